@@ -22,8 +22,40 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 app.config['MAX_CONTENT_LENGTH'] = 1000 * 1024 * 1024  # 1GB max file size
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['PROCESSED_FOLDER'] = 'processed'
+# Processed outputs (segmentations, rendered slices) older than this are removed by /api/cleanup
+app.config['PROCESSED_RETENTION_DAYS'] = float(os.environ.get("PROCESSED_RETENTION_DAYS", 7))
+# Resumable chunked uploads: sessions live beside the uploads so finished files are moved, not copied
+app.config['CHUNKED_UPLOAD_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.chunked')
+app.config['CHUNKED_UPLOAD_CHUNK_SIZE'] = int(os.environ.get("CHUNKED_UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+app.config['CHUNKED_UPLOAD_MAX_BYTES'] = int(os.environ.get("CHUNKED_UPLOAD_MAX_BYTES", 16 * 1024 ** 3))
+app.config['CHUNKED_UPLOAD_EXPIRY_HOURS'] = float(os.environ.get("CHUNKED_UPLOAD_EXPIRY_HOURS", 48))
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # Disable caching for development
 
+# Memory budget for decoded image volumes shared by all requests in a worker
+app.config['VOLUME_CACHE_MAX_BYTES'] = int(os.environ.get("VOLUME_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+# Uncompressed, memory-mappable copies of uploads written at ingest time
+app.config['SLICE_STORE_FOLDER'] = os.path.join(app.config['PROCESSED_FOLDER'], 'slice_store')
+# Rendered slices, content-addressed and kept apart from the upload store
+app.config['TILE_CACHE_FOLDER'] = os.path.join(app.config['PROCESSED_FOLDER'], 'tiles')
+app.config['TILE_CACHE_MAX_BYTES'] = int(os.environ.get("TILE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# Background processing concurrency (segmentation + analysis jobs per worker)
+app.config['PROCESSING_WORKERS'] = int(os.environ.get("PROCESSING_WORKERS", 2))
+
+# Processes decoding the frames of an uploaded DICOM series
+app.config['SERIES_DECODE_WORKERS'] = int(os.environ.get("SERIES_DECODE_WORKERS", os.cpu_count() or 1))
+# Fastest decoding plugin per DICOM transfer syntax, measured by `python -m services.pixel_decoders`.
+# Kept in the instance folder: it is configuration, not a processed output the cleanup may remove.
+app.config['PIXEL_DECODER_TABLE'] = os.environ.get(
+    "PIXEL_DECODER_TABLE", os.path.join(app.instance_path, 'decoder_table.json'))
+
+# Segmentation backend: auto (TotalSegmentator if installed), totalsegmentator or standin.
+# The worker process is recycled after this many studies.
+app.config['SEGMENTATION_BACKEND'] = os.environ.get("SEGMENTATION_BACKEND", "auto")
+app.config['SEGMENTATION_MAX_JOBS_PER_WORKER'] = int(os.environ.get("SEGMENTATION_MAX_JOBS_PER_WORKER", 50))
+# Douglas-Peucker tolerance (voxels) of the outlines traced for vector segmentation overlays
+app.config['CONTOUR_TOLERANCE'] = float(os.environ.get("CONTOUR_TOLERANCE", 0.5))
+
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///medical_imaging.db")
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
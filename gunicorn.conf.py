@@ -7,7 +7,10 @@ backlog = 2048
 
 # Worker processes
 workers = 1  # Keep single worker for development
-worker_class = "sync"
+# Threaded workers keep serving uploads and viewer requests while
+# processing jobs run on the background pool (PROCESSING_WORKERS)
+worker_class = "gthread"
+threads = 4
 worker_connections = 1000
 max_requests = 1000
 max_requests_jitter = 50
@@ -32,10 +32,28 @@ class MedicalStudy(db.Model):
     # Relationship to analysis results
     analyses = db.relationship('AnalysisResult', backref='study', lazy=True)
 
+class StudyMetadata(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of the study file
+    format = db.Column(db.String(16), nullable=False)  # DICOM, NIFTI
+    modality = db.Column(db.String(16))
+    dimensions = db.Column(db.JSON)
+    slice_count = db.Column(db.Integer, default=1)
+    voxel_spacing = db.Column(db.JSON)  # mm as [row, column, slice]
+    dtype = db.Column(db.String(32))
+    affine = db.Column(db.JSON)  # 4x4 voxel-to-patient transform
+    intensity_stats = db.Column(db.JSON)
+    header = db.Column(db.JSON)  # Format-specific header fields
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # One metadata record per medical study, parsed once at ingest
+    study_id = db.Column(db.Integer, db.ForeignKey('medical_study.id'), nullable=False, unique=True, index=True)
+    study = db.relationship('MedicalStudy', backref=db.backref('image_metadata', uselist=False))
+
 class AnalysisResult(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     analysis_type = db.Column(db.String(64), nullable=False)  # segmentation, detection, etc.
-    status = db.Column(db.String(32), default='pending')  # pending, completed, failed
+    status = db.Column(db.String(32), default='pending')  # pending, completed, failed, expired (results cleaned up)
     result_data = db.Column(db.JSON)  # Store JSON results
     segmentation_path = db.Column(db.String(500))  # Path to segmentation files
     report_text = db.Column(db.Text)  # LLM generated report
@@ -1,32 +1,346 @@
 import os
 import json
+import shutil
 import logging
+import tempfile
+import zipfile
 from datetime import datetime
-from flask import render_template, request, jsonify, send_file, flash, redirect, url_for
+from flask import render_template, request, jsonify, flash, redirect, url_for, Response
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 from app import app, db
-from models import MedicalStudy, AnalysisResult, ProcessingLog
-from services.image_processor import ImageProcessor
+from models import MedicalStudy, AnalysisResult, ProcessingLog, StudyMetadata
+from services.image_processor import ImageProcessor, DEFAULT_SPRITE_SIZE
 from services.segmentation_service import SegmentationService
 from services.llm_service import LLMService
+from services.volume_cache import VolumeCache
+from services.job_queue import JobQueue
+from services.slice_store import SliceStore, SliceFileRange
+from services.tile_cache import TileCache
+from services.image_encoder import IMAGE_MIMETYPES, normalize_format
+from services.dicom_series import DicomSeriesBuilder, extract_archive
+from services.chunked_upload import ChunkedUploadStore
+from services.upload_stream import receive_multipart
+from services import pixel_decoders, label_volume, contour_store, overlay, mpr
 from utils.validators import validate_medical_file
-from utils.file_utils import get_file_info, cleanup_old_files
+from utils.file_utils import get_file_info, cleanup_old_files, store_file_content_addressed
 
 logger = logging.getLogger(__name__)
 
 # Initialize services
-image_processor = ImageProcessor()
-segmentation_service = SegmentationService()
+image_processor = ImageProcessor(
+    volume_cache=VolumeCache(max_bytes=app.config['VOLUME_CACHE_MAX_BYTES']),
+    slice_store=SliceStore(app.config['SLICE_STORE_FOLDER']),
+    tile_cache=TileCache(app.config['TILE_CACHE_FOLDER'], max_bytes=app.config['TILE_CACHE_MAX_BYTES'])
+)
+segmentation_service = SegmentationService(
+    backend=app.config['SEGMENTATION_BACKEND'],
+    max_jobs_per_worker=app.config['SEGMENTATION_MAX_JOBS_PER_WORKER'],
+    contour_tolerance=app.config['CONTOUR_TOLERANCE']
+)
 llm_service = LLMService()
+processing_queue = JobQueue(max_workers=app.config['PROCESSING_WORKERS'])
+series_builder = DicomSeriesBuilder(workers=app.config['SERIES_DECODE_WORKERS'])
+pixel_decoders.selector.load_table(app.config['PIXEL_DECODER_TABLE'])
+upload_store = ChunkedUploadStore(
+    app.config['CHUNKED_UPLOAD_FOLDER'],
+    chunk_size=app.config['CHUNKED_UPLOAD_CHUNK_SIZE'],
+    max_bytes=app.config['CHUNKED_UPLOAD_MAX_BYTES'],
+    expiry_seconds=app.config['CHUNKED_UPLOAD_EXPIRY_HOURS'] * 3600
+)
+
+def recover_interrupted_studies():
+    """Mark studies left queued or processing by a previous process as failed"""
+    with app.app_context():
+        interrupted = MedicalStudy.query.filter(MedicalStudy.processing_status.in_(('queued', 'processing'))).all()
+        for study in interrupted:
+            study.processing_status = 'failed'
+            db.session.add(ProcessingLog(
+                study_id=study.id,
+                log_level='ERROR',
+                message='Processing interrupted by a restart; submit the study again',
+                component='api'
+            ))
+        db.session.commit()
+        if interrupted:
+            logger.warning(f"Marked {len(interrupted)} interrupted studies as failed")
+
+# Job state lives in memory, so jobs of the previous process are gone
+recover_interrupted_studies()
 
 ALLOWED_EXTENSIONS = {'dcm', 'nii', 'nii.gz', 'gz'}
 
+STUDY_METADATA_FIELDS = ('format', 'modality', 'dimensions', 'slice_count', 'voxel_spacing',
+                         'dtype', 'affine', 'intensity_stats', 'header')
+
+def negotiate_image_format():
+    """Pick the slice image format from ?format= or the Accept header"""
+    requested = request.args.get('format')
+    if requested:
+        return normalize_format(requested)
+    
+    best = request.accept_mimetypes.best_match(list(IMAGE_MIMETYPES.values()), default='image/png')
+    return next(fmt for fmt, mimetype in IMAGE_MIMETYPES.items() if mimetype == best)
+
+def check_plane(study, plane):
+    """Error response for an MPR plane the study cannot provide, else None"""
+    if plane is None:
+        return None
+    planes = image_processor.get_available_planes(study.file_path)
+    if not planes:
+        return jsonify({'error': 'MPR planes are only available for 3D NIFTI volumes'}), 400
+    if plane not in planes:
+        return jsonify({'error': f'Unknown plane. Use one of: {", ".join(planes)}'}), 400
+    return None
+
+def resolve_overlay(study, plane):
+    """
+    Segmentation overlay requested with overlay=<analysis id>, organs= and alpha=
+    
+    Returns:
+        tuple of (LabelOverlay or None, error response or None)
+    """
+    analysis_id = request.args.get('overlay', type=int)
+    if analysis_id is None:
+        if 'overlay' in request.args:
+            return None, (jsonify({'error': 'overlay must be an analysis id'}), 400)
+        return None, None
+    
+    analysis = db.session.get(AnalysisResult, analysis_id)
+    if analysis is None or analysis.study_id != study.id:
+        return None, (jsonify({'error': 'No such segmentation for this study'}), 404)
+    if not analysis.segmentation_path or not os.path.isdir(analysis.segmentation_path):
+        return None, (jsonify({'error': 'Segmentation data not found'}), 404)
+    if not segmentation_service.ensure_label_volume(analysis.segmentation_path):
+        return None, (jsonify({'error': 'Segmentation has no masks to overlay'}), 404)
+    
+    organs = [organ for organ in request.args.get('organs', '').split(',') if organ]
+    alpha = request.args.get('alpha', overlay.DEFAULT_ALPHA, type=float)
+    try:
+        label_overlay = overlay.LabelOverlay(analysis.segmentation_path, organs or None, alpha)
+    except ValueError as e:
+        return None, (jsonify({'error': str(e)}), 400)
+    
+    if not label_overlay.fits(plane, image_processor.get_slice_grid(study.file_path, plane)):
+        return None, (jsonify({'error': 'Segmentation does not match the image geometry'}), 400)
+    return label_overlay, None
+
 def allowed_file(filename):
     return '.' in filename and (
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS or
         filename.lower().endswith('.nii.gz')
     )
 
+def ingest_study_metadata(study, content_hash=None):
+    """
+    Parse a study's image once and persist it as StudyMetadata
+    
+    Studies sharing content with an already ingested study copy its record
+    instead of parsing the file again.
+    
+    Returns:
+        StudyMetadata record, or None if the image could not be parsed
+    """
+    try:
+        if study.image_metadata is not None:
+            return study.image_metadata
+        
+        content_hash = content_hash or image_processor.get_content_hash(study.file_path)
+        existing = StudyMetadata.query.filter_by(content_hash=content_hash).first()
+        if existing is not None:
+            fields = {name: getattr(existing, name) for name in STUDY_METADATA_FIELDS}
+        else:
+            described = image_processor.describe_study(study.file_path)
+            if not described['success']:
+                logger.warning(f"Could not ingest study {study.id}: {described['error']}")
+                return None
+            fields = {name: described[name] for name in STUDY_METADATA_FIELDS}
+        
+        fields['modality'] = fields['modality'] or study.modality
+        image_metadata = StudyMetadata(study_id=study.id, content_hash=content_hash, **fields)
+        db.session.add(image_metadata)
+        db.session.commit()
+        return image_metadata
+        
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error ingesting study {study.id}: {str(e)}")
+        return None
+
+def discard_upload(saved):
+    """Remove a stored upload unless it existed before or a study references it"""
+    if saved['existed'] or MedicalStudy.query.filter_by(file_path=saved['path']).first():
+        return
+    try:
+        os.remove(saved['path'])
+    except OSError:
+        pass  # File already removed or doesn't exist
+
+def register_upload(saved, filename, original_filename, fields):
+    """
+    Validate a stored upload, build its slice store and create its study
+    
+    Args:
+        saved: Result of storing the file content-addressed
+        filename: Secured filename
+        original_filename: Filename as uploaded
+        fields: Form fields (patient_id, study_id, description)
+    
+    Returns:
+        tuple of (response body, HTTP status); invalid files are discarded
+    """
+    filepath = saved['path']
+    content_hash = saved['sha256']
+    if saved['existed']:
+        logger.info(f"Upload of {filename} matches stored content {content_hash[:12]}")
+    
+    # Validate medical file format with improved error handling
+    try:
+        validation_result = validate_medical_file(filepath, max_size=app.config['CHUNKED_UPLOAD_MAX_BYTES'])
+        if not validation_result['valid']:
+            discard_upload(saved)  # Clean up invalid file
+            return {'error': f'Invalid medical image file: {validation_result["error"]}'}, 400
+    except Exception as validation_error:
+        discard_upload(saved)
+        return {'error': f'File validation failed: {str(validation_error)}'}, 400
+    
+    # Write the random-access slice store so slice serving avoids gzip
+    store_result = image_processor.build_slice_store(filepath, content_hash=content_hash)
+    if not store_result['success']:
+        logger.warning(f"Slice store not built for {filepath}: {store_result['error']}")
+    
+    # Get file information
+    try:
+        file_info = get_file_info(filepath)
+    except Exception as info_error:
+        logger.warning(f"Could not get file info for {filepath}: {str(info_error)}")
+        file_info = {'size': os.path.getsize(filepath) if os.path.exists(filepath) else 0}
+    
+    # Create database record
+    study = MedicalStudy(
+        patient_id=fields.get('patient_id', 'UNKNOWN'),
+        study_id=fields.get('study_id', f'STUDY_{int(datetime.now().timestamp())}'),
+        modality=validation_result.get('modality', 'UNKNOWN'),
+        study_date=datetime.now(),
+        description=fields.get('description', ''),
+        original_filename=original_filename,
+        file_path=filepath,
+        file_size=file_info['size'],
+        processing_status='uploaded'
+    )
+    
+    db.session.add(study)
+    db.session.commit()
+    
+    # Parse the image once; later stages read the stored metadata
+    ingest_study_metadata(study, content_hash)
+    
+    logger.info(f"File uploaded successfully: {filename}, Study ID: {study.id}")
+    
+    return {
+        'success': True,
+        'study_id': study.id,
+        'message': 'File uploaded successfully',
+        'file_info': {
+            'filename': filename,
+            'size': file_info['size'],
+            'sha256': content_hash,
+            'duplicate': saved['existed'],
+            'modality': validation_result.get('modality'),
+            'format': validation_result.get('format')
+        }
+    }, 200
+
+def register_series(paths, work_dir, uploaded_name, fields):
+    """
+    Stack the DICOM series found among uploaded files and create a study per series
+    
+    Args:
+        paths: DICOM files (already extracted from any archives)
+        work_dir: Scratch directory beside the upload folder
+        uploaded_name: Name shown for the upload in each study's filename
+        fields: Form fields (patient_id, study_id, description)
+    
+    Returns:
+        tuple of (response body, HTTP status)
+    """
+    output_dir = os.path.join(work_dir, 'stacked')
+    os.makedirs(output_dir)
+    built = series_builder.build(paths, output_dir)
+    if not built['success']:
+        return {'error': f'Invalid DICOM series: {built["error"]}'}, 400
+    
+    # Validate every stacked series before creating any study, so an upload
+    # never ends up half registered
+    stored = []
+    for series in built['series']:
+        saved = store_file_content_addressed(series['path'], app.config['UPLOAD_FOLDER'], 'series.nii')
+        stored.append((series, saved))
+        validation_result = validate_medical_file(saved['path'], max_size=app.config['CHUNKED_UPLOAD_MAX_BYTES'])
+        if not validation_result['valid']:
+            for _, other in stored:
+                discard_upload(other)
+            return {'error': f'Stacked series {series["series_uid"]} is invalid: {validation_result["error"]}'}, 500
+    
+    registered = []
+    for series, saved in stored:
+        filepath = saved['path']
+        store_result = image_processor.build_slice_store(filepath, content_hash=saved['sha256'])
+        if not store_result['success']:
+            logger.warning(f"Slice store not built for {filepath}: {store_result['error']}")
+        
+        study = MedicalStudy(
+            patient_id=fields.get('patient_id') or series['patient_id'] or 'UNKNOWN',
+            study_id=fields.get('study_id') or f'STUDY_{int(datetime.now().timestamp())}',
+            modality=series['modality'][:16],
+            study_date=datetime.now(),
+            description=fields.get('description') or series['series_description'],
+            original_filename=f"{uploaded_name} ({series['series_description'] or series['series_uid']})"[:255],
+            file_path=filepath,
+            file_size=saved['size'],
+            processing_status='uploaded'
+        )
+        db.session.add(study)
+        registered.append((series, saved, study))
+    db.session.commit()
+    
+    studies = []
+    for series, saved, study in registered:
+        content_hash = saved['sha256']
+        image_metadata = ingest_study_metadata(study, content_hash)
+        if image_metadata is not None:
+            series_header = {name: series[name] for name in (
+                'series_uid', 'study_uid', 'series_description', 'instances',
+                'slice_spacing', 'window_center', 'window_width')}
+            image_metadata.header = dict(image_metadata.header or {}, dicom_series=series_header,
+                                         pixel_decode=series['pixel_decode'])
+            db.session.commit()
+        
+        logger.info(f"Series {series['series_uid']} uploaded: {series['instances']} instances, "
+                    f"Study ID: {study.id}")
+        studies.append({
+            'success': True,
+            'study_id': study.id,
+            'file_info': {
+                'filename': study.original_filename,
+                'size': saved['size'],
+                'sha256': content_hash,
+                'duplicate': saved['existed'],
+                'modality': series['modality'],
+                'format': 'DICOM series',
+                'instances': series['instances'],
+                'dimensions': series['shape'],
+                'series_uid': series['series_uid']
+            }
+        })
+    
+    return {
+        'success': True,
+        'studies': studies,
+        'skipped_files': built['skipped_files'],
+        'message': f'{len(studies)} series uploaded successfully'
+    }, 200
+
 @app.route('/')
 def index():
     """Main dashboard page"""
@@ -42,178 +356,315 @@ def upload_page():
 def upload_file():
     """Handle file upload and basic validation with streaming support"""
     try:
-        if 'file' not in request.files:
+        boundary = request.mimetype_params.get('boundary')
+        if request.mimetype != 'multipart/form-data' or not boundary:
             return jsonify({'error': 'No file provided'}), 400
         
-        file = request.files['file']
-        if file.filename == '' or file.filename is None:
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file type. Please upload DICOM (.dcm) or NIFTI (.nii, .nii.gz) files'}), 400
+        # Parse the body ourselves (request.files would spool it to a temp file first):
+        # the file is hashed, sniffed and written once, straight into the upload store
+        received = receive_multipart(request.stream, boundary.encode('latin-1'), app.config['UPLOAD_FOLDER'],
+                                     accept_filename=allowed_file)
+        if not received['success']:
+            return jsonify({'error': received['error']}), received['status']
+        saved = received['file']
         
         # Secure the filename
-        filename = secure_filename(file.filename) if file.filename else None
+        filename = secure_filename(saved['filename'])
         if not filename:
             filename = 'medical_image_' + str(int(datetime.now().timestamp()))
         
-        # Save file with streaming to handle large files
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        body, status = register_upload(saved, filename, saved['filename'], received['fields'])
+        return jsonify(body), status
         
-        # Stream save for large files
-        with open(filepath, 'wb') as f:
-            while True:
-                chunk = file.stream.read(4096)  # 4KB chunks
-                if not chunk:
-                    break
-                f.write(chunk)
+    except Exception as e:
+        logger.error(f"Upload error: {str(e)}")
+        # Clean up the stored file unless earlier uploads share it
+        if 'saved' in locals():
+            discard_upload(saved)
+        return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+
+@app.route('/api/upload/series', methods=['POST'])
+def upload_series():
+    """Upload a DICOM series as many files or a zip; each series becomes one stacked study"""
+    work_dir = None
+    try:
+        files = [f for f in request.files.getlist('files') + request.files.getlist('file') if f.filename]
+        if not files:
+            return jsonify({'error': 'No files provided'}), 400
         
-        # Validate medical file format with improved error handling
-        try:
-            validation_result = validate_medical_file(filepath)
-            if not validation_result['valid']:
-                try:
-                    os.remove(filepath)  # Clean up invalid file
-                except OSError:
-                    pass  # File already removed or doesn't exist
-                return jsonify({'error': f'Invalid medical image file: {validation_result["error"]}'}), 400
-        except Exception as validation_error:
-            try:
-                os.remove(filepath)
-            except OSError:
-                pass
-            return jsonify({'error': f'File validation failed: {str(validation_error)}'}), 400
-        
-        # Get file information
+        # Working files live beside the uploads so stacked volumes are moved, not copied
+        work_dir = tempfile.mkdtemp(prefix='.series_', dir=app.config['UPLOAD_FOLDER'])
+        paths = []
+        for index, file in enumerate(files):
+            path = os.path.join(work_dir, f'upload_{index:06d}')
+            file.save(path)
+            if zipfile.is_zipfile(path):
+                archive_dir = os.path.join(work_dir, f'archive_{index:06d}')
+                os.makedirs(archive_dir)
+                paths += extract_archive(path, archive_dir)
+            else:
+                paths.append(path)
+        
+        uploaded_name = files[0].filename if len(files) == 1 else f'{len(files)} DICOM files'
+        body, status = register_series(paths, work_dir, uploaded_name, request.form)
+        return jsonify(body), status
+        
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Series upload error: {str(e)}")
+        return jsonify({'error': f'Series upload failed: {str(e)}'}), 500
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+@app.route('/api/uploads', methods=['POST'])
+def create_chunked_upload():
+    """Start a resumable upload; chunks are then PUT in any order and in parallel"""
+    try:
+        data = request.get_json(silent=True) or {}
+        original_filename = data.get('filename') or ''
+        if not original_filename or not (allowed_file(original_filename) or
+                                         original_filename.lower().endswith('.zip')):
+            return jsonify({'error': 'Invalid file type. Please upload DICOM (.dcm), NIFTI (.nii, .nii.gz) '
+                                     'or a zip of a DICOM series'}), 400
         try:
-            file_info = get_file_info(filepath)
-        except Exception as info_error:
-            logger.warning(f"Could not get file info for {filepath}: {str(info_error)}")
-            file_info = {'size': os.path.getsize(filepath) if os.path.exists(filepath) else 0}
+            size = int(data.get('size'))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'size must be the file size in bytes'}), 400
         
-        # Create database record
-        study = MedicalStudy(
-            patient_id=request.form.get('patient_id', 'UNKNOWN'),
-            study_id=request.form.get('study_id', f'STUDY_{int(datetime.now().timestamp())}'),
-            modality=validation_result.get('modality', 'UNKNOWN'),
-            study_date=datetime.now(),
-            description=request.form.get('description', ''),
-            original_filename=file.filename,
-            file_path=filepath,
-            file_size=file_info['size'],
-            processing_status='uploaded'
-        )
+        fields = {name: str(data[name]) for name in ('patient_id', 'study_id', 'description')
+                  if data.get(name) is not None}
+        created = upload_store.create(original_filename, size, fields=fields, sha256=data.get('sha256'))
+        if not created['success']:
+            return jsonify({'error': created['error']}), 400
+        return jsonify(dict(created['upload'], success=True)), 201
         
-        db.session.add(study)
-        db.session.commit()
+    except Exception as e:
+        logger.error(f"Error creating chunked upload: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_chunked_upload(upload_id):
+    """Received and missing chunks of an upload, for resuming it"""
+    status = upload_store.status(upload_id)
+    if status is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    return jsonify(status)
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def put_upload_chunk(upload_id, index):
+    """Write one chunk (raw request body) at its offset; X-Chunk-SHA256 is checked when given"""
+    try:
+        if request.content_length is None:
+            return jsonify({'error': 'Content-Length is required'}), 411
+        written = upload_store.write_chunk(upload_id, index, request.stream, request.content_length,
+                                           sha256=request.headers.get('X-Chunk-SHA256'))
+        if not written['success']:
+            return jsonify({'error': written['error']}), written['status']
+        return jsonify(written)
+        
+    except Exception as e:
+        logger.error(f"Error receiving chunk {index} of upload {upload_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """Assemble a fully received upload into a study (or one study per series for a zip)"""
+    work_dir = None
+    finalizing = False
+    try:
+        finished = upload_store.finish(upload_id)
+        if not finished['success']:
+            body = {'error': finished['error']}
+            for key in ('missing', 'upload'):
+                if key in finished:
+                    body[key] = finished[key]
+            return jsonify(body), finished['status']
+        if finished['completed']:
+            return jsonify(finished['result']), finished['status']  # Retried after a lost response
+        finalizing = True
         
-        logger.info(f"File uploaded successfully: {filename}, Study ID: {study.id}")
+        original_filename = finished['filename']
+        filename = secure_filename(original_filename) or 'medical_image_' + str(int(datetime.now().timestamp()))
+        if filename.lower().endswith('.zip'):
+            if not zipfile.is_zipfile(finished['path']):
+                body, status = {'error': 'Uploaded file is not a zip archive'}, 400
+            else:
+                work_dir = tempfile.mkdtemp(prefix='.series_', dir=app.config['UPLOAD_FOLDER'])
+                archive_dir = os.path.join(work_dir, 'archive')
+                os.makedirs(archive_dir)
+                paths = extract_archive(finished['path'], archive_dir)
+                body, status = register_series(paths, work_dir, original_filename, finished['fields'])
+        else:
+            saved = store_file_content_addressed(finished['path'], app.config['UPLOAD_FOLDER'], filename,
+                                                 content_hash=finished['sha256'])
+            body, status = register_upload(saved, filename, original_filename, finished['fields'])
         
-        return jsonify({
-            'success': True,
-            'study_id': study.id,
-            'message': 'File uploaded successfully',
-            'file_info': {
-                'filename': filename,
-                'size': file_info['size'],
-                'modality': validation_result.get('modality'),
-                'format': validation_result.get('format')
-            }
-        })
+        # A rejected file cannot become valid by resending it, so the session ends either way
+        upload_store.complete(upload_id, body, status)
+        return jsonify(body), status
         
     except Exception as e:
-        logger.error(f"Upload error: {str(e)}")
-        # Clean up partially uploaded file if it exists
-        if 'filepath' in locals() and os.path.exists(filepath):
-            try:
-                os.remove(filepath)
-            except OSError:
-                pass
+        db.session.rollback()
+        logger.error(f"Error completing upload {upload_id}: {str(e)}")
+        if finalizing:
+            upload_store.reopen(upload_id)  # Let the client retry the completion
         return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    """Abandon an upload and free its disk space"""
+    if not upload_store.discard(upload_id):
+        return jsonify({'error': 'Upload session not found'}), 404
+    return jsonify({'success': True})
 
 @app.route('/api/process/<int:study_id>', methods=['POST'])
 def process_study(study_id):
-    """Process a medical study with segmentation and analysis"""
+    """Queue a medical study for segmentation and analysis"""
     try:
         study = MedicalStudy.query.get_or_404(study_id)
         
-        if study.processing_status == 'processing':
-            return jsonify({'error': 'Study is already being processed'}), 400
+        if study.processing_status in ('queued', 'processing'):
+            if processing_queue.is_active(study_id):
+                return jsonify({'error': 'Study is already being processed'}), 400
+            # No live job behind the status: the worker that ran it was restarted
+            logger.warning(f"Study {study_id} was left {study.processing_status}; queueing it again")
+        
+        # Read the request body now; the job runs outside the request context
+        analysis_request = (request.get_json(silent=True) or {}).get('analysis_request', '')
         
         # Update status
-        study.processing_status = 'processing'
+        study.processing_status = 'queued'
         db.session.commit()
         
+        job_id = processing_queue.submit(run_processing_job, study_id, analysis_request, study_id=study_id)
+        
         # Log processing start
         log_entry = ProcessingLog(
             study_id=study_id,
             log_level='INFO',
-            message='Processing started',
+            message=f'Processing queued (job {job_id})',
             component='api'
         )
         db.session.add(log_entry)
         db.session.commit()
         
-        # Process the image
-        processed_data = image_processor.process_image(study.file_path)
-        if not processed_data['success']:
-            study.processing_status = 'failed'
-            db.session.commit()
-            return jsonify({'error': processed_data['error']}), 500
-        
-        # Run segmentation
-        segmentation_result = segmentation_service.segment_image(
-            study.file_path, 
-            output_dir=app.config['PROCESSED_FOLDER']
-        )
-        
-        if not segmentation_result['success']:
-            study.processing_status = 'failed'
-            db.session.commit()
-            return jsonify({'error': segmentation_result['error']}), 500
-        
-        # Generate LLM analysis if requested
-        analysis_request = request.json.get('analysis_request', '')
-        llm_report = None
-        if analysis_request:
-            llm_report = llm_service.analyze_segmentation(
-                segmentation_result['data'], 
-                analysis_request
-            )
-        
-        # Create analysis result
-        analysis = AnalysisResult(
-            study_id=study_id,
-            analysis_type='segmentation',
-            status='completed',
-            result_data=segmentation_result['data'],
-            segmentation_path=segmentation_result.get('output_path'),
-            report_text=llm_report.get('report', '') if llm_report else '',
-            confidence_score=segmentation_result.get('confidence'),
-            processing_time=segmentation_result.get('processing_time', 0),
-            completed_at=datetime.now()
-        )
-        
-        db.session.add(analysis)
-        study.processing_status = 'completed'
-        db.session.commit()
-        
-        logger.info(f"Study {study_id} processed successfully")
-        
-        return jsonify({
+        response = jsonify({
             'success': True,
             'study_id': study_id,
-            'analysis_id': analysis.id,
-            'message': 'Processing completed successfully'
+            'job_id': job_id,
+            'status_url': url_for('get_study_status', study_id=study_id),
+            'message': 'Processing queued'
         })
+        response.status_code = 202
+        response.headers['Location'] = url_for('get_study_status', study_id=study_id)
+        return response
         
     except Exception as e:
-        logger.error(f"Processing error for study {study_id}: {str(e)}")
-        if 'study' in locals():
-            study.processing_status = 'failed'
-            db.session.commit()
+        logger.error(f"Error queueing study {study_id}: {str(e)}")
         return jsonify({'error': f'Processing failed: {str(e)}'}), 500
 
+def _log_processing(study_id, message, log_level='INFO', component='processing'):
+    """Add a processing log entry for a study"""
+    db.session.add(ProcessingLog(
+        study_id=study_id,
+        log_level=log_level,
+        message=message,
+        component=component
+    ))
+    db.session.commit()
+
+def _fail_processing(study, message):
+    """Mark a study as failed and raise so the job records the error"""
+    study.processing_status = 'failed'
+    db.session.commit()
+    _log_processing(study.id, message, log_level='ERROR')
+    raise RuntimeError(message)
+
+def run_processing_job(job_id, study_id, analysis_request=''):
+    """Run image processing, segmentation and LLM analysis for a study (background job)"""
+    with app.app_context():
+        study = db.session.get(MedicalStudy, study_id)
+        if study is None:
+            raise RuntimeError(f'Study {study_id} not found')
+        
+        try:
+            study.processing_status = 'processing'
+            db.session.commit()
+            
+            # Full pixel validation, deferred from the upload request
+            processing_queue.update(job_id, stage='validation', progress=0.02)
+            validation_result = validate_medical_file(study.file_path, deep=True,
+                                                  max_size=app.config['CHUNKED_UPLOAD_MAX_BYTES'])
+            if not validation_result['valid']:
+                _fail_processing(study, f"Invalid medical image file: {validation_result['error']}")
+            
+            # Image metadata is parsed at upload; studies from before ingest get it now
+            processing_queue.update(job_id, stage='image_processing', progress=0.05)
+            _log_processing(study_id, 'Image processing started')
+            if ingest_study_metadata(study) is None:
+                _fail_processing(study, 'Image processing failed: could not parse image metadata')
+            
+            # Run segmentation
+            processing_queue.update(job_id, stage='segmentation', progress=0.2)
+            _log_processing(study_id, 'Segmentation started')
+            segmentation_result = segmentation_service.segment_image(
+                study.file_path, 
+                output_dir=app.config['PROCESSED_FOLDER'],
+                content_hash=image_processor.get_content_hash(study.file_path)
+            )
+            
+            if not segmentation_result['success']:
+                _fail_processing(study, segmentation_result['error'])
+            if segmentation_result.get('reused'):
+                _log_processing(study_id, 'Reused segmentation of identical content')
+            
+            # Generate LLM analysis if requested
+            llm_report = None
+            if analysis_request:
+                processing_queue.update(job_id, stage='report', progress=0.8)
+                llm_report = llm_service.analyze_segmentation(
+                    segmentation_result['data'], 
+                    analysis_request,
+                    image_metadata=study.image_metadata
+                )
+            
+            # Create analysis result
+            processing_queue.update(job_id, stage='saving', progress=0.95)
+            analysis = AnalysisResult(
+                study_id=study_id,
+                analysis_type='segmentation',
+                status='completed',
+                result_data=segmentation_result['data'],
+                segmentation_path=segmentation_result.get('output_path'),
+                report_text=llm_report.get('report', '') if llm_report else '',
+                confidence_score=segmentation_result.get('confidence'),
+                processing_time=segmentation_result.get('processing_time', 0),
+                completed_at=datetime.now()
+            )
+            
+            db.session.add(analysis)
+            study.processing_status = 'completed'
+            db.session.commit()
+            _log_processing(study_id, 'Processing completed')
+            
+            logger.info(f"Study {study_id} processed successfully")
+            return {'analysis_id': analysis.id}
+            
+        except Exception as e:
+            logger.error(f"Processing error for study {study_id}: {str(e)}")
+            db.session.rollback()
+            if study.processing_status != 'failed':
+                study.processing_status = 'failed'
+                db.session.commit()
+                _log_processing(study_id, f'Processing failed: {str(e)}', log_level='ERROR')
+            raise
+        finally:
+            db.session.remove()
+
 @app.route('/viewer/<int:study_id>')
 def viewer(study_id):
     """Medical image viewer page"""
@@ -227,33 +678,175 @@ def serve_image(study_id):
     try:
         study = MedicalStudy.query.get_or_404(study_id)
         slice_index = request.args.get('slice', 0, type=int)
+        quality = request.args.get('quality', type=int)
+        window = request.args.get('window', 'auto')
+        level = request.args.get('level', type=int)
+        max_size = request.args.get('max_size', type=int)
+        plane = request.args.get('plane')
         
-        # Convert image to format suitable for web viewing
-        web_image_path = image_processor.prepare_for_web(study.file_path, slice_index=slice_index)
+        image_format = negotiate_image_format()
+        if image_format is None:
+            return jsonify({'error': f'Unsupported format. Use one of: {", ".join(IMAGE_MIMETYPES)}'}), 400
+        if level is not None and max_size is not None:
+            return jsonify({'error': 'Use either level or max_size, not both'}), 400
+        if (level is not None and level < 0) or (max_size is not None and max_size < 1):
+            return jsonify({'error': 'Invalid pyramid level or size'}), 400
         
-        if not web_image_path or not os.path.exists(web_image_path):
+        windows = image_processor.get_available_windows(study.file_path)
+        if window not in windows:
+            return jsonify({'error': f'Unknown window. Use one of: {", ".join(windows)}'}), 400
+        plane_error = check_plane(study, plane)
+        if plane_error:
+            return plane_error
+        label_overlay, overlay_error = resolve_overlay(study, plane)
+        if overlay_error:
+            return overlay_error
+        
+        level, pyramid = image_processor.resolve_pyramid_level(study.file_path, level=level, max_size=max_size,
+                                                               plane=plane)
+        
+        # Encode in memory and return the bytes directly
+        image_bytes = image_processor.render_for_web(
+            study.file_path,
+            slice_index=slice_index,
+            fmt=image_format,
+            quality=quality,
+            window=window,
+            level=level,
+            plane=plane,
+            overlay=label_overlay
+        )
+        
+        if image_bytes is None:
             return jsonify({'error': 'Image preparation failed'}), 500
         
-        return send_file(web_image_path, as_attachment=False)
+        response = Response(image_bytes, mimetype=IMAGE_MIMETYPES[image_format])
+        response.headers['Vary'] = 'Accept'
+        response.headers['X-Pyramid-Level'] = str(level)
+        response.headers['X-Pyramid-Levels'] = str(pyramid['levels'])
+        response.headers['X-Slice-Width'] = str(pyramid['width'])
+        response.headers['X-Slice-Height'] = str(pyramid['height'])
+        return response
         
     except Exception as e:
         logger.error(f"Error serving image for study {study_id}: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/studies/<int:study_id>/slices')
+def serve_slice_sprite(study_id):
+    """Serve a range of slices packed into one sprite sheet (grid layout in X-* headers)"""
+    try:
+        study = MedicalStudy.query.get_or_404(study_id)
+        start = request.args.get('from', 0, type=int)
+        stop = request.args.get('to', type=int)
+        stride = request.args.get('stride', 1, type=int)
+        size = request.args.get('size', DEFAULT_SPRITE_SIZE, type=int)
+        quality = request.args.get('quality', type=int)
+        window = request.args.get('window', 'auto')
+        plane = request.args.get('plane')
+        
+        image_format = negotiate_image_format()
+        if image_format is None:
+            return jsonify({'error': f'Unsupported format. Use one of: {", ".join(IMAGE_MIMETYPES)}'}), 400
+        if stride < 1 or size < 1 or (stop is not None and stop < start):
+            return jsonify({'error': 'Invalid slice range'}), 400
+        
+        windows = image_processor.get_available_windows(study.file_path)
+        if window not in windows:
+            return jsonify({'error': f'Unknown window. Use one of: {", ".join(windows)}'}), 400
+        plane_error = check_plane(study, plane)
+        if plane_error:
+            return plane_error
+        
+        sprite = image_processor.render_sprite(
+            study.file_path,
+            start=start,
+            stop=stop,
+            stride=stride,
+            size=size,
+            fmt=image_format,
+            quality=quality,
+            window=window,
+            plane=plane
+        )
+        if not sprite['success']:
+            return jsonify({'error': sprite['error']}), 500
+        
+        layout = sprite['layout']
+        response = Response(sprite['data'], mimetype=IMAGE_MIMETYPES[image_format])
+        response.headers['Vary'] = 'Accept'
+        response.headers['X-Sprite-Columns'] = str(layout['columns'])
+        response.headers['X-Sprite-Rows'] = str(layout['rows'])
+        response.headers['X-Tile-Width'] = str(layout['tile_width'])
+        response.headers['X-Tile-Height'] = str(layout['tile_height'])
+        response.headers['X-Slice-Width'] = str(layout['slice_width'])
+        response.headers['X-Slice-Height'] = str(layout['slice_height'])
+        response.headers['X-Slice-From'] = str(layout['start'])
+        response.headers['X-Slice-To'] = str(layout['stop'])
+        response.headers['X-Slice-Stride'] = str(layout['stride'])
+        response.headers['X-Slice-Count'] = str(layout['count'])
+        response.headers['X-Total-Slices'] = str(layout['total_slices'])
+        return response
+        
+    except Exception as e:
+        logger.error(f"Error serving slice sprite for study {study_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/studies/<int:study_id>/slices/<int:slice_index>.raw')
+def serve_raw_slice(study_id, slice_index):
+    """Serve one slice's native pixel values for client-side windowing"""
+    try:
+        study = MedicalStudy.query.get_or_404(study_id)
+        
+        raw = image_processor.get_raw_slice(study.file_path, slice_index)
+        if not raw['success']:
+            return jsonify({'error': raw['error']}), 500
+        
+        if 'file_range' in raw:
+            # Stream straight from the slice store (sendfile under gunicorn)
+            file_range = raw['file_range']
+            body = wrap_file(request.environ, SliceFileRange(
+                file_range['path'], file_range['offset'], file_range['length']
+            ))
+            response = Response(body, mimetype='application/octet-stream', direct_passthrough=True)
+            response.content_length = file_range['length']
+        else:
+            response = Response(raw['pixels'].tobytes(), mimetype='application/octet-stream')
+        
+        response.headers['X-Dtype'] = raw['dtype']
+        response.headers['X-Byte-Order'] = 'little'
+        response.headers['X-Shape'] = ','.join(str(x) for x in raw['shape'])
+        response.headers['X-Spacing'] = ','.join(str(x) for x in raw['spacing'])
+        response.headers['X-Rescale-Slope'] = str(raw['rescale_slope'])
+        response.headers['X-Rescale-Intercept'] = str(raw['rescale_intercept'])
+        response.headers['X-Slice-Index'] = str(raw['slice_index'])
+        response.headers['X-Slice-Count'] = str(raw['slice_count'])
+        return response
+        
+    except Exception as e:
+        logger.error(f"Error serving raw slice {slice_index} for study {study_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/studies/<int:study_id>/info')
 def get_study_info(study_id):
     """Get study information including slice count for NIFTI files"""
     try:
         study = MedicalStudy.query.get_or_404(study_id)
         
-        # Process the file to get detailed information
-        processed_info = image_processor.process_image(study.file_path)
+        # Parsed once at ingest; older studies are ingested on first view
+        image_metadata = ingest_study_metadata(study)
+        if image_metadata is None:
+            return jsonify({'error': 'Could not read study image'}), 500
         
         return jsonify({
             'id': study.id,
-            'format': processed_info.get('format', 'unknown'),
-            'slices': processed_info.get('slices', 1),
-            'dimensions': processed_info.get('dimensions', {}),
+            'format': image_metadata.format,
+            'slices': image_metadata.slice_count,
+            'dimensions': image_metadata.dimensions,
+            'voxel_spacing': image_metadata.voxel_spacing,
+            'dtype': image_metadata.dtype,
+            'windows': image_processor.get_available_windows(study.file_path),
+            'planes': image_processor.get_available_planes(study.file_path),
             'modality': study.modality
         })
         
@@ -263,19 +856,100 @@ def get_study_info(study_id):
 
 @app.route('/api/segmentation/<int:analysis_id>')
 def serve_segmentation(analysis_id):
-    """Serve segmentation overlay data"""
+    """Serve the label table of a segmentation; label slices come from the slices route"""
     try:
         analysis = AnalysisResult.query.get_or_404(analysis_id)
         
-        if not analysis.segmentation_path or not os.path.exists(analysis.segmentation_path):
+        if not analysis.segmentation_path or not os.path.isdir(analysis.segmentation_path):
             return jsonify({'error': 'Segmentation data not found'}), 404
         
-        return send_file(analysis.segmentation_path, as_attachment=False)
+        # Results from before label volumes are merged on first request
+        if not segmentation_service.ensure_label_volume(analysis.segmentation_path):
+            return jsonify({'error': 'Segmentation has no masks to serve'}), 404
+        
+        _, table = label_volume.open_label_volume(analysis.segmentation_path)
+        return jsonify({
+            'analysis_id': analysis.id,
+            'study_id': analysis.study_id,
+            'dtype': table['dtype'],
+            'shape': table['shape'],
+            'spacing': table['spacing'],
+            'slice_count': table['shape'][0],
+            'labels': table['labels'],
+            'planes': list(mpr.PLANES)
+        })
         
     except Exception as e:
         logger.error(f"Error serving segmentation for analysis {analysis_id}: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/segmentation/<int:analysis_id>/slices/<int:slice_index>')
+def serve_segmentation_slice(analysis_id, slice_index):
+    """Serve one slice of segmentation labels as raw little-endian integers"""
+    try:
+        analysis = AnalysisResult.query.get_or_404(analysis_id)
+        
+        if not analysis.segmentation_path or not os.path.isdir(analysis.segmentation_path):
+            return jsonify({'error': 'Segmentation data not found'}), 404
+        
+        if not segmentation_service.ensure_label_volume(analysis.segmentation_path):
+            return jsonify({'error': 'Segmentation has no masks to serve'}), 404
+        
+        plane = request.args.get('plane')
+        labels = label_volume.read_label_slice(analysis.segmentation_path, slice_index, plane)
+        if not labels['success']:
+            return jsonify({'error': labels['error']}), 400
+        
+        if 'file_range' in labels:
+            # Stream straight from the memory-mapped label volume
+            file_range = labels['file_range']
+            body = wrap_file(request.environ, SliceFileRange(
+                file_range['path'], file_range['offset'], file_range['length']
+            ))
+            response = Response(body, mimetype='application/octet-stream', direct_passthrough=True)
+            response.content_length = file_range['length']
+        else:
+            response = Response(labels['labels'].tobytes(), mimetype='application/octet-stream')
+        
+        response.headers['X-Dtype'] = labels['dtype']
+        response.headers['X-Byte-Order'] = 'little'
+        response.headers['X-Shape'] = ','.join(str(x) for x in labels['shape'])
+        response.headers['X-Slice-Index'] = str(labels['slice_index'])
+        response.headers['X-Slice-Count'] = str(labels['slice_count'])
+        response.headers['X-Labels-Present'] = ','.join(str(x) for x in labels['present'])
+        return response
+        
+    except Exception as e:
+        logger.error(f"Error serving segmentation slice {slice_index} for analysis {analysis_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/segmentation/<int:analysis_id>/contours/<int:slice_index>')
+def serve_segmentation_contours(analysis_id, slice_index):
+    """Serve the organ outlines of one slice as JSON polygons or SVG paths"""
+    try:
+        analysis = AnalysisResult.query.get_or_404(analysis_id)
+        
+        if not analysis.segmentation_path or not os.path.isdir(analysis.segmentation_path):
+            return jsonify({'error': 'Segmentation data not found'}), 404
+        
+        # Results from before contours are traced on first request
+        if not (segmentation_service.ensure_label_volume(analysis.segmentation_path)
+                and segmentation_service.ensure_contours(analysis.segmentation_path)):
+            return jsonify({'error': 'Segmentation has no masks to outline'}), 404
+        
+        contours = contour_store.read_contours(analysis.segmentation_path, slice_index, request.args.get('plane'))
+        if not contours['success']:
+            return jsonify({'error': contours['error']}), 400
+        
+        if request.args.get('format', 'json') == 'svg':
+            return Response(contour_store.to_svg(contours), mimetype='image/svg+xml')
+        del contours['success']
+        return jsonify(dict(contours, analysis_id=analysis.id))
+        
+    except Exception as e:
+        logger.error(f"Error serving segmentation contours {slice_index} for analysis {analysis_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze_with_llm():
     """Analyze study with LLM using natural language"""
@@ -338,16 +1012,48 @@ def get_study_status(study_id):
     try:
         study = MedicalStudy.query.get_or_404(study_id)
         
-        return jsonify({
+        status = {
             'study_id': study_id,
             'status': study.processing_status,
             'updated_at': study.updated_at.isoformat()
-        })
+        }
+        
+        # Job progress is known to the worker process that queued it
+        job = processing_queue.get_for_study(study_id)
+        if job:
+            status['job'] = {
+                'job_id': job['job_id'],
+                'status': job['status'],
+                'stage': job['stage'],
+                'progress': job['progress'],
+                'error': job['error'],
+                'analysis_id': (job['result'] or {}).get('analysis_id')
+            }
+        else:
+            last_log = ProcessingLog.query.filter_by(study_id=study_id).order_by(ProcessingLog.timestamp.desc()).first()
+            if last_log:
+                status['last_message'] = last_log.message
+        
+        return jsonify(status)
         
     except Exception as e:
         logger.error(f"Error getting study status: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/cache/stats')
+def get_cache_stats():
+    """Get cache, slice store and background worker statistics for this process"""
+    try:
+        stats = image_processor.get_cache_stats()
+        stats['segmentation_worker'] = segmentation_service.get_worker_stats()
+        stats['processing_queue'] = processing_queue.get_stats()
+        stats['pixel_decoders'] = pixel_decoders.selector.get_stats()
+        stats['chunked_uploads'] = upload_store.get_stats()
+        return jsonify(stats)
+    except Exception as e:
+        logger.error(f"Error getting cache stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.errorhandler(413)
 def too_large(e):
     return jsonify({'error': 'File too large. Maximum size is 500MB.'}), 413
@@ -365,8 +1071,27 @@ def internal_error(e):
 def cleanup_files():
     """Clean up old processed files"""
     try:
-        cleanup_old_files(app.config['PROCESSED_FOLDER'], days=7)
-        return jsonify({'success': True, 'message': 'Cleanup completed'})
+        processed_folder = app.config['PROCESSED_FOLDER']
+        days = app.config['PROCESSED_RETENTION_DAYS']
+        
+        # Segmentation results are removed whole and their analyses marked
+        removed = segmentation_service.cleanup_old_results(processed_folder, days=days)
+        if removed:
+            expired = AnalysisResult.query.filter(AnalysisResult.segmentation_path.in_(removed)).all()
+            for analysis in expired:
+                analysis.status = 'expired'
+                analysis.segmentation_path = None
+            db.session.commit()
+            logger.info(f"Expired {len(expired)} analyses with removed segmentation results")
+        
+        # The remaining results, the slice store (which lives as long as its
+        # uploads) and the tile cache (evicted by size) are not swept file by file
+        exclude_dirs = [os.path.join(processed_folder, item) for item in os.listdir(processed_folder)
+                        if item.startswith('segmentation_')]
+        exclude_dirs += [app.config['SLICE_STORE_FOLDER'], app.config['TILE_CACHE_FOLDER']]
+        cleanup_old_files(processed_folder, days=days, exclude_dirs=exclude_dirs)
+        upload_store.expire()
+        return jsonify({'success': True, 'message': 'Cleanup completed', 'segmentations_removed': len(removed)})
     except Exception as e:
         logger.error(f"Cleanup error: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,434 @@
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024  # Small enough to retry cheaply over a slow link
+DEFAULT_MAX_BYTES = 16 * 1024 ** 3
+DEFAULT_EXPIRY_SECONDS = 48 * 3600  # Sessions untouched this long are removed
+WRITE_BLOCK_SIZE = 1024 * 1024  # Request body read/pwrite buffer
+FREE_SPACE_MARGIN = 256 * 1024 * 1024  # Keep this much disk free beyond a new session
+
+UPLOAD_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+MANIFEST_FILENAME = 'manifest.json'
+DATA_FILENAME = 'data.part'
+LOCK_FILENAME = '.lock'
+
+class ChunkedUploadStore:
+    """
+    Resumable uploads assembled from chunks sent in any order
+
+    Each session is a directory holding a data file preallocated to the
+    final size, a JSON manifest (size, chunk size, form fields and the
+    SHA-256 of every received chunk) and a lock file. A chunk is written
+    with pwrite straight to its offset in the data file and only recorded
+    in the manifest once all of its bytes are on disk, so a session
+    survives worker restarts and a client can resend whatever the manifest
+    does not list. The manifest is updated under an flock, so chunks may
+    arrive in parallel on any thread or worker process.
+
+    The SHA-256 of the whole file is computed while the upload runs: each
+    process advances a running digest over the contiguous prefix of
+    received chunks, reading them back from the page cache. A process
+    that has not seen the session before (e.g. after a restart) catches
+    up by hashing the received prefix once.
+    """
+
+    def __init__(self, root, chunk_size=DEFAULT_CHUNK_SIZE, max_bytes=DEFAULT_MAX_BYTES,
+                 expiry_seconds=DEFAULT_EXPIRY_SECONDS):
+        self.root = root
+        self.chunk_size = int(chunk_size)
+        self.max_bytes = int(max_bytes)
+        self.expiry_seconds = expiry_seconds
+        self.chunks_written = 0
+        self.chunks_rejected = 0
+        self._digests = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def create(self, filename, size, fields=None, sha256=None):
+        """
+        Start an upload session and preallocate its data file
+
+        Args:
+            filename: Original filename (kept for its extension)
+            size: Total size in bytes
+            fields: Form fields to apply when the upload completes
+            sha256: Expected digest of the whole file, checked on completion
+
+        Returns:
+            dict with success status and the session status
+        """
+        try:
+            size = int(size)
+            if size <= 0:
+                return {'success': False, 'error': 'Upload size must be positive'}
+            if size > self.max_bytes:
+                return {'success': False, 'error': f'Upload exceeds the {self.max_bytes} byte limit'}
+            if sha256 is not None and not re.fullmatch(r'[0-9a-fA-F]{64}', str(sha256)):
+                return {'success': False, 'error': 'sha256 must be a 64-digit hex digest'}
+            if shutil.disk_usage(self.root).free < size + FREE_SPACE_MARGIN:
+                return {'success': False, 'error': 'Not enough disk space for this upload'}
+
+            self.expire()
+            upload_id = uuid.uuid4().hex
+            session_dir = self._session_dir(upload_id)
+            os.makedirs(session_dir)
+            with open(os.path.join(session_dir, DATA_FILENAME), 'wb') as f:
+                f.truncate(size)  # Sparse; chunks fill it in place
+            open(os.path.join(session_dir, LOCK_FILENAME), 'wb').close()
+
+            manifest = {
+                'upload_id': upload_id,
+                'filename': filename,
+                'size': size,
+                'chunk_size': self.chunk_size,
+                'sha256': sha256.lower() if sha256 else None,
+                'fields': fields or {},
+                'chunks': {},
+                'state': 'open',
+                'result': None,
+                'result_status': None,
+                'created_at': time.time()
+            }
+            self._write_manifest(upload_id, manifest)
+            logger.info(f"Upload session {upload_id} created for {filename} ({size} bytes)")
+            return {'success': True, 'upload': self._status(manifest)}
+
+        except Exception as e:
+            logger.error(f"Error creating upload session for {filename}: {str(e)}")
+            return {'success': False, 'error': f'Could not create upload session: {str(e)}'}
+
+    def status(self, upload_id):
+        """Session status (received chunks, bytes, state), or None if unknown"""
+        manifest = self._read_manifest(upload_id)
+        return self._status(manifest) if manifest is not None else None
+
+    def write_chunk(self, upload_id, index, stream, length, sha256=None):
+        """
+        Write one chunk from a request body straight to its offset
+
+        Args:
+            upload_id: Session id
+            index: Chunk number (0-based)
+            stream: Readable binary stream with the chunk bytes
+            length: Declared body length; must match the chunk's size
+            sha256: Optional digest of the chunk, checked before it is recorded
+
+        Returns:
+            dict with success status, the chunk digest and session progress
+            (status 404 for unknown sessions, 409 for finished ones)
+        """
+        manifest = self._read_manifest(upload_id)
+        if manifest is None:
+            return {'success': False, 'error': 'Upload session not found', 'status': 404}
+        if manifest['state'] != 'open':
+            return {'success': False, 'error': f"Upload session is {manifest['state']}", 'status': 409}
+
+        expected = self._chunk_length(manifest, index)
+        if expected is None:
+            return {'success': False, 'error': f'Chunk {index} is out of range', 'status': 400}
+        if length != expected:
+            return {'success': False, 'error': f'Chunk {index} must be {expected} bytes, got {length}',
+                    'status': 400}
+        if str(index) in manifest['chunks']:
+            # A retry of a chunk that landed; rewriting it could invalidate the running digest
+            status = self._status(manifest)
+            return {'success': True, 'index': index, 'size': expected, 'sha256': manifest['chunks'][str(index)],
+                    'received_bytes': status['received_bytes'], 'complete': not status['missing']}
+
+        try:
+            digest = hashlib.sha256()
+            offset = index * manifest['chunk_size']
+            written = 0
+            fd = os.open(self._data_path(upload_id), os.O_WRONLY)
+            try:
+                while written < expected:
+                    block = stream.read(min(WRITE_BLOCK_SIZE, expected - written))
+                    if not block:
+                        break
+                    digest.update(block)
+                    view = memoryview(block)
+                    while view:
+                        count = os.pwrite(fd, view, offset + written)
+                        view = view[count:]
+                        written += count
+            finally:
+                os.close(fd)
+        except Exception as e:
+            logger.error(f"Error writing chunk {index} of upload {upload_id}: {str(e)}")
+            return {'success': False, 'error': f'Could not write chunk: {str(e)}', 'status': 500}
+
+        chunk_hash = digest.hexdigest()
+        if written != expected or (sha256 and sha256.lower() != chunk_hash):
+            with self._lock:
+                self.chunks_rejected += 1
+            error = (f'Chunk {index} truncated at {written} of {expected} bytes' if written != expected
+                     else f'Chunk {index} does not match its sha256')
+            return {'success': False, 'error': error, 'status': 400}
+
+        with self._locked(upload_id):
+            manifest = self._read_manifest(upload_id)
+            if manifest is None or manifest['state'] != 'open':
+                return {'success': False, 'error': 'Upload session is no longer open', 'status': 409}
+            manifest['chunks'][str(index)] = chunk_hash
+            self._write_manifest(upload_id, manifest)
+        with self._lock:
+            self.chunks_written += 1
+
+        self._advance_digest(upload_id, manifest)
+        status = self._status(manifest)
+        return {
+            'success': True,
+            'index': index,
+            'size': expected,
+            'sha256': chunk_hash,
+            'received_bytes': status['received_bytes'],
+            'complete': not status['missing']
+        }
+
+    def finish(self, upload_id):
+        """
+        Check that every chunk arrived and finish the file digest
+
+        The session moves from open to finalizing under its lock, so only
+        one caller assembles it; chunks and further finish calls are
+        refused (409) until complete() records the result or reopen()
+        hands the session back after a failure.
+
+        Returns:
+            dict with success status, the data file path, sha256, size,
+            filename and form fields; a session that already completed
+            returns its stored result instead
+        """
+        try:
+            with self._locked(upload_id):
+                manifest = self._read_manifest(upload_id)
+                if manifest is None:
+                    return {'success': False, 'error': 'Upload session not found', 'status': 404}
+                if manifest['state'] == 'complete':
+                    return {'success': True, 'completed': True, 'result': manifest['result'],
+                            'status': manifest['result_status']}
+                if manifest['state'] != 'open':
+                    return {'success': False, 'error': f"Upload session is {manifest['state']}",
+                            'upload': self._status(manifest), 'status': 409}
+
+                missing = self._missing(manifest)
+                if missing:
+                    return {'success': False, 'error': f'{len(missing)} chunks have not been received',
+                            'missing': missing, 'status': 409}
+
+                state = self._advance_digest(upload_id, manifest)
+                content_hash = state['hash'].hexdigest()
+                if manifest['sha256'] and manifest['sha256'] != content_hash:
+                    return {'success': False, 'error': 'Uploaded file does not match its sha256',
+                            'status': 400}
+                manifest['state'] = 'finalizing'
+                self._write_manifest(upload_id, manifest)
+
+            return {
+                'success': True,
+                'completed': False,
+                'path': self._data_path(upload_id),
+                'sha256': content_hash,
+                'size': manifest['size'],
+                'filename': manifest['filename'],
+                'fields': manifest['fields']
+            }
+
+        except Exception as e:
+            logger.error(f"Error finishing upload {upload_id}: {str(e)}")
+            return {'success': False, 'error': f'Could not finish upload: {str(e)}', 'status': 500}
+
+    def complete(self, upload_id, result, status=200):
+        """Record the response to a finished upload and drop its data file"""
+        with self._locked(upload_id):
+            manifest = self._read_manifest(upload_id)
+            if manifest is None:
+                return
+            manifest['state'] = 'complete'
+            manifest['result'] = result
+            manifest['result_status'] = status
+            self._write_manifest(upload_id, manifest)
+        self._forget(upload_id)
+        try:
+            os.remove(self._data_path(upload_id))
+        except OSError:
+            pass  # Moved into the upload store
+
+    def reopen(self, upload_id):
+        """
+        Return a finalizing session to open after its assembly failed
+
+        The client can then call finish again. A session whose data file
+        was already moved away cannot be retried and is discarded.
+
+        Returns:
+            True if the session is open again
+        """
+        with self._locked(upload_id):
+            manifest = self._read_manifest(upload_id)
+            if manifest is None or manifest['state'] != 'finalizing':
+                return False
+            if os.path.exists(self._data_path(upload_id)):
+                manifest['state'] = 'open'
+                self._write_manifest(upload_id, manifest)
+                return True
+        self.discard(upload_id)
+        return False
+
+    def discard(self, upload_id):
+        """Remove a session and its data; returns False if it did not exist"""
+        session_dir = self._session_dir(upload_id)
+        if session_dir is None or not os.path.isdir(session_dir):
+            return False
+        self._forget(upload_id)
+        shutil.rmtree(session_dir, ignore_errors=True)
+        logger.info(f"Upload session {upload_id} discarded")
+        return True
+
+    def expire(self, max_age_seconds=None):
+        """Remove sessions whose manifest has not changed for max_age_seconds"""
+        max_age_seconds = self.expiry_seconds if max_age_seconds is None else max_age_seconds
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        for upload_id in os.listdir(self.root):
+            manifest_path = os.path.join(self.root, upload_id, MANIFEST_FILENAME)
+            try:
+                if os.path.getmtime(manifest_path) >= cutoff:
+                    continue
+            except OSError:
+                continue  # Being created or already removed
+            if self.discard(upload_id):
+                removed += 1
+        return removed
+
+    def get_stats(self):
+        """Open (or finalizing) sessions, bytes reserved on disk and chunk counters"""
+        sessions = 0
+        reserved_bytes = 0
+        for upload_id in os.listdir(self.root):
+            manifest = self._read_manifest(upload_id)
+            if manifest is not None and manifest['state'] in ('open', 'finalizing'):
+                sessions += 1
+                reserved_bytes += manifest['size']
+        with self._lock:
+            return {
+                'open_sessions': sessions,
+                'reserved_bytes': reserved_bytes,
+                'chunks_written': self.chunks_written,
+                'chunks_rejected': self.chunks_rejected,
+                'digests_in_progress': len(self._digests)
+            }
+
+    def _advance_digest(self, upload_id, manifest):
+        """Hash newly contiguous chunks into this process's running digest"""
+        end = self._contiguous_bytes(manifest)
+        with self._lock:
+            state = self._digests.setdefault(
+                upload_id, {'hash': hashlib.sha256(), 'offset': 0, 'lock': threading.Lock()})
+        with state['lock']:
+            if state['offset'] < end:
+                with open(self._data_path(upload_id), 'rb') as f:
+                    f.seek(state['offset'])
+                    while state['offset'] < end:
+                        block = f.read(min(WRITE_BLOCK_SIZE, end - state['offset']))
+                        if not block:
+                            raise IOError(f'Upload data ends at {state["offset"]} of {end} bytes')
+                        state['hash'].update(block)
+                        state['offset'] += len(block)
+        return state
+
+    def _forget(self, upload_id):
+        with self._lock:
+            self._digests.pop(upload_id, None)
+
+    def _status(self, manifest):
+        received = sorted(int(index) for index in manifest['chunks'])
+        return {
+            'upload_id': manifest['upload_id'],
+            'filename': manifest['filename'],
+            'size': manifest['size'],
+            'chunk_size': manifest['chunk_size'],
+            'chunk_count': self._chunk_count(manifest),
+            'received': received,
+            'missing': self._missing(manifest),
+            'received_bytes': sum(self._chunk_length(manifest, index) for index in received),
+            'state': manifest['state'],
+            'result': manifest['result']
+        }
+
+    def _chunk_count(self, manifest):
+        return -(-manifest['size'] // manifest['chunk_size'])
+
+    def _chunk_length(self, manifest, index):
+        """Size of a chunk (the last one may be short), or None if out of range"""
+        if index < 0 or index >= self._chunk_count(manifest):
+            return None
+        return min(manifest['chunk_size'], manifest['size'] - index * manifest['chunk_size'])
+
+    def _missing(self, manifest):
+        return [index for index in range(self._chunk_count(manifest)) if str(index) not in manifest['chunks']]
+
+    def _contiguous_bytes(self, manifest):
+        """Bytes from the start of the file covered by received chunks"""
+        index = 0
+        while str(index) in manifest['chunks']:
+            index += 1
+        return min(index * manifest['chunk_size'], manifest['size'])
+
+    def _session_dir(self, upload_id):
+        if not UPLOAD_ID_PATTERN.fullmatch(upload_id or ''):
+            return None
+        return os.path.join(self.root, upload_id)
+
+    def _data_path(self, upload_id):
+        return os.path.join(self._session_dir(upload_id), DATA_FILENAME)
+
+    def _read_manifest(self, upload_id):
+        session_dir = self._session_dir(upload_id)
+        if session_dir is None:
+            return None
+        try:
+            with open(os.path.join(session_dir, MANIFEST_FILENAME)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self, upload_id, manifest):
+        """Replace the manifest atomically so readers never see a partial file"""
+        session_dir = self._session_dir(upload_id)
+        fd, tmp_path = tempfile.mkstemp(dir=session_dir, prefix='.tmp_', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, os.path.join(session_dir, MANIFEST_FILENAME))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @contextmanager
+    def _locked(self, upload_id):
+        """Exclusive lock on a session across threads and processes"""
+        session_dir = self._session_dir(upload_id)
+        if session_dir is None or not os.path.isdir(session_dir):
+            yield
+            return
+        with open(os.path.join(session_dir, LOCK_FILENAME), 'ab') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
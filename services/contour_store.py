@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import struct
+import logging
+import argparse
+import tempfile
+from xml.sax.saxutils import quoteattr
+import cv2
+import numpy as np
+from services import mpr, label_volume, overlay
+
+logger = logging.getLogger(__name__)
+
+CONTOURS_FILENAME = 'contours.bin'
+CONTOUR_FORMAT_VERSION = 1
+MAGIC = b'CONTOUR1'
+FOOTER = struct.Struct('<QQ8s')  # index offset, header offset, magic
+DEFAULT_TOLERANCE = 0.5  # Douglas-Peucker tolerance in voxels
+STORED = 'stored'  # Slices of the label volume as stored (third voxel axis)
+PLANES = (STORED,) + mpr.PLANES
+
+def trace_slice(labels_slice, tolerance=DEFAULT_TOLERANCE):
+    """
+    Outline polygons of every label on one slice
+
+    Args:
+        labels_slice: 2D label array
+        tolerance: Douglas-Peucker tolerance in pixels (0 keeps every vertex)
+
+    Returns:
+        list of (label, polygon) with polygons as (n, 2) arrays of (x, y)
+        pixel centres; holes are returned as polygons of their own
+    """
+    labels_slice = np.ascontiguousarray(labels_slice)
+    polygons = []
+    for label in np.flatnonzero(np.bincount(labels_slice.ravel())):
+        if not label:
+            continue
+        mask = (labels_slice == label).view(np.uint8)
+        contours, _ = cv2.findContours(mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+        for contour in contours:
+            if tolerance > 0 and len(contour) > 2:
+                contour = cv2.approxPolyDP(contour, tolerance, True)
+            polygons.append((int(label), contour.reshape(-1, 2)))
+    return polygons
+
+def encode_polygons(polygons):
+    """Slice record: uint32 polygon count and (label, points) pairs, then uint16 x, y coordinates"""
+    if not polygons:
+        return b''
+    counts = np.array([[label, len(points)] for label, points in polygons], dtype='<u4')
+    coordinates = np.concatenate([points for _, points in polygons]).astype('<u2')
+    return np.uint32(len(polygons)).astype('<u4').tobytes() + counts.tobytes() + coordinates.tobytes()
+
+def decode_polygons(data):
+    """list of (label, (n, 2) int array) from encode_polygons output"""
+    if not data:
+        return []
+    count = int(np.frombuffer(data, dtype='<u4', count=1)[0])
+    counts = np.frombuffer(data, dtype='<u4', count=2 * count, offset=4).reshape(count, 2)
+    coordinates = np.frombuffer(data, dtype='<u2', offset=4 + counts.nbytes).reshape(-1, 2)
+    ends = np.cumsum(counts[:, 1])
+    return [(int(label), coordinates[end - n:end]) for (label, n), end in zip(counts, ends)]
+
+def build_contours(seg_dir, tolerance=DEFAULT_TOLERANCE):
+    """
+    Trace the outlines of every label on every slice of every plane
+
+    Reads the directory's label volume and writes contours.bin: one record
+    of simplified polygons per slice for the stored slices and the three
+    MPR planes, followed by a slice offset index and a JSON header with
+    each plane's geometry and the label -> organ table.
+
+    Args:
+        seg_dir: Segmentation output directory with a label volume
+        tolerance: Douglas-Peucker tolerance in voxels
+
+    Returns:
+        dict with success status, polygon and byte counts
+    """
+    opened = label_volume.open_label_volume(seg_dir)
+    if opened is None:
+        return {'success': False, 'error': 'No label volume for this segmentation'}
+    labels, table = opened
+    affine = np.array(table['affine'])
+    spacing = table['spacing']
+
+    fd, tmp_path = tempfile.mkstemp(dir=seg_dir, prefix='.tmp_', suffix='.bin')
+    try:
+        planes = {}
+        offsets = []
+        polygon_count = 0
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            for plane in PLANES:
+                slices = label_volume.plane_labels(labels, affine, None if plane == STORED else plane)
+                if plane == STORED:
+                    plane_spacing = (spacing[2], spacing[0], spacing[1])
+                else:
+                    plane_spacing = mpr.plane_spacing(spacing, affine, plane)
+                planes[plane] = {
+                    'index': len(offsets),
+                    'slices': int(slices.shape[0]),
+                    'height': int(slices.shape[1]),
+                    'width': int(slices.shape[2]),
+                    'spacing': [float(x) for x in plane_spacing]
+                }
+                offsets.append(f.tell())
+                for slice_index in range(slices.shape[0]):
+                    polygons = trace_slice(slices[slice_index], tolerance)
+                    polygon_count += len(polygons)
+                    f.write(encode_polygons(polygons))
+                    offsets.append(f.tell())
+
+            index_offset = f.tell()
+            f.write(np.array(offsets, dtype='<u8').tobytes())
+            header_offset = f.tell()
+            f.write(json.dumps({
+                'format_version': CONTOUR_FORMAT_VERSION,
+                'tolerance': tolerance,
+                'labels': table['labels'],
+                'planes': planes
+            }).encode('utf-8'))
+            f.write(FOOTER.pack(index_offset, header_offset, MAGIC))
+        path = os.path.join(seg_dir, CONTOURS_FILENAME)
+        os.replace(tmp_path, path)
+        logger.info(f"Traced {polygon_count} contours in {seg_dir} ({os.path.getsize(path)} bytes)")
+        return {'success': True, 'polygons': polygon_count, 'bytes': os.path.getsize(path)}
+
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        logger.error(f"Error tracing contours in {seg_dir}: {str(e)}")
+        return {'success': False, 'error': f'Contour extraction failed: {str(e)}'}
+
+def read_header(seg_dir):
+    """Header of a segmentation's contour file, or None if it has no current one"""
+    try:
+        with open(os.path.join(seg_dir, CONTOURS_FILENAME), 'rb') as f:
+            f.seek(-FOOTER.size, os.SEEK_END)
+            index_offset, header_offset, magic = FOOTER.unpack(f.read(FOOTER.size))
+            if magic != MAGIC:
+                return None
+            end = f.tell() - FOOTER.size
+            f.seek(header_offset)
+            header = json.loads(f.read(end - header_offset))
+        if header.get('format_version') != CONTOUR_FORMAT_VERSION:
+            return None
+        return dict(header, index_offset=index_offset)
+    except (OSError, ValueError):
+        return None
+
+def read_contours(seg_dir, slice_index, plane=None):
+    """
+    Contours of one slice
+
+    Args:
+        seg_dir: Segmentation output directory
+        slice_index: Slice along the plane's axis
+        plane: None for the stored slices, else 'axial', 'coronal' or 'sagittal'
+
+    Returns:
+        dict with success status, the slice geometry (width and height in
+        voxels, spacing in mm) and contours: one entry per label with its organ
+        and polygons as flat [x0, y0, x1, y1, ...] lists of voxel centres
+    """
+    header = read_header(seg_dir)
+    if header is None:
+        return {'success': False, 'error': 'No contours for this segmentation'}
+    plane = plane or STORED
+    if plane not in header['planes']:
+        return {'success': False, 'error': f'Unknown plane {plane}'}
+    geometry = header['planes'][plane]
+    if not 0 <= slice_index < geometry['slices']:
+        return {'success': False, 'error': f"Slice {slice_index} out of range (0-{geometry['slices'] - 1})"}
+
+    with open(os.path.join(seg_dir, CONTOURS_FILENAME), 'rb') as f:
+        f.seek(header['index_offset'] + 8 * (geometry['index'] + slice_index))
+        start, stop = np.frombuffer(f.read(16), dtype='<u8')
+        f.seek(int(start))
+        traced = decode_polygons(f.read(int(stop - start)))
+
+    contours = {}
+    for label, points in traced:
+        contours.setdefault(label, []).append(points.ravel().tolist())
+    return {
+        'success': True,
+        'plane': plane,
+        'slice_index': slice_index,
+        'slice_count': geometry['slices'],
+        'width': geometry['width'],
+        'height': geometry['height'],
+        'spacing': geometry['spacing'],
+        'contours': [{'label': label, 'organ': header['labels'].get(str(label)), 'polygons': polygons}
+                     for label, polygons in sorted(contours.items())]
+    }
+
+def label_color(label):
+    """Outline colour of a label, the same as its raster overlay colour"""
+    return 'rgb({}, {}, {})'.format(*overlay.label_rgb(label))
+
+def to_svg(contours):
+    """
+    SVG document of a read_contours result
+
+    The viewBox spans the slice in voxels and is stretched over the image
+    (preserveAspectRatio="none"), so it overlays both native and
+    aspect-corrected renderings; strokes keep their width at any zoom.
+    """
+    paths = []
+    for entry in contours['contours']:
+        d = ' '.join('M' + ' '.join(f'{polygon[i]} {polygon[i + 1]}' for i in range(0, len(polygon), 2)) + 'Z'
+                     for polygon in entry['polygons'])
+        paths.append(f'<path data-label="{entry["label"]}" data-organ={quoteattr(entry["organ"] or "")} '
+                     f'stroke="{label_color(entry["label"])}" vector-effect="non-scaling-stroke" d="{d}"/>')
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {contours["width"]} {contours["height"]}" '
+            f'preserveAspectRatio="none">'
+            f'<g transform="translate(0.5 0.5)" fill="none" fill-rule="evenodd" stroke-width="1.5">'
+            f'{"".join(paths)}</g></svg>')
+
+def main(argv=None):
+    """Trace contours for a segmentation and compare payloads with raw label slices"""
+    parser = argparse.ArgumentParser(description='Extract segmentation contours')
+    parser.add_argument('seg_dir', help='Segmentation output directory (with a label volume)')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Douglas-Peucker tolerance in voxels')
+    args = parser.parse_args(argv)
+
+    if label_volume.open_label_volume(args.seg_dir) is None:
+        built = label_volume.build_label_volume(args.seg_dir)
+        if not built['success']:
+            print(built['error'])
+            return 1
+    start = time.perf_counter()
+    result = build_contours(args.seg_dir, args.tolerance)
+    if not result['success']:
+        print(result['error'])
+        return 1
+    print(f"{result['polygons']} polygons, {result['bytes']} bytes in {time.perf_counter() - start:.2f}s")
+
+    labels, _ = label_volume.open_label_volume(args.seg_dir)
+    busiest = int(np.argmax((labels.reshape(labels.shape[0], -1) != 0).sum(axis=1)))
+    contours = read_contours(args.seg_dir, busiest)
+    print(f"slice {busiest}: raw labels {labels[busiest].nbytes} bytes, "
+          f"JSON {len(json.dumps(contours))} bytes, SVG {len(to_svg(contours))} bytes")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
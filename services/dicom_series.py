@@ -0,0 +1,479 @@
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import logging
+import argparse
+import tempfile
+import subprocess
+from collections import Counter, defaultdict
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.errors import InvalidDicomError
+from services.slice_store import first_float
+from services import pixel_decoders
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NIFTI_DATA_OFFSET = 352  # Single-file NIFTI-1: 348-byte header plus empty extension flag
+MAX_EXTRACTED_BYTES = 8 * 1024 ** 3  # Refuse archives that expand beyond this
+MIN_FRAMES_PER_WORKER = 32  # A worker costs an interpreter start; smaller shares decode in-process
+
+# Header tags needed to group, sort and stack instances (pixel data is never read here)
+HEADER_TAGS = [
+    'SeriesInstanceUID', 'StudyInstanceUID', 'SeriesDescription', 'SeriesNumber', 'Modality',
+    'InstanceNumber', 'ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing',
+    'SliceThickness', 'SpacingBetweenSlices', 'Rows', 'Columns', 'SamplesPerPixel',
+    'NumberOfFrames', 'BitsStored', 'PixelRepresentation', 'RescaleSlope', 'RescaleIntercept',
+    'WindowCenter', 'WindowWidth', 'PatientID'
+]
+
+# Output types tried in order for integer-valued series (first that holds the rescaled range)
+INTEGER_DTYPES = (np.uint8, np.int16, np.uint16, np.int32)
+
+def _floats(value, count):
+    """Multi-valued DICOM element as a list of floats, or None"""
+    try:
+        values = [float(x) for x in value]
+    except (TypeError, ValueError):
+        return None
+    return values if len(values) == count else None
+
+def read_instance_header(path):
+    """
+    Header fields of one DICOM file, without pixel data
+
+    Returns:
+        dict of the fields used for stacking, or None if not an image instance
+    """
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    except (InvalidDicomError, OSError, ValueError) as e:
+        logger.debug(f"Skipping {path}: {str(e)}")
+        return None
+    if 'Rows' not in ds or 'Columns' not in ds:
+        return None
+
+    bits_stored = int(ds.get('BitsStored', 16) or 16)
+    signed = int(ds.get('PixelRepresentation', 0) or 0) == 1
+    return {
+        'path': path,
+        'series_uid': str(ds.get('SeriesInstanceUID', '')) or 'UNKNOWN',
+        'study_uid': str(ds.get('StudyInstanceUID', '')),
+        'series_description': str(ds.get('SeriesDescription', '')),
+        'series_number': ds.get('SeriesNumber'),
+        'modality': str(ds.get('Modality', 'UNKNOWN')),
+        'patient_id': str(ds.get('PatientID', '')),
+        'transfer_syntax': str(pixel_decoders.transfer_syntax_of(ds)),
+        'instance_number': int(ds.get('InstanceNumber', 0) or 0),
+        'position': _floats(ds.get('ImagePositionPatient'), 3),
+        'orientation': _floats(ds.get('ImageOrientationPatient'), 6),
+        'pixel_spacing': _floats(ds.get('PixelSpacing'), 2) or [1.0, 1.0],
+        'slice_thickness': first_float(ds.get('SliceThickness')),
+        'spacing_between_slices': first_float(ds.get('SpacingBetweenSlices')),
+        'rows': int(ds.Rows),
+        'columns': int(ds.Columns),
+        'samples_per_pixel': int(ds.get('SamplesPerPixel', 1) or 1),
+        'frames': int(ds.get('NumberOfFrames', 1) or 1),
+        'stored_range': ((-2 ** (bits_stored - 1), 2 ** (bits_stored - 1) - 1) if signed
+                         else (0, 2 ** bits_stored - 1)),
+        'slope': first_float(ds.get('RescaleSlope')) or 1.0,
+        'intercept': first_float(ds.get('RescaleIntercept')) or 0.0,
+        'window_center': first_float(ds.get('WindowCenter')),
+        'window_width': first_float(ds.get('WindowWidth'))
+    }
+
+def rescale(pixels, slope, intercept, dtype):
+    """Apply RescaleSlope/RescaleIntercept to a whole frame and cast to dtype"""
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        values = pixels.astype(dtype)
+        if slope != 1.0:
+            values *= dtype.type(slope)
+        if intercept != 0.0:
+            values += dtype.type(intercept)
+        return values
+    values = pixels.astype(np.int64 if dtype == np.int32 else np.int32)
+    if slope != 1.0:
+        values *= int(slope)
+    if intercept != 0.0:
+        values += int(intercept)
+    return values.astype(dtype)
+
+def decode_into(tasks, output_path):
+    """
+    Decode DICOM frames and write them into their slots of a stacked volume
+
+    Pixel data is decoded by the plugin chosen for each frame's transfer
+    syntax (see pixel_decoders) and written with pwrite, so any number of
+    processes can fill one file concurrently.
+
+    Args:
+        tasks: list of dicts with path, offset, slope, intercept, dtype and
+            the decoding plugin
+        output_path: Stacked volume file, already sized
+
+    Returns:
+        dict with the number of decoded frames, seconds spent decoding and
+        per-file errors
+    """
+    decoded = 0
+    seconds = 0.0
+    errors = []
+    fd = os.open(output_path, os.O_WRONLY)
+    try:
+        for task in tasks:
+            try:
+                pixels, decode_info = pixel_decoders.decode(pydicom.dcmread(task['path']), task.get('plugin'))
+                seconds += decode_info['seconds']
+                values = rescale(pixels, task['slope'], task['intercept'], task['dtype'])
+                os.pwrite(fd, values.astype(values.dtype.newbyteorder('<'), copy=False).tobytes(), task['offset'])
+                decoded += 1
+            except Exception as e:
+                errors.append({'path': task['path'], 'error': str(e)})
+    finally:
+        os.close(fd)
+    return {'decoded': decoded, 'seconds': seconds, 'errors': errors}
+
+def extract_archive(zip_path, output_dir, max_bytes=MAX_EXTRACTED_BYTES):
+    """
+    Extract the files of a zip archive under generated names
+
+    Member paths are never used on disk, so archives cannot write outside
+    output_dir.
+
+    Returns:
+        list of extracted file paths
+    """
+    paths = []
+    with zipfile.ZipFile(zip_path) as archive:
+        members = [m for m in archive.infolist() if not m.is_dir()]
+        total = sum(m.file_size for m in members)
+        if total > max_bytes:
+            raise ValueError(f'Archive expands to {total} bytes (limit {max_bytes})')
+        for index, member in enumerate(members):
+            path = os.path.join(output_dir, f'{index:06d}.dcm')
+            with archive.open(member) as source, open(path, 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            paths.append(path)
+    return paths
+
+class DicomSeriesBuilder:
+    """
+    Stack multi-file DICOM series into one NIFTI volume per series
+
+    Headers are read in-process and grouped by SeriesInstanceUID; pixel
+    decoding is spread over worker processes that write straight into the
+    output file, so throughput scales with the number of cores. The result
+    is an uncompressed NIFTI with rescaled values (e.g. Hounsfield units)
+    and a RAS affine, which the rest of the pipeline already handles.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+
+    def build(self, paths, output_dir):
+        """
+        Group files into series and write one stacked volume per series
+
+        Args:
+            paths: DICOM files (non-DICOM files are skipped)
+            output_dir: Directory for the stacked .nii files
+
+        Returns:
+            dict with success status, a list of built series (path, series
+            metadata) and the number of skipped files
+        """
+        try:
+            headers = [read_instance_header(path) for path in paths]
+            instances = [h for h in headers if h is not None]
+            if not instances:
+                return {'success': False, 'error': 'No DICOM image instances found'}
+
+            groups = defaultdict(list)
+            for instance in instances:
+                groups[instance['series_uid']].append(instance)
+
+            series = []
+            for series_uid, members in groups.items():
+                result = self._build_series(members, output_dir)
+                if result['success']:
+                    series.append(result)
+                else:
+                    logger.warning(f"Series {series_uid} not stacked: {result['error']}")
+            if not series:
+                return {'success': False, 'error': 'No series could be stacked'}
+
+            return {
+                'success': True,
+                'series': series,
+                'skipped_files': len(paths) - len(instances)
+            }
+
+        except Exception as e:
+            logger.error(f"Error building DICOM series: {str(e)}")
+            return {'success': False, 'error': f'Series build failed: {str(e)}'}
+
+    def _build_series(self, instances, output_dir):
+        """Sort, validate and stack the instances of one series"""
+        series_uid = instances[0]['series_uid']
+        instances = self._select_geometry(instances)
+        if any(i['frames'] > 1 or i['samples_per_pixel'] > 1 for i in instances):
+            return {'success': False, 'error': 'Multi-frame and color instances are uploaded as single files'}
+
+        instances, slice_spacing = self._sort_instances(instances)
+        first = instances[0]
+        rows, columns = first['rows'], first['columns']
+        dtype = self._output_dtype(instances)
+        affine = self._affine(instances, slice_spacing)
+
+        fd, output_path = tempfile.mkstemp(dir=output_dir, prefix='series_', suffix='.nii')
+        os.close(fd)
+        self._write_header(output_path, (columns, rows, len(instances)), dtype, affine,
+                           first['pixel_spacing'], slice_spacing, first['modality'])
+
+        # Plugins are chosen here so worker processes need not load the decoder table
+        slice_bytes = rows * columns * dtype.itemsize
+        tasks = [{
+            'path': instance['path'],
+            'offset': NIFTI_DATA_OFFSET + index * slice_bytes,
+            'slope': instance['slope'],
+            'intercept': instance['intercept'],
+            'dtype': dtype.str,
+            'plugin': pixel_decoders.selector.plugin_for(instance['transfer_syntax'])
+        } for index, instance in enumerate(instances)]
+
+        start = time.perf_counter()
+        decoded = self.decode(tasks, output_path)
+        elapsed = time.perf_counter() - start
+        if decoded['errors']:
+            os.remove(output_path)
+            failure = decoded['errors'][0]
+            return {'success': False,
+                    'error': f"{len(decoded['errors'])} frames failed to decode "
+                             f"(first: {os.path.basename(failure['path'])}: {failure['error']})"}
+
+        transfer_syntax, _ = Counter(instance['transfer_syntax'] for instance in instances).most_common(1)[0]
+        pixel_decode = {
+            'transfer_syntax': pydicom.uid.UID(transfer_syntax).name,
+            'plugin': pixel_decoders.selector.plugin_for(transfer_syntax) or 'default',
+            'frames': decoded['decoded'],
+            'seconds': decoded['seconds']
+        }
+        logger.info(f"Stacked series {series_uid}: {len(instances)} x {rows}x{columns} {dtype} "
+                    f"in {elapsed:.2f}s ({pixel_decode['transfer_syntax']} via {pixel_decode['plugin']})")
+        return {
+            'success': True,
+            'path': output_path,
+            'series_uid': series_uid,
+            'study_uid': first['study_uid'],
+            'series_description': first['series_description'],
+            'modality': first['modality'],
+            'patient_id': first['patient_id'],
+            'instances': len(instances),
+            'shape': [columns, rows, len(instances)],
+            'dtype': dtype.name,
+            'slice_spacing': slice_spacing,
+            'window_center': first['window_center'],
+            'window_width': first['window_width'],
+            'decode_seconds': elapsed,
+            'pixel_decode': pixel_decode
+        }
+
+    def _select_geometry(self, instances):
+        """Keep the instances sharing the series' most common matrix and orientation"""
+        def geometry(instance):
+            orientation = tuple(round(x, 4) for x in instance['orientation'] or ())
+            return instance['rows'], instance['columns'], orientation
+
+        common, _ = Counter(geometry(i) for i in instances).most_common(1)[0]
+        selected = [i for i in instances if geometry(i) == common]
+        if len(selected) < len(instances):
+            # e.g. localizer images stored in the same series
+            logger.info(f"Series {instances[0]['series_uid']}: dropped {len(instances) - len(selected)} "
+                        f"instances with a different matrix or orientation")
+        return selected
+
+    def _sort_instances(self, instances):
+        """
+        Order instances along the slice normal
+
+        Falls back to InstanceNumber when positions are missing.
+
+        Returns:
+            tuple of (sorted instances, slice spacing in mm)
+        """
+        first = instances[0]
+        if first['orientation'] and all(i['position'] for i in instances):
+            orientation = np.array(first['orientation'])
+            normal = np.cross(orientation[:3], orientation[3:])
+            distances = np.array([np.dot(normal, i['position']) for i in instances])
+            order = np.argsort(distances, kind='stable')
+            instances = [instances[i] for i in order]
+            steps = np.diff(distances[order])
+            steps = steps[steps > 1e-4]
+            if steps.size:
+                return instances, float(np.median(steps))
+        else:
+            instances = sorted(instances, key=lambda i: i['instance_number'])
+
+        spacing = first['spacing_between_slices'] or first['slice_thickness'] or 1.0
+        return instances, float(spacing)
+
+    def _output_dtype(self, instances):
+        """Smallest integer type holding every rescaled value, or float32"""
+        integral = all(float(i['slope']).is_integer() and float(i['intercept']).is_integer()
+                       for i in instances)
+        if not integral:
+            return np.dtype(np.float32)
+
+        bounds = []
+        for instance in instances:
+            low, high = instance['stored_range']
+            bounds += [low * instance['slope'] + instance['intercept'],
+                       high * instance['slope'] + instance['intercept']]
+        low, high = min(bounds), max(bounds)
+        for dtype in INTEGER_DTYPES:
+            info = np.iinfo(dtype)
+            if info.min <= low and high <= info.max:
+                return np.dtype(dtype)
+        return np.dtype(np.float32)
+
+    def _affine(self, instances, slice_spacing):
+        """Voxel (column, row, slice) to RAS transform from DICOM patient geometry"""
+        first = instances[0]
+        row_spacing, column_spacing = first['pixel_spacing']
+        affine = np.eye(4)
+        if first['orientation'] and first['position']:
+            orientation = np.array(first['orientation'])
+            affine[:3, 0] = orientation[:3] * column_spacing
+            affine[:3, 1] = orientation[3:] * row_spacing
+            affine[:3, 2] = np.cross(orientation[:3], orientation[3:]) * slice_spacing
+            if len(instances) > 1 and instances[-1]['position']:
+                # The first-to-last step follows gantry tilt, unlike the plane normal
+                step = (np.array(instances[-1]['position']) - np.array(first['position'])) / (len(instances) - 1)
+                if np.linalg.norm(step) > 1e-6:
+                    affine[:3, 2] = step
+            affine[:3, 3] = first['position']
+        else:
+            affine[:3, :3] = np.diag([column_spacing, row_spacing, slice_spacing])
+        # DICOM patient coordinates are LPS; NIFTI expects RAS
+        return np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+
+    def _write_header(self, output_path, shape, dtype, affine, pixel_spacing, slice_spacing, modality):
+        """Write a NIFTI-1 header and size the file for the voxel data"""
+        header = nib.Nifti1Header()
+        header.set_data_shape(shape)
+        header.set_data_dtype(dtype)
+        header.set_zooms((pixel_spacing[1], pixel_spacing[0], slice_spacing))
+        header.set_qform(affine, code='scanner')
+        header.set_sform(affine, code='scanner')
+        header.set_xyzt_units('mm', 'sec')
+        header.set_data_offset(NIFTI_DATA_OFFSET)
+        header['descrip'] = f'DICOM series {modality}'[:79].encode('ascii', errors='ignore')
+        with open(output_path, 'wb') as f:
+            header.write_to(f)
+            f.write(b'\x00' * (NIFTI_DATA_OFFSET - f.tell()))
+            f.truncate(NIFTI_DATA_OFFSET + int(np.prod(shape)) * dtype.itemsize)
+
+    def decode(self, tasks, output_path, workers=None):
+        """
+        Decode frames into the output file across worker processes
+
+        Each worker is a fresh interpreter running this module, given an
+        interleaved share of the frames through a task file.
+
+        Returns:
+            dict with the number of decoded frames and per-file errors
+        """
+        workers = max(1, min(workers or self.workers, len(tasks) // MIN_FRAMES_PER_WORKER))
+        if workers == 1:
+            return decode_into(tasks, output_path)
+
+        task_dir = tempfile.mkdtemp(prefix='decode_', dir=os.path.dirname(output_path) or '.')
+        try:
+            processes = []
+            for index in range(workers):
+                task_path = os.path.join(task_dir, f'{index}.json')
+                with open(task_path, 'w') as f:
+                    json.dump({'tasks': [dict(task, path=os.path.abspath(task['path']))
+                                         for task in tasks[index::workers]],
+                               'output_path': os.path.abspath(output_path)}, f)
+                # Results come back on stdout; stderr goes to a file so a chatty
+                # worker cannot block on a full pipe
+                with open(os.path.join(task_dir, f'{index}.log'), 'wb') as log:
+                    processes.append(subprocess.Popen(
+                        [sys.executable, '-m', 'services.dicom_series', '--decode', task_path],
+                        stdout=subprocess.PIPE,
+                        stderr=log,
+                        cwd=PROJECT_ROOT
+                    ))
+
+            decoded = 0
+            seconds = 0.0
+            errors = []
+            for index, process in enumerate(processes):
+                stdout, _ = process.communicate()
+                if process.returncode != 0:
+                    with open(os.path.join(task_dir, f'{index}.log'), 'rb') as log:
+                        reason = log.read()[-200:].decode(errors='ignore')
+                    errors += [{'path': task['path'],
+                                'error': f'Decode worker exited with {process.returncode}: {reason}'}
+                               for task in tasks[index::workers]]
+                    continue
+                result = json.loads(stdout)
+                decoded += result['decoded']
+                seconds += result['seconds']
+                errors += result['errors']
+            return {'decoded': decoded, 'seconds': seconds, 'errors': errors}
+        finally:
+            shutil.rmtree(task_dir, ignore_errors=True)
+
+def main(argv=None):
+    """Benchmark series stacking, or run as a decode worker"""
+    parser = argparse.ArgumentParser(description='Stack a DICOM series and report decode throughput')
+    parser.add_argument('input_path', nargs='?', help='Directory of DICOM files or a zip archive')
+    parser.add_argument('--decode', metavar='TASK_FILE', help=argparse.SUPPRESS)
+    parser.add_argument('--workers', default=None,
+                        help='Comma-separated worker counts to compare (default: 1 and all cores)')
+    args = parser.parse_args(argv)
+
+    if args.decode:
+        with open(args.decode) as f:
+            job = json.load(f)
+        print(json.dumps(decode_into(job['tasks'], job['output_path'])))
+        return 0
+
+    if not args.input_path:
+        parser.error('input_path is required')
+    worker_counts = ([int(x) for x in args.workers.split(',')] if args.workers
+                     else sorted({1, os.cpu_count() or 1}))
+
+    work_dir = tempfile.mkdtemp(prefix='series_bench_')
+    try:
+        if zipfile.is_zipfile(args.input_path):
+            paths = extract_archive(args.input_path, work_dir)
+        else:
+            paths = [os.path.join(args.input_path, name) for name in sorted(os.listdir(args.input_path))]
+
+        print(f"{'workers':>8}{'frames':>8}{'seconds':>10}{'frames/s':>10}")
+        for workers in worker_counts:
+            output_dir = tempfile.mkdtemp(dir=work_dir)
+            result = DicomSeriesBuilder(workers=workers).build(paths, output_dir)
+            if not result['success']:
+                print(result['error'])
+                return 1
+            for series in result['series']:
+                rate = series['instances'] / max(series['decode_seconds'], 1e-9)
+                print(f"{workers:>8}{series['instances']:>8}{series['decode_seconds']:>10.2f}{rate:>10.0f}")
+        return 0
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
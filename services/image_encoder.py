@@ -0,0 +1,152 @@
+import io
+import sys
+import time
+import logging
+import argparse
+import numpy as np
+import cv2
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Output formats served to the viewer, in order of preference on ties
+IMAGE_MIMETYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg'
+}
+
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+DEFAULT_JPEG_QUALITY = 90
+PNG_COMPRESSION = 3  # zlib level; higher is smaller but slower
+
+def normalize_format(fmt):
+    """Canonical format name, or None if unsupported"""
+    if not fmt:
+        return None
+    fmt = FORMAT_ALIASES.get(fmt.lower(), fmt.lower())
+    return fmt if fmt in IMAGE_MIMETYPES else None
+
+def _to_bgr(image):
+    """OpenCV expects BGR channel order for color images"""
+    if image.ndim == 3 and image.shape[2] == 3:
+        return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    return image
+
+def encode_image(image, fmt='png', quality=None):
+    """
+    Encode an 8-bit grayscale or RGB image in memory
+
+    Args:
+        image: uint8 numpy array (H, W) or (H, W, 3) in RGB order
+        fmt: 'png', 'webp' (lossless) or 'jpeg'
+        quality: JPEG quality 1-100 (ignored for lossless formats)
+
+    Returns:
+        Encoded bytes
+    """
+    fmt = normalize_format(fmt)
+    if fmt is None:
+        raise ValueError('Unsupported image format')
+
+    image = np.ascontiguousarray(image)
+    if fmt == 'png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+    elif fmt == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, 101]  # >100 selects lossless WebP
+    else:
+        quality = DEFAULT_JPEG_QUALITY if quality is None else max(1, min(int(quality), 100))
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    ok, encoded = cv2.imencode(f'.{fmt}', _to_bgr(image), params)
+    if ok:
+        return encoded.tobytes()
+
+    logger.warning(f"cv2 could not encode {fmt}, falling back to PIL")
+    return encode_image_pil(image, fmt, quality)
+
+def encode_image_pil(image, fmt='png', quality=None):
+    """Encode with PIL into an in-memory buffer"""
+    fmt = normalize_format(fmt)
+    if fmt is None:
+        raise ValueError('Unsupported image format')
+
+    buffer = io.BytesIO()
+    pil_image = Image.fromarray(image)
+    if fmt == 'png':
+        pil_image.save(buffer, format='PNG', compress_level=PNG_COMPRESSION)
+    elif fmt == 'webp':
+        pil_image.save(buffer, format='WEBP', lossless=True)
+    else:
+        quality = DEFAULT_JPEG_QUALITY if quality is None else max(1, min(int(quality), 100))
+        pil_image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def benchmark_encoders(image, formats=None, repeat=20, quality=None):
+    """
+    Time each encoder/format combination on one image
+
+    Args:
+        image: uint8 image to encode
+        formats: Formats to test (default: all served formats)
+        repeat: Encodes per combination
+        quality: JPEG quality
+
+    Returns:
+        list of dicts sorted by mean encode time
+    """
+    formats = formats or list(IMAGE_MIMETYPES)
+    encoders = {'cv2': encode_image, 'pil': encode_image_pil}
+    results = []
+
+    for fmt in formats:
+        for encoder_name, encoder in encoders.items():
+            try:
+                timings = []
+                data = b''
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    data = encoder(image, fmt, quality)
+                    timings.append((time.perf_counter() - start) * 1000)
+                results.append({
+                    'format': fmt,
+                    'encoder': encoder_name,
+                    'mean_ms': float(np.mean(timings)),
+                    'min_ms': float(np.min(timings)),
+                    'bytes': len(data),
+                    'lossless': fmt != 'jpeg'
+                })
+            except Exception as e:
+                logger.warning(f"Benchmark of {encoder_name}/{fmt} failed: {str(e)}")
+
+    return sorted(results, key=lambda r: r['mean_ms'])
+
+def main(argv=None):
+    """Benchmark slice encoding for a medical image file"""
+    parser = argparse.ArgumentParser(description='Benchmark slice encoders on a DICOM/NIFTI file')
+    parser.add_argument('file_path', help='DICOM (.dcm) or NIFTI (.nii, .nii.gz) file')
+    parser.add_argument('--slice', type=int, default=None, help='Slice index (default: middle)')
+    parser.add_argument('--repeat', type=int, default=20, help='Encodes per format')
+    parser.add_argument('--quality', type=int, default=DEFAULT_JPEG_QUALITY, help='JPEG quality')
+    args = parser.parse_args(argv)
+
+    from services.image_processor import ImageProcessor
+    processor = ImageProcessor()
+    if args.file_path.lower().endswith('.dcm'):
+        image = processor._dicom_to_web(args.file_path)
+    else:
+        image = processor._nifti_to_web(args.file_path, args.slice)
+    if image is None:
+        print(f"Could not render {args.file_path}", file=sys.stderr)
+        return 1
+
+    print(f"Image {image.shape[1]}x{image.shape[0]}, {args.repeat} encodes per format")
+    print(f"{'format':<8}{'encoder':<9}{'mean ms':>10}{'min ms':>10}{'bytes':>10}")
+    for result in benchmark_encoders(image, repeat=args.repeat, quality=args.quality):
+        print(f"{result['format']:<8}{result['encoder']:<9}{result['mean_ms']:>10.2f}"
+              f"{result['min_ms']:>10.2f}{result['bytes']:>10}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,25 +1,61 @@
 import os
 import logging
+import tempfile
+import threading
 import numpy as np
 import pydicom
 import nibabel as nib
 from PIL import Image
 import cv2
 import json
+import math
+from collections import OrderedDict
 from datetime import datetime
+from services.volume_cache import VolumeCache
+from services import volume_reader, image_stats, windowing, mpr, pixel_decoders
+from services.windowing import VolumeHistogram
+from services.slice_store import first_float
+from services.tile_cache import TileCache
+from services.image_encoder import encode_image, normalize_format, DEFAULT_JPEG_QUALITY
+from utils.file_utils import compute_file_sha256, content_hash_from_path
 
 logger = logging.getLogger(__name__)
 
+# Pixel types the raw slice endpoint sends as is (others become float32)
+RAW_SLICE_DTYPES = ('uint8', 'int8', 'int16', 'uint16', 'float32')
+
+MAX_CACHED_WINDOWS = 64  # Window lookup tables kept in memory (64KB each)
+
+MAX_SPRITE_SLICES = 256  # Slices packed into one sprite sheet
+DEFAULT_SPRITE_SIZE = 256  # Longest tile edge in pixels
+
+MIN_PYRAMID_SIZE = 64  # Pyramid levels stop once the longest edge fits this
+
+STORED_PLANE = 'stored'  # Tile key plane of slices along the stored axis
+TILE_VERSION = 'v2'  # Part of rendered tile keys; bump when rendering or keying changes
+
 class ImageProcessor:
     """Service for processing medical images (DICOM/NIFTI)"""
     
-    def __init__(self):
+    def __init__(self, volume_cache=None, slice_store=None, tile_cache=None):
         self.supported_formats = ['.dcm', '.nii', '.nii.gz']
+        self.volume_cache = volume_cache if volume_cache is not None else VolumeCache()
+        self.slice_store = slice_store
+        if tile_cache is None:
+            tile_cache = TileCache(os.path.join(tempfile.gettempdir(), 'medical_tiles'))
+        self.tile_cache = tile_cache
+        self._content_hashes = {}
+        self._hash_lock = threading.Lock()
+        self._windows = OrderedDict()
+        self._window_lock = threading.Lock()
     
-    def process_image(self, file_path):
+    def process_image(self, file_path, include_stats=True):
         """
         Process medical image and extract metadata
         Returns dict with success status and processed data
+        
+        With include_stats=False NIFTI files are described from the header
+        alone and no voxel data is read.
         """
         try:
             file_extension = self._get_file_extension(file_path)
@@ -27,7 +63,7 @@ class ImageProcessor:
             if file_extension == '.dcm':
                 return self._process_dicom(file_path)
             elif file_extension in ['.nii', '.nii.gz']:
-                return self._process_nifti(file_path)
+                return self._process_nifti(file_path, include_stats=include_stats)
             else:
                 return {
                     'success': False,
@@ -44,10 +80,7 @@ class ImageProcessor:
     def _process_dicom(self, file_path):
         """Process DICOM file"""
         try:
-            ds = pydicom.dcmread(file_path)
-            
-            # Extract image data
-            image_data = ds.pixel_array
+            ds = pydicom.dcmread(file_path, stop_before_pixels=True)
             
             # Extract metadata
             metadata = {
@@ -70,18 +103,32 @@ class ImageProcessor:
                 'bits_stored': int(ds.get('BitsStored', 0)),
                 'window_center': float(ds.get('WindowCenter', 0)) if ds.get('WindowCenter') else None,
                 'window_width': float(ds.get('WindowWidth', 0)) if ds.get('WindowWidth') else None,
+                'transfer_syntax': pixel_decoders.transfer_syntax_of(ds).name
             }
             
-            # Calculate basic statistics
-            stats = self._calculate_image_stats(image_data)
+            # Decoder, decode time and statistics recorded when the slice store was written
+            stored = self.slice_store.open(file_path) if self.slice_store is not None else None
+            if stored is not None and stored[1].get('pixel_decode'):
+                metadata['pixel_decode'] = stored[1]['pixel_decode']
+            
+            if stored is not None and stored[1].get('intensity_stats') is not None:
+                stats = stored[1]['intensity_stats']
+                dimensions = tuple(stored[1]['source_shape'])
+                dtype = str(np.dtype(stored[1]['dtype']).newbyteorder('='))
+            else:
+                # Calculate basic statistics
+                image_data = self._load_volume(file_path, '.dcm')
+                stats = self._calculate_image_stats(image_data)
+                dimensions = image_data.shape
+                dtype = str(image_data.dtype)
             
             return {
                 'success': True,
                 'format': 'DICOM',
                 'metadata': metadata,
                 'image_stats': stats,
-                'dimensions': image_data.shape,
-                'dtype': str(image_data.dtype)
+                'dimensions': dimensions,
+                'dtype': dtype
             }
             
         except Exception as e:
@@ -91,16 +138,16 @@ class ImageProcessor:
                 'error': f'DICOM processing failed: {str(e)}'
             }
     
-    def _process_nifti(self, file_path):
+    def _process_nifti(self, file_path, include_stats=True):
         """Process NIFTI file"""
         try:
-            img = nib.load(file_path)
-            image_data = img.get_fdata()
+            img = volume_reader.open_nifti(file_path)
             header = img.header
+            shape = volume_reader.get_shape(img)
             
             # Extract metadata
             metadata = {
-                'dimensions': list(image_data.shape),
+                'dimensions': list(shape),
                 'voxel_size': [float(x) for x in header.get_zooms()],
                 'data_type': str(header.get_data_dtype()),
                 'units': {
@@ -113,17 +160,19 @@ class ImageProcessor:
                 'description': header['descrip'].tobytes().decode('utf-8', errors='ignore').strip('\x00'),
             }
             
-            # Calculate basic statistics
-            stats = self._calculate_image_stats(image_data)
+            # Calculate basic statistics, streaming the voxel data in native dtype
+            stats = {}
+            if include_stats:
+                stats = self._calculate_volume_stats(file_path, img)
             
             return {
                 'success': True,
                 'format': 'NIFTI',
                 'metadata': metadata,
                 'image_stats': stats,
-                'dimensions': image_data.shape,
-                'dtype': str(image_data.dtype),
-                'slices': image_data.shape[2] if len(image_data.shape) >= 3 else 1
+                'dimensions': shape,
+                'dtype': str(header.get_data_dtype()),
+                'slices': volume_reader.get_slice_count(img)
             }
             
         except Exception as e:
@@ -134,130 +183,786 @@ class ImageProcessor:
             }
     
     def _calculate_image_stats(self, image_data):
-        """Calculate basic statistics for image data"""
+        """Calculate basic statistics for image data in one pass over slabs"""
         try:
-            # Handle NaN values
-            clean_data = image_data[~np.isnan(image_data)] if np.any(np.isnan(image_data)) else image_data
-            
-            stats = {
-                'min': float(np.min(clean_data)),
-                'max': float(np.max(clean_data)),
-                'mean': float(np.mean(clean_data)),
-                'std': float(np.std(clean_data)),
-                'median': float(np.median(clean_data)),
-                'percentile_5': float(np.percentile(clean_data, 5)),
-                'percentile_95': float(np.percentile(clean_data, 95)),
-                'non_zero_count': int(np.count_nonzero(clean_data)),
-                'total_voxels': int(clean_data.size)
-            }
-            
-            return stats
+            return image_stats.compute_stats(image_stats.iter_array_slabs(image_data))
             
         except Exception as e:
             logger.error(f"Error calculating image stats: {str(e)}")
             return {}
     
+    def _calculate_volume_stats(self, file_path, img):
+        """
+        Calculate NIFTI statistics without materializing the volume
+        
+        Uses the statistics recorded while the slice store was written, else
+        reads an already cached volume or the memory-mapped slice store when
+        either holds the whole volume, otherwise streams slabs from the file.
+        """
+        try:
+            stored = self.slice_store.open(file_path) if self.slice_store is not None else None
+            if stored is not None and stored[1].get('intensity_stats') is not None:
+                return stored[1]['intensity_stats']
+            
+            cached = self.volume_cache.peek(file_path, variant='nifti')
+            if cached is not None:
+                return self._calculate_image_stats(cached)
+            
+            shape = volume_reader.get_shape(img)
+            if stored is not None and stored[0].size == int(np.prod(shape)):
+                return self._calculate_image_stats(stored[0])
+            
+            frames = shape[3] if len(shape) >= 4 else 1
+            return image_stats.compute_stats(
+                slab
+                for frame in range(frames)
+                for _, slab in volume_reader.iter_slabs(img, frame=frame)
+            )
+            
+        except Exception as e:
+            logger.error(f"Error calculating volume stats for {file_path}: {str(e)}")
+            return {}
+    
+    def describe_study(self, file_path):
+        """
+        Parse a study file once into the fields persisted as study metadata
+        
+        Returns:
+            dict with success status, format, modality, dimensions,
+            slice_count, voxel_spacing ([row, column, slice] in mm), dtype,
+            affine, intensity_stats and the format-specific header fields
+        """
+        processed = self.process_image(file_path)
+        if not processed['success']:
+            return processed
+        
+        metadata = processed['metadata']
+        dimensions = [int(x) for x in processed['dimensions']]
+        
+        if processed['format'] == 'DICOM':
+            pixel_spacing = metadata.get('pixel_spacing') or [1.0, 1.0]
+            voxel_spacing = [float(pixel_spacing[0]), float(pixel_spacing[1]),
+                             float(metadata.get('slice_thickness') or 1.0)]
+            affine = self._dicom_affine(metadata, voxel_spacing)
+            modality = metadata.get('modality')
+        else:
+            zooms = metadata['voxel_size']
+            voxel_spacing = [float(x) for x in (list(zooms[:3]) + [1.0] * 3)[:3]]
+            affine = metadata['affine']
+            modality = None  # NIFTI headers carry no modality
+        
+        return {
+            'success': True,
+            'format': processed['format'],
+            'modality': modality,
+            'dimensions': dimensions,
+            'slice_count': int(processed.get('slices', 1)),
+            'voxel_spacing': voxel_spacing,
+            'dtype': processed['dtype'],
+            'affine': affine,
+            'intensity_stats': processed['image_stats'],
+            'header': metadata
+        }
+    
+    def _dicom_affine(self, metadata, voxel_spacing):
+        """Voxel-to-patient (LPS) transform from DICOM orientation and position, or None"""
+        orientation = metadata.get('image_orientation')
+        position = metadata.get('image_position')
+        if not orientation or len(orientation) != 6 or not position or len(position) != 3:
+            return None
+        
+        row_cosine = np.array(orientation[:3])
+        col_cosine = np.array(orientation[3:])
+        affine = np.eye(4)
+        # Array axis 0 steps down rows (along the column cosine), axis 1 along a row
+        affine[:3, 0] = col_cosine * voxel_spacing[0]
+        affine[:3, 1] = row_cosine * voxel_spacing[1]
+        affine[:3, 2] = np.cross(row_cosine, col_cosine) * voxel_spacing[2]
+        affine[:3, 3] = position
+        return affine.tolist()
+    
     def prepare_for_web(self, file_path, slice_index=0):
         """
         Prepare medical image for web viewing
-        Returns path to web-compatible image
+        Returns path to web-compatible PNG in the rendered-tile cache
+        """
+        if self.render_for_web(file_path, slice_index) is None:
+            return None
+        slice_index = self._resolve_slice_index(file_path, slice_index)
+        return self.tile_cache.get_path(self._tile_key(file_path, slice_index, 'png', None), 'png')
+    
+    def render_for_web(self, file_path, slice_index=0, fmt='png', quality=None, window='auto', level=0,
+                       plane=None, overlay=None):
+        """
+        Render a slice and encode it in memory
+        
+        A slice that has already been rendered is served from the tile cache
+        without decoding any image data. Each pyramid level is rendered the
+        first time it is requested and cached like any other tile, as is
+        each composite with a segmentation overlay.
+        
+        Args:
+            file_path: Path to DICOM/NIFTI file
+            slice_index: Slice to render (NIFTI only)
+            fmt: 'png', 'webp' (lossless) or 'jpeg'
+            quality: JPEG quality 1-100
+            window: 'auto', 'dicom' or a CT preset name (see get_available_windows)
+            level: Pyramid level; level n is downsampled 2^n times (0 = full resolution)
+            plane: 'axial', 'coronal' or 'sagittal' for a canonically oriented
+                MPR slice (3D NIFTI only); None slices the stored axis 2 as is
+            overlay: Optional LabelOverlay blended in before downsampling
+        
+        Returns:
+            Encoded image bytes, or None on failure
         """
         try:
             file_extension = self._get_file_extension(file_path)
-            output_dir = os.path.dirname(file_path)
-            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            fmt = normalize_format(fmt)
+            if file_extension not in self.supported_formats or fmt is None:
+                return None
             
-            if file_extension == '.dcm':
-                return self._dicom_to_web(file_path, output_dir, base_name)
-            elif file_extension in ['.nii', '.nii.gz']:
-                return self._nifti_to_web(file_path, output_dir, base_name, slice_index)
+            # Out-of-range and missing indices share the rendered slice's tile
+            slice_index = self._resolve_slice_index(file_path, slice_index, plane)
+            
+            level = max(0, int(level))
+            params = {'level': level} if level else {}
+            if overlay is not None:
+                params.update(overlay.cache_params())
+            key = self._tile_key(file_path, slice_index, fmt, quality, window, plane, **params)
+            data = self.tile_cache.get(key, fmt)
+            if data is not None:
+                return data
+            
+            if plane is not None:
+                normalized = self._plane_to_web(file_path, plane, slice_index, window)
+            elif file_extension == '.dcm':
+                normalized = self._dicom_to_web(file_path, window)
             else:
+                normalized = self._nifti_to_web(file_path, slice_index, window)
+            
+            if normalized is None:
                 return None
+            if overlay is not None:
+                normalized = overlay.apply(normalized, slice_index, plane)
+            
+            for _ in range(level):
+                normalized = self._downsample(normalized)
+            
+            data = encode_image(normalized, fmt, quality)
+            self.tile_cache.put(key, data, fmt)
+            return data
                 
         except Exception as e:
             logger.error(f"Error preparing image for web {file_path}: {str(e)}")
             return None
     
-    def _dicom_to_web(self, file_path, output_dir, base_name):
-        """Convert DICOM to web-viewable format"""
+    def _resolve_slice_index(self, file_path, slice_index, plane=None):
+        """Slice actually rendered for a requested index: clamped, or the middle slice for None"""
+        slice_count = self.get_slice_grid(file_path, plane)[0]
+        slice_index = slice_count // 2 if slice_index is None else int(slice_index)
+        return max(0, min(slice_index, slice_count - 1))
+    
+    def get_pyramid_info(self, file_path, plane=None):
+        """
+        Full-resolution slice size and number of pyramid levels, from headers only
+        
+        Returns:
+            dict with width, height and levels (level 0 is full resolution;
+            the coarsest level is the first whose longest edge fits
+            MIN_PYRAMID_SIZE)
+        """
+        height, width = self._get_slice_shape(file_path, plane)
+        levels = 1
+        longest = max(height, width)
+        while longest > MIN_PYRAMID_SIZE:
+            longest = (longest + 1) // 2
+            levels += 1
+        return {'width': width, 'height': height, 'levels': levels}
+    
+    def resolve_pyramid_level(self, file_path, level=None, max_size=None, plane=None):
+        """
+        Pyramid level for a request, clamped to the available levels
+        
+        Args:
+            file_path: Path to DICOM/NIFTI file
+            level: Explicit level
+            max_size: Longest edge the client can use; picks the finest level that fits
+            plane: MPR plane, or None for stored slices
+        
+        Returns:
+            tuple of (level, pyramid info dict)
+        """
+        info = self.get_pyramid_info(file_path, plane)
+        if max_size is not None:
+            level = 0
+            longest = max(info['width'], info['height'])
+            while longest > max_size and level < info['levels'] - 1:
+                longest = (longest + 1) // 2
+                level += 1
+        level = max(0, min(int(level or 0), info['levels'] - 1))
+        return level, info
+    
+    def get_slice_grid(self, file_path, plane=None):
+        """(slices, rows, columns) in voxels of the stored slices or an MPR plane, from headers only"""
+        if plane is not None:
+            return self._get_plane_geometry(file_path, plane)[0]
+        stored = self.slice_store.open(file_path) if self.slice_store is not None else None
+        if stored is not None:
+            return tuple(int(x) for x in stored[0].shape[:3])
+        if self._get_file_extension(file_path) == '.dcm':
+            ds = pydicom.dcmread(file_path, stop_before_pixels=True)
+            return int(ds.get('NumberOfFrames', 1) or 1), int(ds.Rows), int(ds.Columns)
+        shape = volume_reader.get_shape(volume_reader.open_nifti(file_path))
+        return (shape[2] if len(shape) > 2 else 1), shape[0], shape[1]
+    
+    def _get_slice_shape(self, file_path, plane=None):
+        """(rows, columns) of a displayed slice without decoding pixel data"""
+        if plane is not None:
+            shape, spacing = self._get_plane_geometry(file_path, plane)
+            return self._aspect_corrected_rows(shape[1], spacing), shape[2]
+        stored = self.slice_store.open(file_path) if self.slice_store is not None else None
+        if stored is not None:
+            return tuple(int(x) for x in stored[0].shape[1:3])
+        if self._get_file_extension(file_path) == '.dcm':
+            ds = pydicom.dcmread(file_path, stop_before_pixels=True)
+            return int(ds.Rows), int(ds.Columns)
+        shape = volume_reader.get_shape(volume_reader.open_nifti(file_path))
+        return shape[0], shape[1]
+    
+    def _downsample(self, image):
+        """Next pyramid level: halve each edge (rounding up) with 2x2 area averaging"""
+        height, width = image.shape[:2]
+        size = ((width + 1) // 2, (height + 1) // 2)
+        if size == (width, height):
+            return image
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    
+    def _tile_key(self, file_path, slice_index, fmt, quality, window='auto', plane=None, **params):
+        """
+        Tile cache key for a rendered slice (extra params become part of the key)
+        
+        Stored-axis slices are keyed as plane 'stored': they differ from the
+        canonical axial MPR plane whenever the affine is not RAS-aligned.
+        """
+        if fmt == 'jpeg':
+            params['quality'] = DEFAULT_JPEG_QUALITY if quality is None else max(1, min(int(quality), 100))
+        return TileCache.make_key(self.get_content_hash(file_path), slice_index, plane=plane or STORED_PLANE,
+                                  window=window, fmt=fmt, lut=TILE_VERSION, **params)
+    
+    def render_sprite(self, file_path, start=0, stop=None, stride=1, size=DEFAULT_SPRITE_SIZE,
+                      fmt='png', quality=None, window='auto', plane=None):
+        """
+        Render a range of slices into one sprite sheet
+        
+        The slices are read in a single access (one slice store range or one
+        proxy read), windowed with one lookup, scaled to fit size x size and
+        packed row-major into a grid. Sheets are kept in the tile cache.
+        
+        Args:
+            file_path: Path to DICOM/NIFTI file
+            start, stop: First and last slice (inclusive, clamped)
+            stride: Step between slices
+            size: Longest tile edge in pixels (slices are never upscaled)
+            fmt: 'png', 'webp' (lossless) or 'jpeg'
+            quality: JPEG quality 1-100
+            window: Window name (see get_available_windows)
+            plane: MPR plane, or None for stored slices
+        
+        Returns:
+            dict with success status, encoded image data and the grid layout
+        """
         try:
-            ds = pydicom.dcmread(file_path)
-            image_data = ds.pixel_array
-            
-            # Normalize image data
-            normalized = self._normalize_for_display(image_data)
+            fmt = normalize_format(fmt)
+            if fmt is None:
+                return {'success': False, 'error': 'Unsupported image format'}
+            
+            slice_count = self._get_slice_count(file_path, plane)
+            stride = max(1, int(stride))
+            start = max(0, min(int(start), slice_count - 1))
+            stop = slice_count - 1 if stop is None else max(start, min(int(stop), slice_count - 1))
+            stop = min(stop, start + (MAX_SPRITE_SLICES - 1) * stride)
+            stop = start + (stop - start) // stride * stride  # Last slice actually included
+            size = max(16, min(int(size), 1024))
+            
+            key = self._tile_key(file_path, f'sprite:{start}:{stop}:{stride}', fmt, quality, window, plane,
+                                 size=size)
+            layout_data = self.tile_cache.get(key, 'json')
+            data = self.tile_cache.get(key, fmt) if layout_data is not None else None
+            if data is not None:
+                return {'success': True, 'data': data, 'layout': json.loads(layout_data)}
+            
+            block = self._read_slice_block(file_path, start, stop + 1, stride, plane)
+            if block.ndim == 3 and not (window == windowing.AUTO_WINDOW and block.dtype == np.uint8):
+                histogram, lut = self._get_window_lut(file_path, window)
+                block = windowing.apply_lut(lut, histogram.to_codes(block))
+            
+            count = block.shape[0]
+            height, width = self._get_slice_shape(file_path, plane) if plane is not None else block.shape[1:3]
+            scale = min(1.0, size / max(height, width))
+            tile_width = max(1, int(round(width * scale)))
+            tile_height = max(1, int(round(height * scale)))
+            columns = int(math.ceil(math.sqrt(count)))
+            rows = int(math.ceil(count / columns))
+            
+            sheet = np.zeros((rows * tile_height, columns * tile_width) + block.shape[3:], dtype=np.uint8)
+            for i in range(count):
+                tile = block[i]
+                if tile.shape[:2] != (tile_height, tile_width):
+                    tile = cv2.resize(tile, (tile_width, tile_height), interpolation=cv2.INTER_AREA)
+                row, column = divmod(i, columns)
+                sheet[row * tile_height:(row + 1) * tile_height,
+                      column * tile_width:(column + 1) * tile_width] = tile
+            
+            layout = {
+                'columns': columns,
+                'rows': rows,
+                'tile_width': tile_width,
+                'tile_height': tile_height,
+                'slice_width': width,
+                'slice_height': height,
+                'start': start,
+                'stop': stop,
+                'stride': stride,
+                'count': count,
+                'total_slices': slice_count
+            }
+            data = encode_image(sheet, fmt, quality)
+            self.tile_cache.put(key, data, fmt)
+            self.tile_cache.put(key, json.dumps(layout).encode('utf-8'), 'json')
+            return {'success': True, 'data': data, 'layout': layout}
             
-            # Save as PNG for web viewing
-            output_path = os.path.join(output_dir, f"{base_name}_web.png")
-            Image.fromarray(normalized).save(output_path)
+        except ValueError as e:
+            return {'success': False, 'error': str(e)}
+        except Exception as e:
+            logger.error(f"Error rendering sprite for {file_path}: {str(e)}")
+            return {'success': False, 'error': f'Sprite rendering failed: {str(e)}'}
+    
+    def _get_slice_count(self, file_path, plane=None):
+        """Number of displayable slices, from the slice store or the header"""
+        if plane is not None:
+            return self._get_plane_geometry(file_path, plane)[0][0]
+        stored = self.slice_store.open(file_path) if self.slice_store is not None else None
+        if stored is not None:
+            return int(stored[0].shape[0])
+        if self._get_file_extension(file_path) == '.dcm':
+            return 1
+        return volume_reader.get_slice_count(volume_reader.open_nifti(file_path))
+    
+    def _read_slice_block(self, file_path, start, stop, stride=1, plane=None):
+        """
+        Read slices start:stop:stride in one access
+        
+        Returns:
+            numpy array (slices, rows, columns[, channels]) in native dtype
+        """
+        if plane is not None:
+            return np.asarray(self._get_plane_volume(file_path, plane)[0][start:stop:stride])
+        
+        stored = self.slice_store.open(file_path) if self.slice_store is not None else None
+        if stored is not None:
+            return np.asarray(stored[0][start:stop:stride])
+        
+        if self._get_file_extension(file_path) == '.dcm':
+            pixels = self._load_volume(file_path, '.dcm')
+            return pixels[np.newaxis] if pixels.ndim == 2 else pixels[start:stop:stride]
+        
+        cached = self.volume_cache.peek(file_path, variant='nifti')
+        if cached is not None and cached.ndim >= 3:
+            block = cached[:, :, start:stop:stride]
+            if block.ndim > 3:
+                block = block.reshape(block.shape[:3] + (-1,))[:, :, :, 0]
+        else:
+            block = volume_reader.read_slab(volume_reader.open_nifti(file_path), start, stop, stride)
+        return np.moveaxis(block, 2, 0)
+    
+    def _dicom_to_web(self, file_path, window='auto'):
+        """Render DICOM as a display-ready 8-bit image"""
+        try:
+            stored = self.slice_store.open(file_path) if self.slice_store is not None else None
+            if stored is not None and stored[0].shape[0] == 1:
+                image_data = stored[0][0]
+            else:
+                image_data = self._load_volume(file_path, '.dcm')
             
-            return output_path
+            return self._window_for_display(file_path, image_data, window)
             
         except Exception as e:
             logger.error(f"Error converting DICOM to web format: {str(e)}")
             return None
     
-    def _nifti_to_web(self, file_path, output_dir, base_name, slice_index=None):
-        """Convert NIFTI to web-viewable format with slice support"""
+    def _nifti_to_web(self, file_path, slice_index=None, window='auto'):
+        """Render one NIFTI slice as a display-ready 8-bit image"""
         try:
-            img = nib.load(file_path)
-            image_data = img.get_fdata()
-            
-            # Handle slice selection for 3D volumes
-            if len(image_data.shape) == 3:
-                total_slices = image_data.shape[2]
-                if slice_index is None:
-                    slice_index = total_slices // 2  # Default to middle slice
-                else:
-                    slice_index = max(0, min(slice_index, total_slices - 1))  # Clamp to valid range
-                
-                slice_data = image_data[:, :, slice_index]
-            else:
-                # If 2D, use as is
-                slice_data = image_data
-                slice_index = 0
+            slice_data, slice_index = self._read_nifti_slice(file_path, slice_index)
             
-            # Normalize image data
-            normalized = self._normalize_for_display(slice_data)
-            
-            # Create unique filename for each slice
-            if slice_index > 0:
-                output_path = os.path.join(output_dir, f"{base_name}_slice_{slice_index}_web.png")
-            else:
-                output_path = os.path.join(output_dir, f"{base_name}_web.png")
-            
-            # Save as PNG for web viewing
-            Image.fromarray(normalized).save(output_path)
-            
-            return output_path
+            return self._window_for_display(file_path, slice_data, window)
             
         except Exception as e:
             logger.error(f"Error converting NIFTI to web format: {str(e)}")
             return None
     
-    def _normalize_for_display(self, image_data):
-        """Normalize image data for display (0-255 range)"""
+    def get_available_planes(self, file_path):
+        """
+        MPR planes of a study and their slice counts, from headers only
+        
+        Returns:
+            dict of plane name to slice count (empty unless a 3D NIFTI volume)
+        """
+        if self._get_file_extension(file_path) not in ('.nii', '.nii.gz'):
+            return {}
+        if len(volume_reader.get_shape(volume_reader.open_nifti(file_path))) < 3:
+            return {}
+        return {plane: self._get_plane_geometry(file_path, plane)[0][0] for plane in mpr.PLANES}
+    
+    def _get_plane_geometry(self, file_path, plane):
+        """(slices, rows, columns) shape and spacing of an MPR plane"""
+        img = volume_reader.open_nifti(file_path)
+        shape = volume_reader.get_shape(img)
+        zooms = img.header.get_zooms()
+        return mpr.plane_shape(shape, img.affine, plane), mpr.plane_spacing(zooms, img.affine, plane)
+    
+    def _get_plane_volume(self, file_path, plane):
+        """
+        Canonically oriented (slices, rows, columns) volume of an MPR plane
+        
+        Served from the slice store's per-plane copy, which keeps every
+        plane's slices contiguous; without a store the plane is a view of
+        the cached volume.
+        
+        Returns:
+            tuple of (array, (slice, row, column) spacing)
+        """
+        if self.slice_store is not None:
+            stored = self.slice_store.get_plane(file_path, plane)
+            if stored is not None:
+                return stored
+        
+        img = volume_reader.open_nifti(file_path)
+        volume = self._load_volume(file_path, '.nii')
+        if volume.ndim > 3:
+            volume = volume.reshape(volume.shape[:3] + (-1,))[:, :, :, 0]
+        return (mpr.plane_view(volume, img.affine, plane),
+                mpr.plane_spacing(img.header.get_zooms(), img.affine, plane))
+    
+    def _plane_to_web(self, file_path, plane, slice_index=None, window='auto'):
+        """Render one MPR slice as a display-ready 8-bit image with square pixels"""
         try:
-            # Handle different data types and ranges
-            if image_data.dtype == np.uint8:
-                return image_data
+            volume, spacing = self._get_plane_volume(file_path, plane)
+            total_slices = volume.shape[0]
+            if slice_index is None:
+                slice_index = total_slices // 2
+            slice_index = max(0, min(int(slice_index), total_slices - 1))
+            
+            image = self._window_for_display(file_path, np.asarray(volume[slice_index]), window)
+            rows = self._aspect_corrected_rows(image.shape[0], spacing)
+            if rows != image.shape[0]:
+                image = cv2.resize(image, (image.shape[1], rows), interpolation=cv2.INTER_LINEAR)
+            return image
             
-            # Remove outliers for better visualization
-            p1, p99 = np.percentile(image_data, (1, 99))
-            image_data = np.clip(image_data, p1, p99)
+        except Exception as e:
+            logger.error(f"Error rendering {plane} plane of {file_path}: {str(e)}")
+            return None
+    
+    def _aspect_corrected_rows(self, rows, spacing):
+        """Row count that gives square pixels at the plane's column spacing"""
+        row_spacing, column_spacing = spacing[1], spacing[2]
+        if row_spacing <= 0 or column_spacing <= 0:
+            return rows
+        return max(1, int(round(rows * row_spacing / column_spacing)))
+    
+    def get_content_hash(self, file_path):
+        """
+        SHA-256 of the file content, memoized per path, mtime and size
+        
+        Content-addressed uploads carry the digest in their filename; other
+        files use the digest recorded in the slice store sidecar when
+        available so the file is hashed at most once per worker.
+        """
+        content_hash = content_hash_from_path(file_path)
+        if content_hash:
+            return content_hash
+        
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+        with self._hash_lock:
+            content_hash = self._content_hashes.get(key)
+        if content_hash:
+            return content_hash
+        
+        stored = self.slice_store.open(file_path) if self.slice_store is not None else None
+        if stored is not None:
+            content_hash = stored[1].get('content_sha256')
+        if not content_hash:
+            content_hash = compute_file_sha256(file_path)
+        
+        with self._hash_lock:
+            self._content_hashes[key] = content_hash
+        return content_hash
+    
+    def _window_for_display(self, file_path, image_data, window='auto'):
+        """
+        Map image data to 8-bit through the volume's window lookup table
+        
+        The table is built from the whole-volume histogram, so every slice
+        of a study gets the same mapping. Color images, and 8-bit images
+        under the auto window, are already display-ready.
+        """
+        if image_data.ndim == 3 and image_data.shape[-1] in (3, 4):
+            return image_data
+        if window == windowing.AUTO_WINDOW and image_data.dtype == np.uint8:
+            return image_data
+        
+        histogram, lut = self._get_window_lut(file_path, window)
+        return windowing.apply_lut(lut, histogram.to_codes(image_data))
+    
+    def get_available_windows(self, file_path):
+        """Window names renderable for a file ('auto', 'dicom' if defined, CT presets for CT data)"""
+        source = self._get_window_source(file_path)
+        return windowing.available_windows(source['dicom_window'], source['hounsfield'])
+    
+    def _get_window_lut(self, file_path, window):
+        """
+        Histogram and lookup table for a named window, memoized per content
+        
+        Raises:
+            ValueError: if the window is not available for the file
+        """
+        key = (self.get_content_hash(file_path), window)
+        with self._window_lock:
+            cached = self._windows.get(key)
+            if cached is not None:
+                self._windows.move_to_end(key)
+                return cached
+        
+        source = self._get_window_source(file_path)
+        histogram = source['histogram']
+        center_width = windowing.resolve_window(
+            window, histogram, source['slope'], source['intercept'], source['dicom_window'], source['hounsfield'])
+        if center_width is None:
+            raise ValueError(f'Window not available: {window}')
+        lut = windowing.make_lut(histogram, center_width[0], center_width[1],
+                                 source['slope'], source['intercept'])
+        
+        with self._window_lock:
+            self._windows[key] = (histogram, lut)
+            while len(self._windows) > MAX_CACHED_WINDOWS:
+                self._windows.popitem(last=False)
+        return histogram, lut
+    
+    def _get_window_source(self, file_path):
+        """Volume histogram, rescale transform and DICOM window of a file, memoized per content"""
+        key = (self.get_content_hash(file_path), None)
+        with self._window_lock:
+            cached = self._windows.get(key)
+            if cached is not None:
+                self._windows.move_to_end(key)
+                return cached
+        
+        stored = self.slice_store.open(file_path) if self.slice_store is not None else None
+        if stored is not None:
+            meta = stored[1]
+            histogram = self.slice_store.get_histogram(file_path)
+            slope, intercept = meta['rescale_slope'], meta['rescale_intercept']
+            header = meta.get('header', {})
+            center, width = header.get('window_center'), header.get('window_width')
+            modality = header.get('modality')
+        elif self._get_file_extension(file_path) == '.dcm':
+            ds = pydicom.dcmread(file_path, stop_before_pixels=True)
+            histogram = VolumeHistogram.from_volume(self._load_volume(file_path, '.dcm'))
+            slope = float(ds.get('RescaleSlope', 1) or 1)
+            intercept = float(ds.get('RescaleIntercept', 0) or 0)
+            center, width = first_float(ds.get('WindowCenter')), first_float(ds.get('WindowWidth'))
+            modality = str(ds.get('Modality', ''))
+        else:
+            # Voxel data comes back already scaled
+            histogram = VolumeHistogram.from_volume(self._load_volume(file_path, '.nii'))
+            slope, intercept = 1.0, 0.0
+            center = width = None
+            modality = None
+        
+        source = {
+            'histogram': histogram,
+            'slope': slope,
+            'intercept': intercept,
+            'dicom_window': (center, width) if center is not None and width else None,
+            'hounsfield': windowing.is_hounsfield(histogram, slope, intercept, modality)
+        }
+        with self._window_lock:
+            self._windows[key] = source
+        return source
+    
+    def _load_volume(self, file_path, kind):
+        """Get decoded pixel data through the shared volume cache"""
+        if kind == '.dcm':
+            return self.volume_cache.get(file_path, self._decode_dicom, variant='dicom')
+        return self.volume_cache.get(file_path, self._decode_nifti, variant='nifti')
+    
+    def _decode_dicom(self, file_path):
+        """Decode DICOM pixel data with the plugin selected for its transfer syntax"""
+        pixels, _ = pixel_decoders.decode(pydicom.dcmread(file_path))
+        return pixels
+    
+    def _decode_nifti(self, file_path):
+        """Decode NIFTI voxel data in the file's dtype"""
+        return volume_reader.read_volume(volume_reader.open_nifti(file_path))
+    
+    def _read_nifti_slice(self, file_path, slice_index=None):
+        """
+        Read one axis-2 slice of a NIFTI volume (first frame for 4D)
+        
+        Prefers the ingest-time slice store, which reads only the bytes of
+        the requested slice. Otherwise uses an already cached volume when
+        available. Uncompressed files are
+        read from a memory map; compressed volumes small enough to share the
+        cache are decoded once so scrolling stays cheap, and larger ones are
+        read slice by slice through the array proxy.
+        
+        Returns:
+            tuple of (2D slice array, clamped slice index)
+        """
+        if self.slice_store is not None:
+            stored = self.slice_store.get_slice(file_path, slice_index)
+            if stored is not None:
+                return stored
+        
+        img = volume_reader.open_nifti(file_path)
+        shape = volume_reader.get_shape(img)
+        
+        if len(shape) < 3:
+            return volume_reader.read_slice(img, 0), 0
+        
+        total_slices = shape[2]
+        if slice_index is None:
+            slice_index = total_slices // 2  # Default to middle slice
+        else:
+            slice_index = max(0, min(slice_index, total_slices - 1))  # Clamp to valid range
+        
+        cached = self.volume_cache.peek(file_path, variant='nifti')
+        if cached is None and not volume_reader.is_memory_mappable(file_path):
+            if volume_reader.estimate_nbytes(img) <= self.volume_cache.max_bytes // 4:
+                cached = self._load_volume(file_path, '.nii')
+        
+        if cached is not None:
+            slice_data = cached[:, :, slice_index]
+            if slice_data.ndim > 2:
+                slice_data = slice_data.reshape(slice_data.shape[:2] + (-1,))[:, :, 0]
+            return slice_data, slice_index
+        
+        return volume_reader.read_slice(img, slice_index), slice_index
+    
+    def get_raw_slice(self, file_path, slice_index=0):
+        """
+        Get one slice's native pixel values for client-side windowing
+        
+        Served from the slice store as a file byte range (no copy) when the
+        stored dtype can go out as is; otherwise the slice is read and,
+        if needed, converted to float32.
+        
+        Returns:
+            dict with 'file_range' (slice store) or 'pixels' (array), plus
+            dtype, shape, spacing, rescale slope/intercept and slice info
+        """
+        try:
+            if self.slice_store is not None:
+                slice_range = self.slice_store.get_slice_range(file_path, slice_index)
+                if slice_range is not None:
+                    meta = slice_range['metadata']
+                    dtype = np.dtype(meta['dtype'])
+                    result = {
+                        'success': True,
+                        'dtype': dtype.name,
+                        'shape': meta['shape'][1:3],
+                        'spacing': meta['spacing'],
+                        'rescale_slope': meta['rescale_slope'],
+                        'rescale_intercept': meta['rescale_intercept'],
+                        'slice_index': slice_range['slice_index'],
+                        'slice_count': meta['shape'][0]
+                    }
+                    if dtype.name in RAW_SLICE_DTYPES and len(meta['shape']) == 3:
+                        result['file_range'] = slice_range
+                    else:
+                        volume, _ = self.slice_store.open(file_path)
+                        result['pixels'] = self._to_raw_dtype(volume[slice_range['slice_index']])
+                        result['dtype'] = result['pixels'].dtype.name
+                    return result
             
-            # Normalize to 0-255
-            if p99 > p1:
-                normalized = ((image_data - p1) / (p99 - p1) * 255).astype(np.uint8)
+            file_extension = self._get_file_extension(file_path)
+            if file_extension == '.dcm':
+                ds = pydicom.dcmread(file_path, stop_before_pixels=True)
+                pixels = self._load_volume(file_path, '.dcm')
+                slice_count = pixels.shape[0] if pixels.ndim == 3 and int(ds.get('SamplesPerPixel', 1)) == 1 else 1
+                if slice_count > 1:
+                    slice_index = max(0, min(int(slice_index), slice_count - 1))
+                    pixels = pixels[slice_index]
+                else:
+                    slice_index = 0
+                spacing = [float(x) for x in ds.get('PixelSpacing', [1.0, 1.0])]
+                spacing.append(float(ds.get('SliceThickness', 0) or 0) or 1.0)
+                slope = float(ds.get('RescaleSlope', 1) or 1)
+                intercept = float(ds.get('RescaleIntercept', 0) or 0)
+            elif file_extension in ['.nii', '.nii.gz']:
+                img = volume_reader.open_nifti(file_path)
+                pixels, slice_index = self._read_nifti_slice(file_path, slice_index)
+                slice_count = volume_reader.get_slice_count(img)
+                zooms = [float(x) for x in img.header.get_zooms()]
+                spacing = [zooms[0], zooms[1], zooms[2] if len(zooms) > 2 else 1.0]
+                slope, intercept = 1.0, 0.0  # nibabel has already applied scl_slope/inter
             else:
-                normalized = np.zeros_like(image_data, dtype=np.uint8)
+                return {'success': False, 'error': f'Unsupported file format: {file_extension}'}
             
-            return normalized
+            pixels = self._to_raw_dtype(pixels)
+            return {
+                'success': True,
+                'pixels': pixels,
+                'dtype': pixels.dtype.name,
+                'shape': list(pixels.shape[:2]),
+                'spacing': spacing,
+                'rescale_slope': slope,
+                'rescale_intercept': intercept,
+                'slice_index': slice_index,
+                'slice_count': slice_count
+            }
             
         except Exception as e:
-            logger.error(f"Error normalizing image: {str(e)}")
-            # Return zeros as fallback
-            return np.zeros_like(image_data, dtype=np.uint8)
+            logger.error(f"Error reading raw slice from {file_path}: {str(e)}")
+            return {'success': False, 'error': f'Raw slice read failed: {str(e)}'}
+    
+    def _to_raw_dtype(self, pixels):
+        """Little-endian C-contiguous copy in a dtype the viewer can map directly"""
+        dtype = pixels.dtype
+        if dtype.name not in RAW_SLICE_DTYPES:
+            dtype = np.dtype(np.float32)
+        return np.ascontiguousarray(pixels, dtype=dtype.newbyteorder('<'))
+    
+    def build_slice_store(self, file_path, content_hash=None):
+        """
+        Write the random-access slice store for an uploaded file
+        
+        Args:
+            file_path: Path to the uploaded medical image
+            content_hash: SHA-256 already computed during upload, if known
+        
+        Returns:
+            dict with success status and the sidecar metadata
+        """
+        if self.slice_store is None:
+            return {'success': False, 'error': 'Slice store not configured'}
+        
+        # Re-uploads of identical content map to the same file and store
+        stored = self.slice_store.open(file_path)
+        if stored is not None:
+            return {'success': True, 'metadata': stored[1], 'reused': True}
+        return self.slice_store.build(file_path, content_hash=content_hash)
+    
+    def get_cache_stats(self):
+        """Get decoded-volume cache, tile cache and slice store statistics"""
+        stats = {
+            'volume_cache': self.volume_cache.get_stats(),
+            'tile_cache': self.tile_cache.get_stats()
+        }
+        if self.slice_store is not None:
+            stats['slice_store'] = self.slice_store.get_disk_usage()
+        return stats
     
     def _get_file_extension(self, file_path):
         """Get file extension, handling .nii.gz specially"""
@@ -266,38 +971,49 @@ class ImageProcessor:
         else:
             return os.path.splitext(file_path.lower())[1]
     
-    def extract_slices(self, file_path, output_dir, slice_count=5):
+    def extract_slices(self, file_path, output_dir, slice_count=5, overlay=None, window='auto'):
         """
-        Extract multiple slices from 3D medical image
-        Returns list of slice file paths
+        Extract evenly spaced key images of a 3D medical image
+        
+        Slices go through the same renderer (and tile cache) as the viewer,
+        so a key image with a segmentation overlay is the composite the
+        image route serves.
+        
+        Args:
+            file_path: Path to DICOM/NIFTI file
+            output_dir: Directory for the PNG key images
+            slice_count: Number of slices to extract
+            overlay: Optional LabelOverlay to blend into every key image
+            window: Window name (see get_available_windows)
+        
+        Returns:
+            list of slice file paths
         """
         try:
             file_extension = self._get_file_extension(file_path)
             base_name = os.path.splitext(os.path.basename(file_path))[0]
             
-            if file_extension == '.dcm':
-                ds = pydicom.dcmread(file_path)
-                image_data = ds.pixel_array
-            elif file_extension in ['.nii', '.nii.gz']:
-                img = nib.load(file_path)
-                image_data = img.get_fdata()
+            if file_extension in ['.nii', '.nii.gz']:
+                img = volume_reader.open_nifti(file_path)
+                if len(volume_reader.get_shape(img)) < 3:
+                    return []
+                depth = volume_reader.get_slice_count(img)
+            elif file_extension == '.dcm':
+                depth = 1
             else:
                 return []
             
             slice_paths = []
-            
-            if len(image_data.shape) == 3:
-                # Extract evenly spaced slices
-                depth = image_data.shape[2]
-                slice_indices = np.linspace(0, depth-1, min(slice_count, depth), dtype=int)
+            slice_indices = np.linspace(0, depth-1, min(slice_count, depth), dtype=int)
+            for i, slice_idx in enumerate(slice_indices):
+                data = self.render_for_web(file_path, int(slice_idx), fmt='png', window=window, overlay=overlay)
+                if data is None:
+                    continue
                 
-                for i, slice_idx in enumerate(slice_indices):
-                    slice_data = image_data[:, :, slice_idx]
-                    normalized = self._normalize_for_display(slice_data)
-                    
-                    slice_path = os.path.join(output_dir, f"{base_name}_slice_{i+1}.png")
-                    Image.fromarray(normalized).save(slice_path)
-                    slice_paths.append(slice_path)
+                slice_path = os.path.join(output_dir, f"{base_name}_slice_{i+1}.png")
+                with open(slice_path, 'wb') as f:
+                    f.write(data)
+                slice_paths.append(slice_path)
             
             return slice_paths
             
@@ -0,0 +1,270 @@
+import sys
+import time
+import logging
+import argparse
+import tracemalloc
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BINS = 4096  # Histogram resolution for float and wide-integer data
+
+# Integer dtypes small enough for an exact histogram with one bin per value
+EXACT_DTYPES = {
+    np.dtype(np.uint8): (np.uint8, 0),
+    np.dtype(np.int8): (np.uint8, -2 ** 7),
+    np.dtype(np.bool_): (np.uint8, 0),
+    np.dtype(np.uint16): (np.uint16, 0),
+    np.dtype(np.int16): (np.uint16, -2 ** 15)
+}
+
+class StreamingStats:
+    """
+    Single-pass image statistics over slabs of a volume
+
+    8- and 16-bit integer data (e.g. CT) is counted into an exact histogram
+    with one bin per representable value, from which every statistic is
+    exact. Other data goes into a fixed number of bins whose width doubles
+    whenever a slab falls outside the current range; quantiles are then
+    accurate to one bin width and mean/std are merged exactly from per-slab
+    moments. Memory is bounded by one slab plus the histogram. NaN and
+    infinite values are ignored.
+    """
+
+    def __init__(self, bins=DEFAULT_BINS):
+        self.bins = int(bins)
+        self.exact = None
+        self.counts = None
+        self.lo = None
+        self.width = None
+        self.integer = False
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.non_zero = 0
+
+    def update(self, slab):
+        """Add a slab (any shape) to the statistics"""
+        slab = np.asarray(slab)
+        if slab.size == 0:
+            return
+        if not slab.dtype.isnative:
+            slab = slab.astype(slab.dtype.newbyteorder('='))
+
+        if self.exact is None:
+            self.exact = slab.dtype in EXACT_DTYPES
+            self.integer = np.issubdtype(slab.dtype, np.integer) or slab.dtype == np.bool_
+        if self.exact:
+            self._update_exact(slab)
+        else:
+            self._update_binned(slab)
+
+    def _update_exact(self, slab):
+        view_dtype, lo = EXACT_DTYPES[slab.dtype]
+        if self.counts is None:
+            self.counts = np.zeros(2 ** (8 * np.dtype(view_dtype).itemsize), dtype=np.int64)
+            self.lo = lo
+            self.width = 1
+        counts = np.bincount(np.ascontiguousarray(slab).view(view_dtype).ravel(),
+                             minlength=self.counts.size)
+        if lo:
+            # Signed values viewed as unsigned wrap around; rotate into ascending order
+            counts = np.roll(counts, -lo)
+        self.counts += counts
+
+    def _update_binned(self, slab):
+        if np.issubdtype(slab.dtype, np.floating):
+            if slab.dtype == np.float16:
+                slab = slab.astype(np.float32)
+            finite = np.isfinite(slab)
+            if not finite.all():
+                slab = slab[finite]
+                if slab.size == 0:
+                    return
+
+        slab_min = float(slab.min())
+        slab_max = float(slab.max())
+        n = slab.size
+        slab_mean = float(np.mean(slab, dtype=np.float64))
+        slab_m2 = float(np.var(slab, dtype=np.float64)) * n
+
+        # Chan et al. parallel merge of count, mean and sum of squared deviations
+        total = self.count + n
+        delta = slab_mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += slab_m2 + delta * delta * self.count * n / total
+        self.count = total
+        self.min = slab_min if self.min is None else min(self.min, slab_min)
+        self.max = slab_max if self.max is None else max(self.max, slab_max)
+        self.non_zero += int(np.count_nonzero(slab))
+
+        self._fit_range(slab_min, slab_max)
+        index = ((slab - self.lo) / self.width).astype(np.int64).ravel()
+        np.clip(index, 0, self.bins - 1, out=index)
+        self.counts += np.bincount(index, minlength=self.bins)
+
+    def _fit_range(self, slab_min, slab_max):
+        """Grow the histogram range (doubling bin width) until it covers the slab"""
+        if self.counts is None:
+            span = slab_max - slab_min
+            if self.integer:
+                self.lo = float(np.floor(slab_min))
+                self.width = float(max(1, int(np.ceil((span + 1) / self.bins))))
+            else:
+                self.lo = slab_min
+                self.width = span / (self.bins - 1) if span > 0 else max(abs(slab_min), 1.0) / self.bins
+            self.counts = np.zeros(self.bins, dtype=np.int64)
+
+        while slab_min < self.lo or slab_max >= self.lo + self.width * self.bins:
+            merged = self.counts.reshape(-1, 2).sum(axis=1)
+            self.counts = np.zeros(self.bins, dtype=np.int64)
+            if slab_min < self.lo:
+                # Old range becomes the upper half
+                self.counts[self.bins // 2:] = merged
+                self.lo -= self.width * self.bins
+            else:
+                self.counts[:self.bins // 2] = merged
+            self.width *= 2
+
+    def _order_statistic(self, cumulative, rank):
+        """Value of the rank-th smallest element (0-based)"""
+        index = int(np.searchsorted(cumulative, rank, side='right'))
+        left = self.lo + index * self.width
+        if self.width == 1 and self.integer:
+            return float(left)
+        before = cumulative[index - 1] if index > 0 else 0
+        in_bin = cumulative[index] - before
+        # Spread the bin's elements evenly across it
+        return float(left + (rank - before + 0.5) / in_bin * self.width)
+
+    def _quantile(self, cumulative, total, q):
+        """Linear-interpolated quantile, matching numpy's default method"""
+        position = (total - 1) * q
+        below = int(np.floor(position))
+        fraction = position - below
+        value = self._order_statistic(cumulative, below)
+        if fraction > 0:
+            value += fraction * (self._order_statistic(cumulative, below + 1) - value)
+        return value
+
+    def result(self):
+        """
+        Statistics accumulated so far
+
+        Returns:
+            dict with min, max, mean, std, median, percentile_5,
+            percentile_95, non_zero_count and total_voxels (empty if no data)
+        """
+        if self.counts is None:
+            return {}
+
+        if self.exact:
+            values = self.lo + np.arange(self.counts.size, dtype=np.float64)
+            total = int(self.counts.sum())
+            occupied = np.flatnonzero(self.counts)
+            mean = float(np.dot(self.counts, values) / total)
+            std = float(np.sqrt(np.dot(self.counts, (values - mean) ** 2) / total))
+            minimum = float(values[occupied[0]])
+            maximum = float(values[occupied[-1]])
+            non_zero = total - int(self.counts[-self.lo])
+        else:
+            total = self.count
+            mean = self.mean
+            std = float(np.sqrt(self.m2 / total))
+            minimum, maximum, non_zero = self.min, self.max, self.non_zero
+
+        cumulative = np.cumsum(self.counts)
+
+        def quantile(q):
+            # Binning can place a quantile marginally outside the observed range
+            return min(max(self._quantile(cumulative, total, q), minimum), maximum)
+
+        return {
+            'min': minimum,
+            'max': maximum,
+            'mean': mean,
+            'std': std,
+            'median': quantile(0.5),
+            'percentile_5': quantile(0.05),
+            'percentile_95': quantile(0.95),
+            'non_zero_count': int(non_zero),
+            'total_voxels': int(total)
+        }
+
+def compute_stats(slabs, bins=DEFAULT_BINS):
+    """
+    Statistics over an iterable of arrays (e.g. slabs of a volume)
+
+    Returns:
+        dict with the same keys as StreamingStats.result
+    """
+    stats = StreamingStats(bins=bins)
+    for slab in slabs:
+        stats.update(slab)
+    return stats.result()
+
+def iter_array_slabs(array, slab_size=16):
+    """Split an in-memory or memory-mapped array into slabs along axis 0"""
+    array = np.asanyarray(array)
+    if array.ndim < 3:
+        yield array
+        return
+    for start in range(0, array.shape[0], slab_size):
+        yield array[start:start + slab_size]
+
+def legacy_stats(image_data):
+    """The previous whole-volume float64 implementation, kept for benchmarking"""
+    image_data = np.asarray(image_data, dtype=np.float64)
+    clean_data = image_data[~np.isnan(image_data)] if np.any(np.isnan(image_data)) else image_data
+    return {
+        'min': float(np.min(clean_data)),
+        'max': float(np.max(clean_data)),
+        'mean': float(np.mean(clean_data)),
+        'std': float(np.std(clean_data)),
+        'median': float(np.median(clean_data)),
+        'percentile_5': float(np.percentile(clean_data, 5)),
+        'percentile_95': float(np.percentile(clean_data, 95)),
+        'non_zero_count': int(np.count_nonzero(clean_data)),
+        'total_voxels': int(clean_data.size)
+    }
+
+def _measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def main(argv=None):
+    """Compare streaming statistics with the legacy implementation"""
+    parser = argparse.ArgumentParser(description='Benchmark image statistics on a volume')
+    parser.add_argument('file_path', nargs='?', help='NIFTI file (default: synthetic CT volume)')
+    parser.add_argument('--shape', default='512,512,1000', help='Synthetic volume shape')
+    args = parser.parse_args(argv)
+
+    if args.file_path:
+        from services import volume_reader
+        volume = volume_reader.read_volume(volume_reader.open_nifti(args.file_path))
+        volume = np.moveaxis(volume, 2, 0) if volume.ndim >= 3 else volume
+    else:
+        shape = tuple(int(x) for x in args.shape.split(','))
+        rng = np.random.default_rng(0)
+        volume = (rng.normal(40, 300, size=shape[::-1]).clip(-1024, 3071)).astype(np.int16)
+
+    print(f"Volume {volume.shape} {volume.dtype}, {volume.nbytes / 1e6:.0f} MB")
+    streaming, streaming_time, streaming_peak = _measure(lambda: compute_stats(iter_array_slabs(volume)))
+    legacy, legacy_time, legacy_peak = _measure(lambda: legacy_stats(volume))
+
+    print(f"{'':<10}{'seconds':>10}{'peak MB':>10}")
+    print(f"{'legacy':<10}{legacy_time:>10.2f}{legacy_peak / 1e6:>10.0f}")
+    print(f"{'streaming':<10}{streaming_time:>10.2f}{streaming_peak / 1e6:>10.0f}")
+    for key in legacy:
+        print(f"{key:<16}{legacy[key]:>16.4f}{streaming[key]:>16.4f}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
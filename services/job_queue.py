@@ -0,0 +1,117 @@
+import uuid
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_FINISHED = 200  # Finished jobs kept for status polling
+
+class JobQueue:
+    """
+    In-process background job runner with bounded concurrency
+
+    Jobs run on a thread pool so long stages (segmentation subprocesses,
+    LLM calls) do not hold a request worker. Job state lives in memory of
+    the worker process that accepted the job; only the most recent
+    max_finished completed or failed jobs are kept.
+    """
+
+    def __init__(self, max_workers=2, max_finished=DEFAULT_MAX_FINISHED):
+        self.max_workers = max_workers
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='processing')
+        self._jobs = {}
+        self._study_jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, study_id=None, **kwargs):
+        """
+        Queue func(job_id, *args, **kwargs) for background execution
+
+        Returns:
+            job id string
+        """
+        job_id = uuid.uuid4().hex
+        job = {
+            'job_id': job_id,
+            'study_id': study_id,
+            'status': 'queued',
+            'stage': 'queued',
+            'progress': 0.0,
+            'error': None,
+            'result': None,
+            'created_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None
+        }
+
+        with self._lock:
+            self._prune()
+            self._jobs[job_id] = job
+            if study_id is not None:
+                self._study_jobs[study_id] = job_id
+
+        self._executor.submit(self._run, job_id, func, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, func, args, kwargs):
+        """Execute a job and record its outcome"""
+        self._set(job_id, status='running', started_at=datetime.now().isoformat())
+        try:
+            result = func(job_id, *args, **kwargs)
+            self._set(job_id, status='completed', stage='completed', progress=1.0, result=result,
+                      finished_at=datetime.now().isoformat())
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}")
+            self._set(job_id, status='failed', error=str(e), finished_at=datetime.now().isoformat())
+
+    def _prune(self):
+        """Drop the oldest finished jobs beyond max_finished (caller holds the lock)"""
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ('completed', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            job = self._jobs.pop(job_id)
+            if self._study_jobs.get(job['study_id']) == job_id:
+                del self._study_jobs[job['study_id']]
+
+    def _set(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def update(self, job_id, stage=None, progress=None):
+        """Report the current stage and fractional progress (0-1) of a job"""
+        fields = {}
+        if stage is not None:
+            fields['stage'] = stage
+        if progress is not None:
+            fields['progress'] = max(0.0, min(float(progress), 1.0))
+        self._set(job_id, **fields)
+
+    def get(self, job_id):
+        """Snapshot of a job's state, or None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def get_for_study(self, study_id):
+        """Snapshot of the latest job submitted for a study, or None"""
+        with self._lock:
+            job_id = self._study_jobs.get(study_id)
+            job = self._jobs.get(job_id) if job_id else None
+            return dict(job) if job is not None else None
+
+    def is_active(self, study_id):
+        """Whether a queued or running job exists for the study in this process"""
+        job = self.get_for_study(study_id)
+        return job is not None and job['status'] in ('queued', 'running')
+
+    def get_stats(self):
+        """Counts of jobs by status"""
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return {'max_workers': self.max_workers, 'jobs': counts}
@@ -0,0 +1,280 @@
+import os
+import json
+import logging
+import tempfile
+import numpy as np
+from services import volume_reader, mpr, mask_store
+
+logger = logging.getLogger(__name__)
+
+LABEL_FORMAT_VERSION = 2  # 2: structures (volumetrics and extents) in the label table
+LABELS_FILENAME = 'labels.npy'
+LABEL_TABLE_FILENAME = 'labels.json'
+QUANTIFY_SLAB_VOXELS = 1 << 22  # Label voxels read per quantification step
+
+def mask_files(seg_dir):
+    """Per-organ mask files of a segmentation output directory as {organ: path}"""
+    masks = {}
+    for filename in sorted(os.listdir(seg_dir)):
+        if filename.endswith('.nii.gz'):
+            masks[filename[:-len('.nii.gz')]] = os.path.join(seg_dir, filename)
+        elif filename.endswith('.nii'):
+            masks[filename[:-len('.nii')]] = os.path.join(seg_dir, filename)
+    return masks
+
+def label_ids(organs, task='total'):
+    """
+    Label value for each organ
+
+    TotalSegmentator's own class map is used when it is installed and
+    covers every organ, so label values match its multi-label output;
+    otherwise organs are numbered 1..N in name order.
+    """
+    try:
+        from totalsegmentator.map_to_binary import class_map
+        ids = {name: int(value) for value, name in class_map.get(task, {}).items()}
+        if ids and all(organ in ids for organ in organs):
+            return {organ: ids[organ] for organ in organs}
+    except ImportError:
+        pass
+    return {organ: index for index, organ in enumerate(sorted(organs), start=1)}
+
+def build_label_volume(seg_dir, task='total'):
+    """
+    Merge per-organ masks into one slice-major label volume
+
+    Writes labels.npy, a (slices, rows, columns) uint8 array (uint16 for more
+    than 255 labels) in the same layout as the slice store, and labels.json
+    with the label -> organ table, shape, affine and per-structure
+    volumetrics (see quantify_labels). Masks come from the directory's mask
+    store (only slices holding the organ are read) or are streamed slab by
+    slab from NIfTI files; where masks overlap, the higher label wins.
+
+    Args:
+        seg_dir: Segmentation output directory with a mask store or one mask file per organ
+        task: Segmentation task (selects the label numbering)
+
+    Returns:
+        dict with success status and the label table
+    """
+    store = mask_store.open_mask_store(seg_dir)
+    try:
+        if store is not None:
+            masks = None
+            organs = store.organs
+            shape, affine, spacing = store.shape, store.affine, store.header['spacing']
+        else:
+            masks = mask_files(seg_dir)
+            organs = list(masks)
+            if organs:
+                first = volume_reader.open_nifti(masks[organs[0]])
+                shape = volume_reader.get_shape(first)[:3]
+                affine = first.affine
+                spacing = [float(x) for x in first.header.get_zooms()[:3]]
+        if not organs:
+            return {'success': False, 'error': 'No masks to merge'}
+
+        ids = label_ids(organs, task)
+        dtype = np.dtype(np.uint8 if max(ids.values()) <= 255 else np.uint16)
+        store_shape = (shape[2], shape[0], shape[1]) if len(shape) == 3 else (1, shape[0], shape[1])
+
+        fd, tmp_path = tempfile.mkstemp(dir=seg_dir, prefix='.tmp_', suffix='.npy')
+        os.close(fd)
+        try:
+            labels = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=store_shape)
+            merged = {}
+            for organ in sorted(organs, key=ids.get):
+                value = dtype.type(ids[organ])
+                if store is not None:
+                    for k in store.occupied_slices(organ):
+                        np.copyto(labels[k], value, where=store.read_slice(organ, k))
+                else:
+                    img = volume_reader.open_nifti(masks[organ])
+                    if volume_reader.get_shape(img)[:3] != shape:
+                        logger.warning(f"Skipping mask {organ}: shape {volume_reader.get_shape(img)} != {shape}")
+                        continue
+                    for start, slab in volume_reader.iter_slabs(img):
+                        slab = slab[:, :, np.newaxis] if slab.ndim == 2 else slab
+                        np.copyto(labels[start:start + slab.shape[2]], value,
+                                  where=np.moveaxis(slab, 2, 0) != 0)
+                merged[str(ids[organ])] = organ
+            labels.flush()
+            spacing = [float(x) for x in spacing]
+            structures = quantify_labels(labels, merged, spacing, affine)
+            del labels
+            os.replace(tmp_path, os.path.join(seg_dir, LABELS_FILENAME))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        table = {
+            'format_version': LABEL_FORMAT_VERSION,
+            'task': task,
+            'dtype': dtype.name,
+            'shape': list(store_shape),
+            'affine': np.asarray(affine).tolist(),
+            'spacing': spacing,
+            'labels': merged,
+            'structures': structures
+        }
+        _write_json(os.path.join(seg_dir, LABEL_TABLE_FILENAME), table)
+        logger.info(f"Merged {len(merged)} masks into {LABELS_FILENAME} {store_shape} {dtype.name} in {seg_dir}")
+        return {'success': True, 'table': table}
+
+    except Exception as e:
+        logger.error(f"Error building label volume in {seg_dir}: {str(e)}")
+        return {'success': False, 'error': f'Label volume build failed: {str(e)}'}
+    finally:
+        if store is not None:
+            store.close()
+
+def quantify_labels(labels, label_names, spacing, affine):
+    """
+    Volumetrics and extents of every structure in a label volume
+
+    All structures are measured together: each slab of labels is read once,
+    and per-axis histograms of (label, voxel index) over its labelled voxels
+    are accumulated with np.bincount. Voxel counts, bounding boxes and
+    centroids all follow from the three histograms.
+
+    Args:
+        labels: (slices, rows, columns) label volume, i.e. voxel axes (k, i, j)
+        label_names: {label value (str): structure name}
+        spacing: Voxel (i, j, k) spacing in mm
+        affine: Voxel-to-world affine
+
+    Returns:
+        dict of structure name -> label, voxel count, volume in mL, voxel
+        bounding box (i, j, k), slice range per plane and centroid in voxel
+        and world (mm) coordinates; structures without voxels are omitted
+    """
+    depth, rows, columns = labels.shape
+    count = max(int(value) for value in label_names) + 1
+    hist_k = np.zeros(count * depth, dtype=np.int64)
+    hist_i = np.zeros(count * rows, dtype=np.int64)
+    hist_j = np.zeros(count * columns, dtype=np.int64)
+
+    step = max(1, QUANTIFY_SLAB_VOXELS // (rows * columns))
+    for start in range(0, depth, step):
+        slab = np.asarray(labels[start:start + step]).ravel()
+        flat = np.flatnonzero(slab)
+        if not flat.size:
+            continue
+        values = slab[flat].astype(np.intp)
+        k, within = np.divmod(flat, rows * columns)
+        i, j = np.divmod(within, columns)
+        hist_k += np.bincount(values * depth + k + start, minlength=count * depth)
+        hist_i += np.bincount(values * rows + i, minlength=count * rows)
+        hist_j += np.bincount(values * columns + j, minlength=count * columns)
+
+    hists = [hist_i.reshape(count, rows), hist_j.reshape(count, columns), hist_k.reshape(count, depth)]
+    voxels = hists[2].sum(axis=1)
+    firsts = np.stack([(h > 0).argmax(axis=1) for h in hists], axis=1)
+    lasts = np.stack([h.shape[1] - 1 - (h[:, ::-1] > 0).argmax(axis=1) for h in hists], axis=1)
+    sums = np.stack([h @ np.arange(h.shape[1]) for h in hists], axis=1)
+    centroids = sums / np.maximum(voxels, 1)[:, np.newaxis]
+    world = np.asarray(affine, dtype=np.float64)[:3] @ np.vstack([centroids.T, np.ones(count)])
+    voxel_ml = float(np.prod(spacing)) / 1000.0
+    shape = (rows, columns, depth)
+
+    structures = {}
+    for value, name in label_names.items():
+        label = int(value)
+        if not voxels[label]:
+            continue
+        first, last = firsts[label].tolist(), lasts[label].tolist()
+        structures[name] = {
+            'label': label,
+            'voxels': int(voxels[label]),
+            'volume_ml': round(float(voxels[label]) * voxel_ml, 3),
+            'bbox': {'min': first, 'max': last},
+            'slice_range': {plane: list(mpr.plane_slice_range(first, last, shape, affine, plane))
+                            for plane in mpr.PLANES},
+            'centroid_voxel': [round(float(x), 2) for x in centroids[label]],
+            'centroid_mm': [round(float(x), 2) for x in world[:, label]]
+        }
+    return structures
+
+def open_label_volume(seg_dir):
+    """
+    Memory-map a merged label volume
+
+    Returns:
+        tuple of (read-only (slices, rows, columns) memmap, label table), or
+        None if the directory has no current label volume
+    """
+    try:
+        with open(os.path.join(seg_dir, LABEL_TABLE_FILENAME)) as f:
+            table = json.load(f)
+        if table.get('format_version') != LABEL_FORMAT_VERSION:
+            return None
+        return np.load(os.path.join(seg_dir, LABELS_FILENAME), mmap_mode='r'), table
+    except (OSError, ValueError):
+        return None
+
+def plane_labels(labels, affine, plane=None):
+    """(slices, rows, columns) view of a (k, i, j) label volume in an MPR plane (None: as stored)"""
+    if plane is None:
+        return labels
+    # MPR views are defined on voxel axes (i, j, k)
+    return mpr.plane_view(labels.transpose(1, 2, 0), affine, plane)
+
+def read_label_slice(seg_dir, slice_index, plane=None):
+    """
+    One slice of labels
+
+    Axial slices of the stored layout are returned as a byte range of
+    labels.npy so they can be sent without copying; MPR plane slices are
+    read through a strided view.
+
+    Args:
+        seg_dir: Segmentation output directory
+        slice_index: Slice along the stored axis, or along the plane's axis
+        plane: None for the stored layout, else 'axial', 'coronal' or 'sagittal'
+
+    Returns:
+        dict with success status, dtype, shape, slice_count, the labels
+        present and either file_range (path, offset, length) or labels
+    """
+    opened = open_label_volume(seg_dir)
+    if opened is None:
+        return {'success': False, 'error': 'No label volume for this segmentation'}
+    labels, table = opened
+
+    if plane is not None:
+        if plane not in mpr.PLANES:
+            return {'success': False, 'error': f'Unknown plane {plane}'}
+        labels = plane_labels(labels, table['affine'], plane)
+
+    if not 0 <= slice_index < labels.shape[0]:
+        return {'success': False, 'error': f'Slice {slice_index} out of range (0-{labels.shape[0] - 1})'}
+
+    labels_slice = labels[slice_index]
+    result = {
+        'success': True,
+        'dtype': table['dtype'],
+        'shape': list(labels_slice.shape),
+        'slice_index': slice_index,
+        'slice_count': labels.shape[0],
+        'present': [int(x) for x in np.flatnonzero(np.bincount(labels_slice.ravel())) if x]
+    }
+    if plane is None:
+        length = labels_slice.nbytes
+        result['file_range'] = {'path': labels.filename, 'offset': labels.offset + slice_index * length,
+                                'length': length}
+    else:
+        result['labels'] = np.ascontiguousarray(labels_slice)
+    return result
+
+def _write_json(path, data):
+    """Replace a JSON file atomically"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
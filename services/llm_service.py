@@ -17,13 +17,14 @@ class LLMService:
         self.max_retries = 3
         self.retry_delay = 1.0
     
-    def analyze_segmentation(self, segmentation_data, analysis_request=""):
+    def analyze_segmentation(self, segmentation_data, analysis_request="", image_metadata=None):
         """
         Analyze segmentation results using LLM
         
         Args:
             segmentation_data: Dictionary containing segmentation results
             analysis_request: Specific analysis request from user
+            image_metadata: StudyMetadata record of the segmented image
         
         Returns:
             dict with analysis report and metadata
@@ -31,6 +32,9 @@ class LLMService:
         try:
             # Prepare context for LLM
             context = self._prepare_segmentation_context(segmentation_data)
+            image_context = self._prepare_image_context(image_metadata)
+            if image_context:
+                context = "\n".join(image_context + [context])
             
             # Create prompt
             if analysis_request:
@@ -166,6 +170,20 @@ class LLMService:
                 summary = segmentation_data['summary']
                 context_parts.append(f"Total Structures Identified: {summary.get('total_organs', 0)}")
             
+            # Measured volumes, largest first
+            structures = segmentation_data.get('structures')
+            if structures:
+                context_parts.append("Structure Volumes (from segmentation masks):")
+                ranked = sorted(structures.items(), key=lambda item: item[1]['volume_ml'], reverse=True)
+                for name, structure in ranked[:20]:
+                    first, last = structure['slice_range']['axial']
+                    context_parts.append(
+                        f"- {name}: {structure['volume_ml']:.1f} mL ({structure['voxels']} voxels), "
+                        f"axial slices {first}-{last}, centroid {structure['centroid_mm']} mm"
+                    )
+                if len(ranked) > 20:
+                    context_parts.append(f"... and {len(ranked) - 20} more measured structures")
+            
             # Processing information
             if segmentation_data.get('is_mock'):
                 context_parts.append("Note: This is mock/demonstration data for development purposes.")
@@ -189,6 +207,7 @@ class LLMService:
                 if study.description:
                     context_parts.append(f"Description: {study.description}")
                 context_parts.append(f"Processing Status: {study.processing_status}")
+                context_parts.extend(self._prepare_image_context(getattr(study, 'image_metadata', None)))
             
             if analysis:
                 context_parts.append(f"Analysis Type: {analysis.analysis_type}")
@@ -206,6 +225,25 @@ class LLMService:
             logger.error(f"Error preparing study context: {str(e)}")
             return "Error preparing study context."
     
+    def _prepare_image_context(self, image_metadata):
+        """Describe the stored image metadata (no file access) as context lines"""
+        if image_metadata is None:
+            return []
+        
+        context_parts = [f"Image Format: {image_metadata.format}"]
+        if image_metadata.dimensions:
+            context_parts.append(f"Image Dimensions: {' x '.join(str(d) for d in image_metadata.dimensions)}")
+        if image_metadata.voxel_spacing:
+            spacing = ' x '.join(f"{s:.2f}" for s in image_metadata.voxel_spacing)
+            context_parts.append(f"Voxel Spacing (mm): {spacing}")
+        if image_metadata.dtype:
+            context_parts.append(f"Data Type: {image_metadata.dtype}")
+        stats = image_metadata.intensity_stats or {}
+        if 'min' in stats and 'max' in stats:
+            context_parts.append(f"Intensity Range: {stats['min']:.1f} to {stats['max']:.1f} "
+                                 f"(mean {stats.get('mean', 0):.1f})")
+        return context_parts
+    
     def _summarize_analysis_results(self, result_data):
         """Create a brief summary of analysis results"""
         try:
@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import logging
+import argparse
+import tempfile
+import numpy as np
+import nibabel as nib
+from services import volume_reader
+
+logger = logging.getLogger(__name__)
+
+MASK_STORE_FILENAME = 'masks.rle'
+MASK_STORE_VERSION = 1
+MAGIC = b'MSKRLE01'
+FOOTER = struct.Struct('<QQ8s')  # index offset, header offset, magic
+COMPRESSION_LEVEL = 1  # Run lengths compress well even at the fastest level
+
+# Foreground flag of each run: runs alternate background, foreground, ...
+_RUN_VALUES = np.arange(1 << 20) % 2 == 1
+
+def encode_slice(mask_slice):
+    """
+    Run-length encode one 2D mask slice
+
+    Returns:
+        bytes: zlib-compressed little-endian uint32 run lengths of the
+        row-major slice, starting with a (possibly empty) background run;
+        b'' for an empty slice
+    """
+    flat = np.ascontiguousarray(mask_slice).ravel() != 0
+    edges = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    if not edges.size and not flat[0]:
+        return b''
+    runs = np.diff(edges, prepend=0, append=flat.size)
+    if flat[0]:
+        runs = np.concatenate([[0], runs])
+    return zlib.compress(runs.astype('<u4').tobytes(), COMPRESSION_LEVEL)
+
+def decode_slice(data, shape):
+    """Boolean 2D slice of the given shape from encode_slice output"""
+    if not data:
+        return np.zeros(shape, dtype=bool)
+    runs = np.frombuffer(zlib.decompress(data), dtype='<u4')
+    values = _RUN_VALUES[:runs.size] if runs.size <= _RUN_VALUES.size else np.arange(runs.size) % 2 == 1
+    return np.repeat(values, runs).reshape(shape)
+
+class MaskStore:
+    """
+    Read access to a run-length encoded mask file
+
+    The file holds every organ mask of one segmentation: the encoded slices,
+    then an index of slice offsets (organs x (slices + 1), uint64) and a JSON
+    header, located through a fixed-size footer. One slice is a single
+    positioned read plus a decode, without touching the rest of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size < len(MAGIC) + FOOTER.size:
+                raise ValueError(f'{path} is not a mask store')
+            index_offset, header_offset, magic = FOOTER.unpack(
+                os.pread(self._fd, FOOTER.size, size - FOOTER.size))
+            if magic != MAGIC or os.pread(self._fd, len(MAGIC), 0) != MAGIC:
+                raise ValueError(f'{path} is not a mask store')
+            self.header = json.loads(os.pread(self._fd, size - FOOTER.size - header_offset, header_offset))
+            if self.header.get('format_version') != MASK_STORE_VERSION:
+                raise ValueError(f"Unsupported mask store version {self.header.get('format_version')}")
+            self.organs = self.header['organs']
+            self.shape = tuple(self.header['shape'])
+            self.affine = np.array(self.header['affine'])
+            depth = self.shape[2]
+            index = os.pread(self._fd, header_offset - index_offset, index_offset)
+            self._index = np.frombuffer(index, dtype='<u8').reshape(len(self.organs), depth + 1)
+            self._rows = {organ: row for row, organ in enumerate(self.organs)}
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def read_slice(self, organ, slice_index):
+        """Boolean (rows, columns) mask of one organ on one axial voxel slice"""
+        offsets = self._index[self._rows[organ]]
+        start, stop = int(offsets[slice_index]), int(offsets[slice_index + 1])
+        return decode_slice(os.pread(self._fd, stop - start, start) if stop > start else b'', self.shape[:2])
+
+    def occupied_slices(self, organ):
+        """Indices of the slices where an organ has any voxel"""
+        return np.flatnonzero(np.diff(self._index[self._rows[organ]]))
+
+    def read_volume(self, organ):
+        """Boolean (i, j, k) mask volume of one organ"""
+        volume = np.zeros(self.shape, dtype=bool)
+        for k in self.occupied_slices(organ):
+            volume[:, :, k] = self.read_slice(organ, k)
+        return volume
+
+    def stored_bytes(self, organ):
+        """Encoded size of one organ's mask"""
+        offsets = self._index[self._rows[organ]]
+        return int(offsets[-1] - offsets[0])
+
+def write_mask_store(path, masks):
+    """
+    Encode NIfTI masks into one mask store
+
+    Masks are read slab by slab and written in order, so memory stays at one
+    slab whatever the number of organs. The file is written to a temporary
+    name and renamed into place.
+
+    Args:
+        path: Mask store file to write
+        masks: {organ: NIfTI mask path}; all masks must share one shape
+
+    Returns:
+        dict with success status, the organs stored and the bytes written
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp_', suffix='.rle')
+    try:
+        organs = sorted(masks)
+        first = volume_reader.open_nifti(masks[organs[0]])
+        shape = volume_reader.get_shape(first)[:3]
+        shape = tuple(shape) if len(shape) == 3 else (shape[0], shape[1], 1)
+        index = np.zeros((len(organs), shape[2] + 1), dtype='<u8')
+
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            for row, organ in enumerate(organs):
+                img = volume_reader.open_nifti(masks[organ])
+                organ_shape = volume_reader.get_shape(img)[:3]
+                if tuple(organ_shape) not in (shape, shape[:2]):
+                    raise ValueError(f'Mask {organ} has shape {organ_shape}, expected {shape}')
+                index[row, 0] = f.tell()
+                for start, slab in volume_reader.iter_slabs(img):
+                    slab = slab[:, :, np.newaxis] if slab.ndim == 2 else slab
+                    for offset in range(slab.shape[2]):
+                        f.write(encode_slice(slab[:, :, offset]))
+                        index[row, start + offset + 1] = f.tell()
+
+            index_offset = f.tell()
+            f.write(index.tobytes())
+            header_offset = f.tell()
+            f.write(json.dumps({
+                'format_version': MASK_STORE_VERSION,
+                'organs': organs,
+                'shape': list(shape),
+                'affine': first.affine.tolist(),
+                'spacing': [float(x) for x in first.header.get_zooms()[:3]]
+            }).encode('utf-8'))
+            f.write(FOOTER.pack(index_offset, header_offset, MAGIC))
+        os.replace(tmp_path, path)
+        return {'success': True, 'path': path, 'organs': organs, 'bytes': os.path.getsize(path)}
+
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        logger.error(f"Error writing mask store {path}: {str(e)}")
+        return {'success': False, 'error': f'Mask store write failed: {str(e)}'}
+
+def compact_masks(seg_dir, mask_paths):
+    """
+    Replace a segmentation's NIfTI masks by a mask store in the same directory
+
+    The NIfTI files are removed only once the store is complete.
+
+    Returns:
+        dict with success status and the bytes before and after
+    """
+    nifti_bytes = sum(os.path.getsize(p) for p in mask_paths.values())
+    stored = write_mask_store(os.path.join(seg_dir, MASK_STORE_FILENAME), mask_paths)
+    if not stored['success']:
+        return stored
+    for mask_path in mask_paths.values():
+        os.remove(mask_path)
+    logger.info(f"Compacted {len(mask_paths)} masks in {seg_dir}: {nifti_bytes} -> {stored['bytes']} bytes")
+    return dict(stored, nifti_bytes=nifti_bytes)
+
+def open_mask_store(seg_dir):
+    """MaskStore of a segmentation directory, or None if it has none"""
+    path = os.path.join(seg_dir, MASK_STORE_FILENAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        return MaskStore(path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Unreadable mask store {path}: {str(e)}")
+        return None
+
+def export_nifti(store, organ, out_path):
+    """Write one organ of a mask store back out as a uint8 NIfTI mask"""
+    img = nib.Nifti1Image(store.read_volume(organ).astype(np.uint8), store.affine)
+    img.header.set_zooms(store.header['spacing'])
+    nib.save(img, out_path)
+    return out_path
+
+def main(argv=None):
+    """Convert TotalSegmentator output to a mask store (or back) and time single-slice reads"""
+    parser = argparse.ArgumentParser(description='Run-length encoded segmentation mask store')
+    parser.add_argument('seg_dir', help='Segmentation output directory')
+    parser.add_argument('--export', metavar='DIR', help='Write every mask back out as NIfTI into DIR')
+    parser.add_argument('--keep-nifti', action='store_true', help='Keep the NIfTI masks after converting')
+    args = parser.parse_args(argv)
+
+    if args.export:
+        store = open_mask_store(args.seg_dir)
+        if store is None:
+            print(f'No mask store in {args.seg_dir}')
+            return 1
+        os.makedirs(args.export, exist_ok=True)
+        with store:
+            for organ in store.organs:
+                export_nifti(store, organ, os.path.join(args.export, f'{organ}.nii.gz'))
+        print(f'Exported {len(store.organs)} masks to {args.export}')
+        return 0
+
+    from services.label_volume import mask_files
+    masks = mask_files(args.seg_dir)
+    if not masks:
+        print(f'No NIfTI masks in {args.seg_dir}')
+        return 1
+    nifti_bytes = sum(os.path.getsize(p) for p in masks.values())
+    organ = max(masks, key=lambda name: os.path.getsize(masks[name]))
+    start = time.perf_counter()
+    img = volume_reader.open_nifti(masks[organ])
+    middle = volume_reader.get_shape(img)[2] // 2 if len(volume_reader.get_shape(img)) > 2 else 0
+    np.asanyarray(img.dataobj[..., middle] if middle else img.dataobj)
+    nifti_seconds = time.perf_counter() - start
+
+    if args.keep_nifti:
+        result = write_mask_store(os.path.join(args.seg_dir, MASK_STORE_FILENAME), masks)
+    else:
+        result = compact_masks(args.seg_dir, masks)
+    if not result['success']:
+        print(result['error'])
+        return 1
+
+    with MaskStore(result['path']) as store:
+        store.read_slice(organ, middle)
+        repeat = 1000
+        start = time.perf_counter()
+        for _ in range(repeat):
+            store.read_slice(organ, middle)
+        store_seconds = (time.perf_counter() - start) / repeat
+
+    print(f"{'':<12}{'bytes':>14}{'one slice':>14}")
+    print(f"{'nifti':<12}{nifti_bytes:>14}{nifti_seconds * 1e6:>12.0f}us")
+    print(f"{'mask store':<12}{result['bytes']:>14}{store_seconds * 1e6:>12.0f}us")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
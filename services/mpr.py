@@ -0,0 +1,93 @@
+import logging
+import numpy as np
+from nibabel import orientations
+
+logger = logging.getLogger(__name__)
+
+AXIAL = 'axial'
+CORONAL = 'coronal'
+SAGITTAL = 'sagittal'
+PLANES = (AXIAL, CORONAL, SAGITTAL)
+
+# Canonical RAS+ axes (0=R, 1=A, 2=S) as (slice axis, row axis, column axis) of each plane
+PLANE_AXES = {
+    AXIAL: (2, 1, 0),
+    CORONAL: (1, 2, 0),
+    SAGITTAL: (0, 2, 1)
+}
+
+def canonical_orientation(affine):
+    """
+    Orientation transform from voxel axes to the closest canonical RAS+ axes
+
+    Falls back to the identity when the affine is degenerate.
+    """
+    ornt = orientations.io_orientation(np.asarray(affine, dtype=np.float64))
+    if np.isnan(ornt).any():
+        logger.warning("Degenerate affine, using voxel axes as RAS")
+        ornt = np.array([[0, 1], [1, 1], [2, 1]], dtype=np.float64)
+    return ornt
+
+def plane_view(volume, affine, plane):
+    """
+    Slices of a plane in display orientation, as a view of the volume
+
+    Slices are numbered toward superior (axial), anterior (coronal) or
+    right (sagittal). Images follow the radiological convention: superior
+    or anterior at the top, patient right on the left of axial and coronal
+    images and anterior on the left of sagittal images.
+
+    Args:
+        volume: 3D array indexed by voxel axes (i, j, k)
+        affine: Voxel-to-world affine of the volume
+        plane: 'axial', 'coronal' or 'sagittal'
+
+    Returns:
+        array view (slices, rows, columns); no data is copied
+    """
+    canonical = orientations.apply_orientation(volume, canonical_orientation(affine))
+    # Rows run superior->inferior (anterior->posterior for axial), columns right->left
+    # (anterior->posterior for sagittal); slices keep the canonical direction
+    slice_axis, row_axis, column_axis = PLANE_AXES[plane]
+    flips = [slice(None)] * 3
+    flips[row_axis] = slice(None, None, -1)
+    flips[column_axis] = slice(None, None, -1)
+    return canonical[tuple(flips)].transpose(slice_axis, row_axis, column_axis)
+
+def plane_shape(shape, affine, plane):
+    """(slices, rows, columns) of a plane for a volume of the given voxel shape"""
+    canonical = _canonical_values(shape[:3], affine)
+    return tuple(int(canonical[axis]) for axis in PLANE_AXES[plane])
+
+def plane_spacing(zooms, affine, plane):
+    """(slice, row, column) spacing in mm of a plane"""
+    canonical = _canonical_values(zooms[:3], affine)
+    return tuple(float(canonical[axis]) for axis in PLANE_AXES[plane])
+
+def plane_slice_range(first, last, shape, affine, plane):
+    """
+    Slices of a plane covering a voxel bounding box
+
+    Args:
+        first: Lowest (i, j, k) voxel index of the box
+        last: Highest (i, j, k) voxel index of the box
+        shape: Voxel shape of the volume
+        affine: Voxel-to-world affine of the volume
+        plane: 'axial', 'coronal' or 'sagittal'
+
+    Returns:
+        (first slice, last slice) in the plane's slice numbering
+    """
+    ornt = canonical_orientation(affine)
+    axis = int(np.flatnonzero(ornt[:, 0] == PLANE_AXES[plane][0])[0])
+    if ornt[axis, 1] < 0:
+        return int(shape[axis] - 1 - last[axis]), int(shape[axis] - 1 - first[axis])
+    return int(first[axis]), int(last[axis])
+
+def _canonical_values(values, affine):
+    """Per-voxel-axis values (shape, zooms) reordered to canonical axes"""
+    ornt = canonical_orientation(affine)
+    canonical = [0] * 3
+    for axis, (target, _) in enumerate(ornt):
+        canonical[int(target)] = values[axis]
+    return canonical
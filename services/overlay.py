@@ -0,0 +1,126 @@
+import os
+import logging
+import cv2
+import numpy as np
+from services import label_volume
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ALPHA = 0.4
+PALETTE_VERSION = 'v1'  # Part of rendered tile keys; bump when the colours change
+
+def _build_palette(size=1 << 16):
+    """Label -> RGB lookup table: hues 137 degrees apart, so neighbouring labels differ clearly"""
+    hls = np.empty((1, size, 3), dtype=np.uint8)
+    hls[0, :, 0] = (np.arange(size) * 137) % 360 // 2  # 8-bit OpenCV hue is degrees / 2
+    hls[0, :, 1] = 140  # Lightness 55%
+    hls[0, :, 2] = 217  # Saturation 85%
+    palette = cv2.cvtColor(hls, cv2.COLOR_HLS2RGB)[0]
+    palette[0] = 0
+    return palette
+
+PALETTE = _build_palette()
+
+def label_rgb(label):
+    """Overlay colour of a label as an (r, g, b) tuple"""
+    return tuple(int(x) for x in PALETTE[label])
+
+def composite(image, labels, alpha=DEFAULT_ALPHA, selected=None):
+    """
+    Blend coloured labels into a display image
+
+    One pass over the slice: labels are mapped through the palette, the
+    whole image is blended with cv2.addWeighted and the blend is kept where
+    a selected label is present.
+
+    Args:
+        image: 8-bit grayscale (rows, columns) or RGB(A) image
+        labels: Integer label slice of the same rows and columns
+        alpha: Overlay opacity 0-1
+        selected: Boolean lookup table of labels to draw (None: every label)
+
+    Returns:
+        uint8 (rows, columns, 3) RGB image
+    """
+    if image.ndim == 2:
+        rgb = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    else:
+        rgb = np.ascontiguousarray(image[..., :3])
+    # np.take and cv2.copyTo are several times faster here than fancy indexing and np.copyto
+    mask = labels != 0 if selected is None else np.take(selected, labels)
+    if not mask.any():
+        return rgb
+    blended = cv2.addWeighted(rgb, 1.0 - alpha, np.take(PALETTE, labels, axis=0), alpha, 0.0)
+    return cv2.copyTo(blended, mask.view(np.uint8), rgb)
+
+class LabelOverlay:
+    """
+    Segmentation labels to blend into rendered slices of one study
+
+    Args:
+        seg_dir: Segmentation output directory with a label volume
+        organs: Organ names to draw (None: all of them)
+        alpha: Overlay opacity 0-1
+
+    Raises:
+        ValueError: if the directory has no label volume, an organ is not
+            part of the segmentation or alpha is out of range
+    """
+
+    def __init__(self, seg_dir, organs=None, alpha=DEFAULT_ALPHA):
+        opened = label_volume.open_label_volume(seg_dir)
+        if opened is None:
+            raise ValueError('Segmentation has no label volume')
+        if not 0.0 <= alpha <= 1.0:
+            raise ValueError('Overlay alpha must be between 0 and 1')
+        self.labels, table = opened
+        self.affine = table['affine']
+        self.alpha = float(alpha)
+        self.seg_dir = seg_dir
+
+        ids = {organ: int(label) for label, organ in table['labels'].items()}
+        self.selected = None
+        self.organs = None
+        if organs:
+            unknown = [organ for organ in organs if organ not in ids]
+            if unknown:
+                raise ValueError(f"Not in this segmentation: {', '.join(unknown)}")
+            self.organs = sorted(set(organs))
+            self.selected = np.zeros(max(ids.values()) + 1, dtype=bool)
+            self.selected[[ids[organ] for organ in self.organs]] = True
+
+    def cache_params(self):
+        """Tile key parameters that identify this overlay's rendering"""
+        return {
+            'overlay': os.path.basename(os.path.normpath(self.seg_dir)),
+            'organs': ','.join(self.organs) if self.organs else '*',
+            'alpha': round(self.alpha, 3),
+            'palette': PALETTE_VERSION
+        }
+
+    def fits(self, plane, grid):
+        """Whether the labels have a study's (slices, rows, columns) voxel grid in a plane"""
+        return tuple(label_volume.plane_labels(self.labels, self.affine, plane).shape) == tuple(grid)
+
+    def label_slice(self, slice_index, plane, shape):
+        """
+        Labels of a slice at the size of its rendered image
+
+        Rendered MPR slices are stretched along their rows for square
+        pixels, so the labels are resized (nearest neighbour) to match.
+        Like the renderers, no slice index means the middle slice.
+        """
+        slices = label_volume.plane_labels(self.labels, self.affine, plane)
+        if slice_index is None:
+            slice_index = slices.shape[0] // 2
+        slice_index = max(0, min(int(slice_index), slices.shape[0] - 1))
+        labels = np.asarray(slices[slice_index])
+        if labels.shape[1] != shape[1]:
+            raise ValueError(f'Segmentation slice {labels.shape} does not match the image {tuple(shape[:2])}')
+        if labels.shape[0] != shape[0]:
+            labels = cv2.resize(labels, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+        return labels
+
+    def apply(self, image, slice_index, plane=None):
+        """Blend this overlay into one rendered (full resolution) slice"""
+        return composite(image, self.label_slice(slice_index, plane, image.shape), self.alpha, self.selected)
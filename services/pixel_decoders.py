@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+import numpy as np
+import pydicom
+from pydicom import uid
+from pydicom.pixels import get_decoder, pixel_array
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLUGIN = ''  # Let pydicom try its plugins in its own order
+
+# Shipped preference order per compressed transfer syntax, fastest first.
+# A measured table (see main) overrides these for the syntaxes it covers.
+DEFAULT_PREFERENCES = {
+    uid.JPEGBaseline8Bit: ('pylibjpeg', 'gdcm', 'pillow'),
+    uid.JPEGExtended12Bit: ('pylibjpeg', 'gdcm', 'pillow'),
+    uid.JPEGLossless: ('pylibjpeg', 'gdcm'),
+    uid.JPEGLosslessSV1: ('pylibjpeg', 'gdcm'),
+    uid.JPEGLSLossless: ('pyjpegls', 'pylibjpeg', 'gdcm'),
+    uid.JPEGLSNearLossless: ('pyjpegls', 'pylibjpeg', 'gdcm'),
+    uid.JPEG2000Lossless: ('pylibjpeg', 'gdcm', 'pillow'),
+    uid.JPEG2000: ('pylibjpeg', 'gdcm', 'pillow'),
+    uid.HTJ2KLossless: ('pylibjpeg',),
+    uid.HTJ2KLosslessRPCL: ('pylibjpeg',),
+    uid.HTJ2K: ('pylibjpeg',),
+    uid.RLELossless: ('pylibjpeg', 'pydicom')
+}
+
+def transfer_syntax_of(ds):
+    """Transfer syntax UID of a dataset (implicit VR little endian if unspecified)"""
+    file_meta = getattr(ds, 'file_meta', None)
+    transfer_syntax = file_meta.get('TransferSyntaxUID') if file_meta is not None else None
+    return uid.UID(str(transfer_syntax)) if transfer_syntax else uid.ImplicitVRLittleEndian
+
+class DecoderSelector:
+    """
+    Picks the pixel-data decoding plugin for each transfer syntax
+
+    The choice is the measured fastest plugin from a decoder table when one
+    has been written for this machine, otherwise the first installed plugin
+    in DEFAULT_PREFERENCES. Uncompressed syntaxes need no plugin. Decode
+    times are accumulated per transfer syntax and plugin.
+    """
+
+    def __init__(self, table_path=None):
+        self.table = {}
+        self._choices = {}
+        self._stats = defaultdict(lambda: {'frames': 0, 'seconds': 0.0, 'failures': 0})
+        self._lock = threading.Lock()
+        if table_path:
+            self.load_table(table_path)
+
+    def load_table(self, table_path):
+        """Load measured plugin choices written by the benchmark (missing file is not an error)"""
+        if not os.path.exists(table_path):
+            return
+        try:
+            with open(table_path) as f:
+                table = json.load(f)
+            with self._lock:
+                self.table = {uid.UID(ts): entry['plugin'] for ts, entry in table.items()}
+                self._choices = {}
+            logger.info(f"Loaded pixel decoder table {table_path} ({len(self.table)} transfer syntaxes)")
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable pixel decoder table {table_path}: {str(e)}")
+
+    def plugin_for(self, transfer_syntax):
+        """
+        Decoding plugin to use for a transfer syntax
+
+        Returns:
+            Plugin name, or DEFAULT_PLUGIN for uncompressed or unknown syntaxes
+        """
+        transfer_syntax = uid.UID(str(transfer_syntax))
+        with self._lock:
+            if transfer_syntax in self._choices:
+                return self._choices[transfer_syntax]
+
+        available = available_plugins(transfer_syntax)
+        measured = self.table.get(transfer_syntax)
+        if measured in available:
+            choice = measured
+        else:
+            choice = next((name for name in DEFAULT_PREFERENCES.get(transfer_syntax, ()) if name in available),
+                          DEFAULT_PLUGIN)
+
+        with self._lock:
+            self._choices[transfer_syntax] = choice
+        return choice
+
+    def decode(self, ds, plugin=None):
+        """
+        Decode a dataset's pixel data with the selected plugin
+
+        Falls back to pydicom's own plugin order if the selected plugin fails.
+
+        Args:
+            ds: pydicom Dataset with pixel data
+            plugin: Plugin to use instead of the selected one
+
+        Returns:
+            tuple of (pixel array, dict with transfer_syntax, plugin and seconds)
+        """
+        transfer_syntax = transfer_syntax_of(ds)
+        if plugin is None:
+            plugin = self.plugin_for(transfer_syntax)
+
+        start = time.perf_counter()
+        try:
+            pixels = pixel_array(ds, decoding_plugin=plugin)
+        except Exception as e:
+            if plugin == DEFAULT_PLUGIN:
+                self._record(transfer_syntax, plugin, 0, 0.0, failed=True)
+                raise
+            logger.warning(f"{plugin} could not decode {transfer_syntax.name}, using pydicom's default: {str(e)}")
+            self._record(transfer_syntax, plugin, 0, 0.0, failed=True)
+            plugin = DEFAULT_PLUGIN
+            start = time.perf_counter()
+            pixels = pixel_array(ds, decoding_plugin=plugin)
+        elapsed = time.perf_counter() - start
+
+        frames = int(ds.get('NumberOfFrames', 1) or 1)
+        self._record(transfer_syntax, plugin, frames, elapsed)
+        return pixels, {
+            'transfer_syntax': transfer_syntax.name,
+            'plugin': plugin or 'default',
+            'frames': frames,
+            'seconds': elapsed
+        }
+
+    def _record(self, transfer_syntax, plugin, frames, seconds, failed=False):
+        with self._lock:
+            stats = self._stats[(transfer_syntax.name, plugin or 'default')]
+            stats['frames'] += frames
+            stats['seconds'] += seconds
+            stats['failures'] += int(failed)
+
+    def get_stats(self):
+        """Decoded frames, total seconds and failures per transfer syntax and plugin"""
+        with self._lock:
+            return {
+                f'{syntax} / {plugin}': dict(stats, ms_per_frame=(1000.0 * stats['seconds'] / stats['frames']
+                                                                  if stats['frames'] else None))
+                for (syntax, plugin), stats in self._stats.items()
+            }
+
+def available_plugins(transfer_syntax):
+    """Installed decoding plugins for a transfer syntax (empty if uncompressed or unsupported)"""
+    try:
+        decoder = get_decoder(transfer_syntax)
+    except NotImplementedError:
+        return ()
+    if decoder.is_native:
+        return ()
+    return tuple(decoder.available_plugins)
+
+# Shared by every caller in the process; routes load the measured table at startup
+selector = DecoderSelector()
+
+def decode(ds, plugin=None):
+    """Decode pixel data through the shared selector (see DecoderSelector.decode)"""
+    return selector.decode(ds, plugin)
+
+def benchmark(paths, repeat=3):
+    """
+    Time every installed plugin on each compressed file
+
+    Returns:
+        dict of transfer syntax UID to {plugin: median seconds per frame}
+    """
+    samples = defaultdict(lambda: defaultdict(list))
+    for path in paths:
+        try:
+            ds = pydicom.dcmread(path)
+        except Exception as e:
+            logger.debug(f"Skipping {path}: {str(e)}")
+            continue
+        if 'PixelData' not in ds:
+            continue
+        transfer_syntax = transfer_syntax_of(ds)
+        frames = int(ds.get('NumberOfFrames', 1) or 1)
+        for plugin in available_plugins(transfer_syntax):
+            for _ in range(repeat):
+                start = time.perf_counter()
+                try:
+                    pixel_array(ds, decoding_plugin=plugin)
+                except Exception as e:
+                    logger.debug(f"{plugin} failed on {path}: {str(e)}")
+                    break
+                samples[transfer_syntax][plugin].append((time.perf_counter() - start) / frames)
+
+    return {
+        transfer_syntax: {plugin: float(np.median(times)) for plugin, times in plugins.items()}
+        for transfer_syntax, plugins in samples.items()
+    }
+
+def write_table(results, table_path):
+    """Atomically save the fastest plugin per transfer syntax"""
+    table = {
+        str(transfer_syntax): {
+            'name': transfer_syntax.name,
+            'plugin': min(timings, key=timings.get),
+            'seconds_per_frame': timings
+        }
+        for transfer_syntax, timings in results.items() if timings
+    }
+    directory = os.path.dirname(table_path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(table, f, indent=2)
+    os.replace(tmp_path, table_path)
+    return table
+
+def main(argv=None):
+    """Benchmark decoding plugins over a directory of DICOM files"""
+    parser = argparse.ArgumentParser(description='Benchmark pixel-data decoders per transfer syntax')
+    parser.add_argument('directory', help='Directory of DICOM sample files (searched recursively)')
+    parser.add_argument('--repeat', type=int, default=3, help='Decodes per file and plugin')
+    parser.add_argument('--write-table', metavar='PATH',
+                        help='Save the fastest plugin per transfer syntax (e.g. instance/decoder_table.json)')
+    args = parser.parse_args(argv)
+
+    paths = [os.path.join(root, name) for root, _, names in os.walk(args.directory) for name in sorted(names)]
+    results = benchmark(paths, repeat=args.repeat)
+    if not results:
+        print('No compressed DICOM files with an installed decoder found')
+        return 1
+
+    print(f"{'transfer syntax':<48}{'plugin':<12}{'ms/frame':>10}")
+    for transfer_syntax, timings in results.items():
+        for plugin, seconds in sorted(timings.items(), key=lambda item: item[1]):
+            print(f"{transfer_syntax.name[:46]:<48}{plugin:<12}{seconds * 1000:>10.2f}")
+    if args.write_table:
+        write_table(results, args.write_table)
+        print(f"Wrote {args.write_table}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
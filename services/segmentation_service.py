@@ -1,39 +1,59 @@
 import os
 import logging
-import subprocess
 import json
 import time
+import uuid
 from datetime import datetime
 import tempfile
 import shutil
+from services.segmentation_worker import SegmentationWorker, totalsegmentator_installed
+from services import label_volume, mask_store, contour_store
 
 logger = logging.getLogger(__name__)
 
+RESULT_MANIFEST = 'segmentation.json'  # Written last; marks a complete result
+
 class SegmentationService:
     """Service for medical image segmentation using TotalSegmentator"""
     
-    def __init__(self):
+    def __init__(self, backend='auto', max_jobs_per_worker=50, job_timeout=600, backend_options=None,
+                 contour_tolerance=contour_store.DEFAULT_TOLERANCE):
         self.supported_formats = ['.dcm', '.nii', '.nii.gz']
         self.totalsegmentator_available = self._check_totalsegmentator()
+        
+        if backend == 'auto':
+            backend = 'totalsegmentator' if self.totalsegmentator_available else 'standin'
+        self.backend = backend
+        self.contour_tolerance = contour_tolerance
+        
+        # Started lazily on the first job, then kept warm between studies
+        self.worker = SegmentationWorker(
+            backend=backend,
+            backend_options=backend_options,
+            max_jobs=max_jobs_per_worker,
+            job_timeout=job_timeout
+        )
     
     def _check_totalsegmentator(self):
-        """Check if TotalSegmentator is available"""
-        try:
-            result = subprocess.run(['TotalSegmentator', '--help'], 
-                                  capture_output=True, text=True, timeout=10)
-            return result.returncode == 0
-        except (subprocess.TimeoutExpired, FileNotFoundError, Exception) as e:
-            logger.warning(f"TotalSegmentator not available: {str(e)}")
-            return False
+        """Check if TotalSegmentator is installed (without launching it)"""
+        available = totalsegmentator_installed()
+        if not available:
+            logger.warning("TotalSegmentator not available, using stand-in segmentation backend")
+        return available
     
-    def segment_image(self, input_path, output_dir=None, task='total'):
+    def segment_image(self, input_path, output_dir=None, task='total', content_hash=None):
         """
-        Segment medical image using TotalSegmentator
+        Segment medical image on the persistent segmentation worker
+        
+        When the content hash is known, results are stored under
+        (content hash, task, backend version) and an existing result for the
+        same tuple is returned without running the model again.
         
         Args:
             input_path: Path to input medical image
             output_dir: Directory to save segmentation results
             task: Segmentation task (total, lung_vessels, covid, etc.)
+            content_hash: SHA-256 of the input file content
         
         Returns:
             dict with success status and result data
@@ -41,69 +61,60 @@ class SegmentationService:
         try:
             start_time = time.time()
             
-            if not self.totalsegmentator_available:
-                return self._mock_segmentation(input_path, output_dir)
-            
             # Create output directory if not provided
             if output_dir is None:
                 output_dir = tempfile.mkdtemp(prefix='segmentation_')
             else:
                 os.makedirs(output_dir, exist_ok=True)
             
+            result_dir = self.get_result_dir(output_dir, content_hash, task)
+            if result_dir is not None and os.path.exists(os.path.join(result_dir, RESULT_MANIFEST)):
+                logger.info(f"Reusing segmentation {result_dir} for {input_path}")
+                os.utime(os.path.join(result_dir, RESULT_MANIFEST))  # Keeps it from the age cleanup
+                return self._build_result(result_dir, task, start_time, reused=True)
+            
             # Create unique output subdirectory
             timestamp = str(int(datetime.now().timestamp()))
-            seg_output_dir = os.path.join(output_dir, f'segmentation_{timestamp}')
+            seg_output_dir = os.path.join(output_dir, f'segmentation_{timestamp}_{uuid.uuid4().hex[:8]}')
             os.makedirs(seg_output_dir, exist_ok=True)
             
-            # Run TotalSegmentator
-            cmd = [
-                'TotalSegmentator',
-                '-i', input_path,
-                '-o', seg_output_dir,
-                '--task', task,
-                '--ml',  # Use machine learning mode
-                '--quiet'  # Suppress verbose output
-            ]
-            
-            logger.info(f"Running TotalSegmentator: {' '.join(cmd)}")
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=600,  # 10 minute timeout
-                cwd=os.getcwd()
-            )
+            logger.info(f"Segmenting {input_path} with {self.backend} backend (task {task})")
             
-            processing_time = time.time() - start_time
+            result = self.worker.run_job(input_path, seg_output_dir, task)
             
-            if result.returncode != 0:
-                logger.error(f"TotalSegmentator failed: {result.stderr}")
+            if not result['success']:
+                logger.error(f"Segmentation failed: {result['error']}")
+                shutil.rmtree(seg_output_dir, ignore_errors=True)
                 return {
                     'success': False,
-                    'error': f'Segmentation failed: {result.stderr}',
-                    'processing_time': processing_time
+                    'error': f"Segmentation failed: {result['error']}",
+                    'processing_time': time.time() - start_time
                 }
             
-            # Parse segmentation results
-            segmentation_data = self._parse_segmentation_results(seg_output_dir)
+            self.compact_masks(seg_output_dir)
             
-            return {
-                'success': True,
-                'data': segmentation_data,
-                'output_path': seg_output_dir,
-                'processing_time': processing_time,
-                'task': task,
-                'confidence': 0.85  # TotalSegmentator typical confidence
-            }
+            # One label volume for overlays instead of a gzip file per organ
+            merged = label_volume.build_label_volume(seg_output_dir, task)
+            if not merged['success']:
+                logger.warning(f"Segmentation {seg_output_dir} has no label volume: {merged['error']}")
+            else:
+                # Outlines for vector overlays, traced once per slice and plane
+                contour_store.build_contours(seg_output_dir, self.contour_tolerance)
+            
+            with open(os.path.join(seg_output_dir, RESULT_MANIFEST), 'w') as f:
+                json.dump({
+                    'content_sha256': content_hash,
+                    'task': task,
+                    'backend': self.backend,
+                    'backend_version': result.get('backend_version'),
+                    'created_at': datetime.now().isoformat()
+                }, f)
+            
+            if result_dir is not None:
+                seg_output_dir = self._publish_result(seg_output_dir, result_dir)
+            
+            return self._build_result(seg_output_dir, task, start_time)
             
-        except subprocess.TimeoutExpired:
-            logger.error(f"TotalSegmentator timeout for {input_path}")
-            return {
-                'success': False,
-                'error': 'Segmentation timeout (>10 minutes)',
-                'processing_time': time.time() - start_time
-            }
         except Exception as e:
             logger.error(f"Segmentation error for {input_path}: {str(e)}")
             return {
@@ -112,6 +123,83 @@ class SegmentationService:
                 'processing_time': time.time() - start_time if 'start_time' in locals() else 0
             }
     
+    def get_result_dir(self, output_dir, content_hash, task='total'):
+        """Reusable result directory for (content hash, task, backend version), or None"""
+        backend_version = self.worker.get_backend_version()
+        if not content_hash or not backend_version:
+            return None
+        return os.path.join(output_dir, f'segmentation_{content_hash}_{task}_{backend_version}')
+    
+    def _publish_result(self, seg_output_dir, result_dir):
+        """Move a finished result to its reusable location (first writer wins)"""
+        try:
+            os.rename(seg_output_dir, result_dir)
+            return result_dir
+        except OSError:
+            if os.path.exists(os.path.join(result_dir, RESULT_MANIFEST)):
+                # A concurrent job for the same content finished first
+                shutil.rmtree(seg_output_dir, ignore_errors=True)
+                return result_dir
+            return seg_output_dir
+    
+    def _build_result(self, seg_output_dir, task, start_time, reused=False):
+        """Assemble the segment_image result for a finished output directory"""
+        with open(os.path.join(seg_output_dir, RESULT_MANIFEST)) as f:
+            manifest = json.load(f)
+        self.compact_masks(seg_output_dir)
+        if self.ensure_label_volume(seg_output_dir, task):
+            self.ensure_contours(seg_output_dir)
+        
+        # Parse segmentation results
+        segmentation_data = self._parse_segmentation_results(seg_output_dir)
+        segmentation_data['backend'] = manifest.get('backend_version')
+        is_mock = manifest.get('backend') == 'standin'
+        if is_mock:
+            segmentation_data['is_mock'] = True
+        
+        return {
+            'success': True,
+            'data': segmentation_data,
+            'output_path': seg_output_dir,
+            'processing_time': time.time() - start_time,
+            'task': task,
+            'confidence': 0.75 if is_mock else 0.85,  # Lower confidence for stand-in output
+            'is_mock': is_mock,
+            'reused': reused
+        }
+    
+    def compact_masks(self, seg_output_dir):
+        """Replace per-organ NIfTI masks by a run-length encoded mask store (kept on failure)"""
+        masks = label_volume.mask_files(seg_output_dir)
+        if not masks or os.path.exists(os.path.join(seg_output_dir, mask_store.MASK_STORE_FILENAME)):
+            return
+        compacted = mask_store.compact_masks(seg_output_dir, masks)
+        if not compacted['success']:
+            logger.warning(f"Keeping NIfTI masks in {seg_output_dir}: {compacted['error']}")
+    
+    def ensure_label_volume(self, seg_output_dir, task=None):
+        """Merge the masks of a result written before label volumes existed; True if one exists"""
+        if label_volume.open_label_volume(seg_output_dir) is not None:
+            return True
+        if task is None:
+            try:
+                with open(os.path.join(seg_output_dir, RESULT_MANIFEST)) as f:
+                    task = json.load(f).get('task', 'total')
+            except (OSError, ValueError):
+                task = 'total'
+        return label_volume.build_label_volume(seg_output_dir, task)['success']
+    
+    def ensure_contours(self, seg_output_dir):
+        """Trace contours at the configured tolerance unless they exist; True if they do"""
+        header = contour_store.read_header(seg_output_dir)
+        if header is not None and header['tolerance'] == self.contour_tolerance:
+            return True
+        return contour_store.build_contours(seg_output_dir, self.contour_tolerance)['success']
+    
+    def get_worker_stats(self):
+        """Get persistent segmentation worker statistics"""
+        return self.worker.get_stats()
+    
     def _parse_segmentation_results(self, output_dir):
         """Parse TotalSegmentator output and extract relevant information"""
         try:
@@ -122,8 +210,19 @@ class SegmentationService:
                 'files': []
             }
             
-            # Look for segmented organ files
-            if os.path.exists(output_dir):
+            # Organ masks live in the mask store; older results have one file per organ
+            store = mask_store.open_mask_store(output_dir)
+            if store is not None:
+                with store:
+                    for organ in store.organs:
+                        segmentation_data['segmented_organs'].append(organ)
+                        segmentation_data['files'].append({
+                            'organ': organ,
+                            'filename': mask_store.MASK_STORE_FILENAME,
+                            'path': store.path,
+                            'size': store.stored_bytes(organ)
+                        })
+            elif os.path.exists(output_dir):
                 for filename in os.listdir(output_dir):
                     if filename.endswith('.nii.gz') or filename.endswith('.nii'):
                         organ_name = os.path.splitext(filename)[0]
@@ -141,12 +240,27 @@ class SegmentationService:
                             'size': file_size
                         })
             
+            opened = label_volume.open_label_volume(output_dir)
+            if opened is not None:
+                table = opened[1]
+                segmentation_data['label_volume'] = {
+                    'path': os.path.join(output_dir, label_volume.LABELS_FILENAME),
+                    'dtype': table['dtype'],
+                    'shape': table['shape'],
+                    'labels': table['labels']
+                }
+                # Volumetrics, extents and slice ranges measured when the labels were merged
+                segmentation_data['structures'] = table['structures']
+            
             # Generate summary statistics
             segmentation_data['summary'] = {
                 'total_organs': len(segmentation_data['segmented_organs']),
                 'organs_found': segmentation_data['segmented_organs'][:10],  # Top 10 for display
                 'total_files': len(segmentation_data['files'])
             }
+            if 'structures' in segmentation_data:
+                segmentation_data['summary']['total_volume_ml'] = round(
+                    sum(s['volume_ml'] for s in segmentation_data['structures'].values()), 3)
             
             return segmentation_data
             
@@ -159,78 +273,10 @@ class SegmentationService:
                 'files': []
             }
     
-    def _mock_segmentation(self, input_path, output_dir):
-        """
-        Mock segmentation for development/testing when TotalSegmentator is not available
-        """
-        logger.info("Using mock segmentation (TotalSegmentator not available)")
-        
-        try:
-            # Create mock output directory
-            if output_dir is None:
-                output_dir = tempfile.mkdtemp(prefix='mock_segmentation_')
-            else:
-                os.makedirs(output_dir, exist_ok=True)
-            
-            timestamp = str(int(datetime.now().timestamp()))
-            seg_output_dir = os.path.join(output_dir, f'mock_segmentation_{timestamp}')
-            os.makedirs(seg_output_dir, exist_ok=True)
-            
-            # Create mock segmentation data
-            mock_organs = [
-                'liver', 'spleen', 'left_kidney', 'right_kidney', 
-                'stomach', 'gallbladder', 'pancreas', 'left_lung', 'right_lung'
-            ]
-            
-            # Create mock result files (empty files for demonstration)
-            mock_files = []
-            for organ in mock_organs:
-                mock_file = os.path.join(seg_output_dir, f"{organ}.nii.gz")
-                with open(mock_file, 'wb') as f:
-                    f.write(b'mock_segmentation_data')  # Minimal mock data
-                
-                mock_files.append({
-                    'organ': organ,
-                    'filename': f"{organ}.nii.gz",
-                    'path': mock_file,
-                    'size': os.path.getsize(mock_file)
-                })
-            
-            segmentation_data = {
-                'timestamp': datetime.now().isoformat(),
-                'output_directory': seg_output_dir,
-                'segmented_organs': mock_organs,
-                'files': mock_files,
-                'summary': {
-                    'total_organs': len(mock_organs),
-                    'organs_found': mock_organs,
-                    'total_files': len(mock_files)
-                },
-                'is_mock': True
-            }
-            
-            return {
-                'success': True,
-                'data': segmentation_data,
-                'output_path': seg_output_dir,
-                'processing_time': 2.5,  # Mock processing time
-                'task': 'total',
-                'confidence': 0.75,  # Lower confidence for mock
-                'is_mock': True
-            }
-            
-        except Exception as e:
-            logger.error(f"Mock segmentation error: {str(e)}")
-            return {
-                'success': False,
-                'error': f'Mock segmentation failed: {str(e)}',
-                'processing_time': 0
-            }
-    
     def get_available_tasks(self):
         """Get list of available segmentation tasks"""
-        if not self.totalsegmentator_available:
-            return ['total']  # Mock task
+        if self.backend != 'totalsegmentator':
+            return ['total']  # Stand-in backend only produces the total task
         
         try:
             # TotalSegmentator available tasks
@@ -281,19 +327,33 @@ class SegmentationService:
             return os.path.splitext(file_path.lower())[1]
     
     def cleanup_old_results(self, output_dir, days=7):
-        """Clean up old segmentation results"""
+        """
+        Remove segmentation result directories not produced or reused for days
+        
+        Results go as a whole: a directory with some of its files missing
+        would still look like a result to the viewer routes.
+        
+        Returns:
+            list of removed result directories
+        """
+        removed = []
         try:
             if not os.path.exists(output_dir):
-                return
+                return removed
             
             cutoff_time = time.time() - (days * 24 * 60 * 60)
             
             for item in os.listdir(output_dir):
                 item_path = os.path.join(output_dir, item)
                 if os.path.isdir(item_path) and item.startswith('segmentation_'):
-                    if os.path.getctime(item_path) < cutoff_time:
+                    # Reuse touches the manifest, so shared results stay while in use
+                    manifest_path = os.path.join(item_path, RESULT_MANIFEST)
+                    age_path = manifest_path if os.path.exists(manifest_path) else item_path
+                    if os.path.getmtime(age_path) < cutoff_time:
                         shutil.rmtree(item_path)
+                        removed.append(item_path)
                         logger.info(f"Cleaned up old segmentation result: {item_path}")
                         
         except Exception as e:
             logger.error(f"Error cleaning up old results: {str(e)}")
+        return removed
@@ -0,0 +1,411 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import logging
+import argparse
+import threading
+import subprocess
+import importlib.util
+from multiprocessing.connection import Connection
+import numpy as np
+import nibabel as nib
+import pydicom
+
+logger = logging.getLogger(__name__)
+
+STANDIN_ORGANS = [
+    'liver', 'spleen', 'left_kidney', 'right_kidney',
+    'stomach', 'gallbladder', 'pancreas', 'left_lung', 'right_lung'
+]
+
+# Relative (center, radius) of each stand-in organ along the three axes
+STANDIN_LAYOUT = {
+    'liver': ((0.30, 0.45, 0.45), (0.15, 0.15, 0.12)),
+    'spleen': ((0.72, 0.55, 0.50), (0.07, 0.08, 0.08)),
+    'left_kidney': ((0.68, 0.65, 0.35), (0.05, 0.06, 0.08)),
+    'right_kidney': ((0.32, 0.65, 0.35), (0.05, 0.06, 0.08)),
+    'stomach': ((0.62, 0.40, 0.50), (0.08, 0.07, 0.07)),
+    'gallbladder': ((0.38, 0.38, 0.40), (0.03, 0.03, 0.04)),
+    'pancreas': ((0.52, 0.55, 0.42), (0.10, 0.03, 0.03)),
+    'left_lung': ((0.68, 0.50, 0.80), (0.12, 0.18, 0.15)),
+    'right_lung': ((0.32, 0.50, 0.80), (0.12, 0.18, 0.15))
+}
+
+class StandInBackend:
+    """
+    Local stand-in for TotalSegmentator
+
+    Writes one ellipsoid mask per organ, matching the input's shape and
+    affine, in TotalSegmentator's output layout. The optional delays
+    simulate model loading and inference so worker overhead and throughput
+    can be measured without the real model.
+    """
+
+    name = 'standin'
+
+    def __init__(self, load_seconds=0.0, job_seconds=0.0):
+        self.load_seconds = float(load_seconds)
+        self.job_seconds = float(job_seconds)
+        self.version = self.installed_version()
+
+    @staticmethod
+    def installed_version():
+        return 'standin-1'
+
+    def load(self):
+        time.sleep(self.load_seconds)
+
+    def _read_geometry(self, input_path):
+        """Shape and affine of the input volume"""
+        if input_path.lower().endswith('.dcm'):
+            ds = pydicom.dcmread(input_path, stop_before_pixels=True)
+            return (int(ds.Rows), int(ds.Columns), 1), np.eye(4)
+        img = nib.load(input_path)
+        return tuple(int(x) for x in img.shape[:3]), img.affine
+
+    def run(self, input_path, output_dir, task='total'):
+        time.sleep(self.job_seconds)
+        shape, affine = self._read_geometry(input_path)
+        if len(shape) < 3:
+            shape = shape + (1,)
+
+        grid = np.ogrid[tuple(slice(0, dim) for dim in shape)]
+        for organ in STANDIN_ORGANS:
+            center, radius = STANDIN_LAYOUT[organ]
+            distance = sum(
+                ((axis - c * dim) / max(r * dim, 0.5)) ** 2
+                for axis, c, r, dim in zip(grid, center, radius, shape)
+            )
+            mask = (distance <= 1.0).astype(np.uint8)
+            nib.Nifti1Image(mask, affine).to_filename(os.path.join(output_dir, f"{organ}.nii.gz"))
+
+class TotalSegmentatorBackend:
+    """
+    TotalSegmentator through its Python API, imported once per worker process
+
+    TotalSegmentator builds a new nnU-Net predictor on every call and loads
+    the checkpoints of each model part from disk again. The worker keeps
+    the initialized predictors instead: initialization is memoized per
+    model folder, folds, checkpoint and device, so later jobs reuse the
+    loaded networks and weights and only pay for inference.
+    """
+
+    name = 'totalsegmentator'
+
+    def __init__(self, fast=False):
+        self.fast = fast
+        self.version = None
+        self.predictors_reused = 0
+        self._segment = None
+        self._predictors = {}
+
+    @staticmethod
+    def installed_version():
+        """Package version without importing the model code, or None"""
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            return f"totalsegmentator-{version('TotalSegmentator')}"
+        except PackageNotFoundError:
+            return None
+
+    def load(self):
+        # Importing pulls in torch and nnU-Net; paying this once per worker
+        # process rather than once per study is the point of the worker
+        from totalsegmentator.python_api import totalsegmentator
+        self._segment = totalsegmentator
+        self.version = self.installed_version()
+        self._keep_predictors()
+
+    def _keep_predictors(self):
+        """Patch nnU-Net (in this worker process only) to reuse initialized predictors"""
+        try:
+            from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+        except ImportError:
+            logger.warning("nnU-Net v2 not importable; predictors are initialized for every job")
+            return
+        initialize = nnUNetPredictor.initialize_from_trained_model_folder
+        backend = self
+
+        def initialize_once(predictor, model_training_output_dir, use_folds,
+                            checkpoint_name='checkpoint_final.pth'):
+            key = (model_training_output_dir, repr(use_folds), checkpoint_name,
+                   str(getattr(predictor, 'device', '')))
+            state = backend._predictors.get(key)
+            if state is None:
+                before = dict(vars(predictor))
+                initialize(predictor, model_training_output_dir, use_folds, checkpoint_name)
+                # Everything initialization set: plans, network, per-fold parameters, ...
+                state = {name: value for name, value in vars(predictor).items()
+                         if name not in before or before[name] is not value}
+                backend._predictors[key] = state
+            else:
+                backend.predictors_reused += 1
+            vars(predictor).update(state)
+
+        nnUNetPredictor.initialize_from_trained_model_folder = initialize_once
+
+    def run(self, input_path, output_dir, task='total'):
+        self._segment(input_path, output_dir, task=task, fast=self.fast, quiet=True)
+
+BACKENDS = {
+    StandInBackend.name: StandInBackend,
+    TotalSegmentatorBackend.name: TotalSegmentatorBackend
+}
+
+def totalsegmentator_installed():
+    """Whether the TotalSegmentator package is importable (the backend uses its Python API, not the CLI)"""
+    return importlib.util.find_spec('totalsegmentator') is not None
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _worker_main(conn, backend_name, backend_options):
+    """Worker process loop: load the backend once, then serve jobs until told to stop"""
+    try:
+        backend = BACKENDS[backend_name](**backend_options)
+        load_start = time.time()
+        backend.load()
+        conn.send({'ready': True, 'load_time': time.time() - load_start, 'version': backend.version})
+    except Exception as e:
+        conn.send({'ready': False, 'error': f'Backend load failed: {str(e)}'})
+        return
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        start = time.time()
+        try:
+            backend.run(job['input_path'], job['output_dir'], job.get('task', 'total'))
+            conn.send({'success': True, 'processing_time': time.time() - start})
+        except Exception as e:
+            conn.send({'success': False, 'error': str(e), 'processing_time': time.time() - start})
+
+class SegmentationWorker:
+    """
+    Supervisor for a long-lived segmentation process
+
+    The backend is loaded once in a child process (a fresh interpreter
+    running this module with --serve) and jobs are sent over a local socket
+    pair. The child is restarted after max_jobs jobs (to bound memory
+    growth), when it crashes, or when a job exceeds its timeout. Jobs are
+    serialized: one child runs one job at a time.
+    """
+
+    def __init__(self, backend='standin', backend_options=None, max_jobs=50,
+                 job_timeout=600, load_timeout=300):
+        self.backend = backend
+        self.backend_options = backend_options or {}
+        self.max_jobs = max_jobs
+        self.job_timeout = job_timeout
+        self.load_timeout = load_timeout
+        self.backend_version = None
+        self.jobs_done = 0
+        self.restarts = 0
+        self.load_time = None
+        self._process = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # A new interpreter rather than fork: the parent may be a threaded
+        # web worker, and the child must not re-import the web app
+        parent_sock, child_sock = socket.socketpair()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'services.segmentation_worker', '--serve',
+             str(child_sock.fileno()), '--backend', self.backend,
+             '--backend-options', json.dumps(self.backend_options)],
+            pass_fds=(child_sock.fileno(),),
+            cwd=PROJECT_ROOT
+        )
+        child_sock.close()
+        parent_conn = Connection(parent_sock.detach())
+
+        try:
+            if not parent_conn.poll(self.load_timeout):
+                raise RuntimeError('Segmentation worker did not become ready in time')
+            message = parent_conn.recv()
+        except (EOFError, OSError, RuntimeError) as e:
+            process.kill()
+            process.wait()
+            parent_conn.close()
+            raise RuntimeError(f'Segmentation worker failed to start: {str(e)}')
+
+        if not message.get('ready'):
+            process.wait(timeout=5)
+            parent_conn.close()
+            raise RuntimeError(message.get('error', 'Segmentation worker failed to start'))
+
+        self._process = process
+        self._conn = parent_conn
+        self.jobs_done = 0
+        self.load_time = message['load_time']
+        self.backend_version = message['version']
+        logger.info(f"Segmentation worker started (pid {process.pid}, {self.backend_version}, "
+                    f"load {self.load_time:.1f}s)")
+
+    def _is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def _stop(self, kill=False):
+        if self._process is None:
+            return
+        try:
+            if kill:
+                self._process.kill()
+            else:
+                self._conn.send(None)
+            self._process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        except (OSError, EOFError):
+            self._process.kill()
+            self._process.wait()
+        finally:
+            self._conn.close()
+            self._process = None
+            self._conn = None
+
+    def _ensure_started(self):
+        if self._is_alive() and self.jobs_done < self.max_jobs:
+            return
+        if self._process is not None:
+            self.restarts += 1
+            self._stop(kill=not self._is_alive())
+        self._start()
+
+    def run_job(self, input_path, output_dir, task='total'):
+        """
+        Run one segmentation job on the warm worker
+
+        Returns:
+            dict with success status, processing_time and backend version
+        """
+        with self._lock:
+            try:
+                self._ensure_started()
+                self._conn.send({
+                    'input_path': os.path.abspath(input_path),
+                    'output_dir': os.path.abspath(output_dir),
+                    'task': task
+                })
+                if not self._conn.poll(self.job_timeout):
+                    self._stop(kill=True)
+                    return {'success': False, 'error': f'Segmentation timeout (>{self.job_timeout}s)',
+                            'timeout': True}
+                result = self._conn.recv()
+            except (EOFError, OSError) as e:
+                logger.error(f"Segmentation worker crashed: {str(e)}")
+                self._stop(kill=True)
+                return {'success': False, 'error': 'Segmentation worker crashed'}
+            except RuntimeError as e:
+                return {'success': False, 'error': str(e)}
+
+            self.jobs_done += 1
+            result['backend'] = self.backend
+            result['backend_version'] = self.backend_version
+            return result
+
+    def get_backend_version(self):
+        """Version string of the backend, known before the worker starts"""
+        if self.backend_version:
+            return self.backend_version
+        return BACKENDS[self.backend].installed_version()
+
+    def shutdown(self):
+        """Stop the worker process"""
+        with self._lock:
+            self._stop()
+
+    def get_stats(self):
+        return {
+            'backend': self.backend,
+            'backend_version': self.backend_version,
+            'alive': self._is_alive(),
+            'jobs_since_start': self.jobs_done,
+            'max_jobs': self.max_jobs,
+            'restarts': self.restarts,
+            'load_time': self.load_time
+        }
+
+def benchmark(input_path, jobs=10, backend='standin', backend_options=None, work_dir=None):
+    """
+    Compare a warm worker with one cold process per study
+
+    Returns:
+        dict with per-job wall times, overhead and studies/hour for both modes
+    """
+    import tempfile
+    work_dir = work_dir or tempfile.mkdtemp(prefix='segmentation_benchmark_')
+    results = {}
+
+    for mode in ('cold', 'warm'):
+        timings = []
+        inference = []
+        worker = SegmentationWorker(backend=backend, backend_options=backend_options,
+                                    max_jobs=1 if mode == 'cold' else jobs + 1)
+        try:
+            for i in range(jobs):
+                output_dir = os.path.join(work_dir, f'{mode}_{i}')
+                os.makedirs(output_dir, exist_ok=True)
+                start = time.time()
+                result = worker.run_job(input_path, output_dir)
+                timings.append(time.time() - start)
+                if not result['success']:
+                    raise RuntimeError(result['error'])
+                inference.append(result['processing_time'])
+        finally:
+            worker.shutdown()
+
+        mean_time = float(np.mean(timings))
+        results[mode] = {
+            'jobs': jobs,
+            'mean_job_seconds': mean_time,
+            'mean_overhead_seconds': mean_time - float(np.mean(inference)),
+            'studies_per_hour': 3600.0 / mean_time if mean_time > 0 else None
+        }
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def main(argv=None):
+    """Measure segmentation worker throughput and per-job overhead"""
+    parser = argparse.ArgumentParser(description='Benchmark the persistent segmentation worker')
+    parser.add_argument('input_path', nargs='?', help='NIFTI or DICOM file to segment')
+    parser.add_argument('--serve', type=int, metavar='FD', help=argparse.SUPPRESS)
+    parser.add_argument('--backend-options', default='{}', help=argparse.SUPPRESS)
+    parser.add_argument('--jobs', type=int, default=10)
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='standin')
+    parser.add_argument('--load-seconds', type=float, default=5.0,
+                        help='Simulated model load time (stand-in backend)')
+    parser.add_argument('--job-seconds', type=float, default=0.0,
+                        help='Simulated inference time (stand-in backend)')
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        # Child side of SegmentationWorker
+        _worker_main(Connection(args.serve), args.backend, json.loads(args.backend_options))
+        return 0
+    if not args.input_path:
+        parser.error('input_path is required')
+
+    options = {}
+    if args.backend == 'standin':
+        options = {'load_seconds': args.load_seconds, 'job_seconds': args.job_seconds}
+
+    results = benchmark(args.input_path, jobs=args.jobs, backend=args.backend, backend_options=options)
+    for mode, result in results.items():
+        print(f"{mode:>5}: {result['mean_job_seconds']:.2f}s/job, "
+              f"overhead {result['mean_overhead_seconds']:.2f}s/job, "
+              f"{result['studies_per_hour']:.0f} studies/hour")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
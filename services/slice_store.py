@@ -0,0 +1,458 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+import pydicom
+from services import volume_reader, mpr, pixel_decoders, image_stats
+from services.windowing import VolumeHistogram
+from utils.file_utils import compute_file_sha256
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 1
+VOLUME_FILENAME = 'volume.npy'
+SIDECAR_FILENAME = 'meta.json'
+HISTOGRAM_FILENAME = 'histogram.npz'
+PLANE_FILENAME = 'plane_{}.npy'
+PLANE_COPY_SLAB = 16  # Output slices copied per step when building a plane
+
+def first_float(value):
+    """First value of a possibly multi-valued DICOM element as float"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, pydicom.multival.MultiValue):
+        value = value[0] if len(value) else None
+    return float(value) if value is not None else None
+
+class SliceFileRange:
+    """
+    Read-only window over a byte range of a store file
+
+    Exposes fileno() so WSGI servers with sendfile support (gunicorn) can
+    send the range straight from the page cache; other servers fall back
+    to read(), which never returns bytes past the end of the range.
+    """
+
+    def __init__(self, path, offset, length):
+        self._file = open(path, 'rb')
+        self._file.seek(offset)
+        self._remaining = length
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def read(self, size=-1):
+        if self._remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+class SliceStore:
+    """
+    Uncompressed, memory-mappable copies of uploaded volumes
+
+    Each source file gets a directory holding volume.npy, the display
+    volume in native little-endian dtype laid out slice-major as
+    (slices, rows, columns) so one slice is a single contiguous byte range,
+    histogram.npz with the whole-volume intensity histogram used for
+    windowing, and meta.json with the affine, header fields, the intensity
+    statistics (computed while the volume is written) and the store's own
+    size. Slice k of the store equals data[:, :, k] of the source volume.
+
+    NIFTI volumes also get plane_<plane>.npy, a canonically oriented
+    (slices, rows, columns) copy per MPR plane, written on first request so
+    coronal and sagittal slices are as contiguous as axial ones.
+    """
+
+    def __init__(self, root, max_open=32):
+        self.root = root
+        self.max_open = max_open
+        self._open = OrderedDict()
+        self._planes = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def get_store_dir(self, source_path):
+        """Directory holding the store for a source file"""
+        abs_path = os.path.abspath(source_path)
+        digest = hashlib.sha1(abs_path.encode('utf-8')).hexdigest()[:12]
+        base_name = os.path.basename(source_path).replace('.', '_')
+        return os.path.join(self.root, f"{base_name}_{digest}")
+
+    def build(self, source_path, content_hash=None):
+        """
+        Convert a NIFTI or DICOM file into a slice store
+
+        Args:
+            source_path: Path to the uploaded medical image
+            content_hash: SHA-256 of the source, if already known
+
+        Returns:
+            dict with success status and the sidecar metadata
+        """
+        tmp_paths = []
+        try:
+            store_dir = self.get_store_dir(source_path)
+            os.makedirs(store_dir, exist_ok=True)
+            volume_path = os.path.join(store_dir, VOLUME_FILENAME)
+            # Unique temporary names: identical uploads share a store and may build it concurrently
+            fd, tmp_volume_path = tempfile.mkstemp(dir=store_dir, prefix='.tmp_', suffix='.npy')
+            os.close(fd)
+            tmp_paths.append(tmp_volume_path)
+
+            if source_path.lower().endswith('.dcm'):
+                meta = self._write_dicom(source_path, tmp_volume_path)
+            else:
+                meta = self._write_nifti(source_path, tmp_volume_path)
+
+            os.replace(tmp_volume_path, volume_path)
+            self._remove_planes(store_dir)
+
+            # The histogram pass reads the freshly written (page-cached) store
+            VolumeHistogram.from_volume(np.load(volume_path, mmap_mode='r')).save(
+                os.path.join(store_dir, HISTOGRAM_FILENAME))
+
+            stat = os.stat(source_path)
+            meta.update({
+                'format_version': STORE_FORMAT_VERSION,
+                'source_path': os.path.abspath(source_path),
+                'source_mtime_ns': stat.st_mtime_ns,
+                'source_size': stat.st_size,
+                'content_sha256': content_hash or compute_file_sha256(source_path),
+                'layout': 'slice-major',
+                'store_bytes': os.path.getsize(volume_path),
+                'created_at': datetime.now().isoformat()
+            })
+
+            # Sidecar goes last: its presence marks a complete store
+            fd, tmp_sidecar_path = tempfile.mkstemp(dir=store_dir, prefix='.tmp_', suffix='.json')
+            tmp_paths.append(tmp_sidecar_path)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_sidecar_path, os.path.join(store_dir, SIDECAR_FILENAME))
+
+            self._forget(source_path)
+            logger.info(f"Built slice store for {source_path}: {meta['shape']} {meta['dtype']}")
+            return {'success': True, 'store_dir': store_dir, 'metadata': meta}
+
+        except Exception as e:
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            logger.error(f"Error building slice store for {source_path}: {str(e)}")
+            return {'success': False, 'error': f'Slice store build failed: {str(e)}'}
+
+    def _write_nifti(self, source_path, volume_path):
+        """Stream a NIFTI volume slab by slab into a slice-major .npy"""
+        img = volume_reader.open_nifti(source_path)
+        header = img.header
+        shape = volume_reader.get_shape(img)
+
+        # Scaled data cannot stay in the on-disk integer type
+        dtype = header.get_data_dtype()
+        slope = getattr(img.dataobj, 'slope', 1.0)
+        inter = getattr(img.dataobj, 'inter', 0.0)
+        if slope != 1.0 or inter != 0.0:
+            dtype = np.dtype(np.float32)
+        dtype = dtype.newbyteorder('<')
+
+        if len(shape) < 3:
+            store_shape = (1, shape[0], shape[1])
+        else:
+            store_shape = (shape[2], shape[0], shape[1])
+
+        # Statistics come from the same pass, so ingest does not read the volume again
+        stats = image_stats.StreamingStats()
+        volume = np.lib.format.open_memmap(volume_path, mode='w+', dtype=dtype, shape=store_shape)
+        for start, slab in volume_reader.iter_slabs(img):
+            stats.update(slab)
+            if slab.ndim == 2:
+                volume[0] = slab
+            else:
+                volume[start:start + slab.shape[2]] = np.moveaxis(slab, 2, 0)
+        volume.flush()
+        del volume
+
+        zooms = [float(x) for x in header.get_zooms()]
+        return {
+            'source_format': 'NIFTI',
+            'source_shape': list(shape),
+            'shape': list(store_shape),
+            'dtype': dtype.str,
+            'affine': img.affine.tolist(),
+            'spacing': [zooms[0], zooms[1], zooms[2] if len(zooms) > 2 else 1.0],
+            'rescale_slope': 1.0,
+            'rescale_intercept': 0.0,
+            # The store holds the first frame only, so 4D statistics are left to a full read
+            'intensity_stats': stats.result() if len(shape) <= 3 else None,
+            'header': {
+                'zooms': zooms,
+                'data_type': str(header.get_data_dtype()),
+                'xyzt_units': list(header.get_xyzt_units()),
+                'qform_code': int(header['qform_code']),
+                'sform_code': int(header['sform_code']),
+                'description': header['descrip'].tobytes().decode('utf-8', errors='ignore').strip('\x00')
+            }
+        }
+
+    def _write_dicom(self, source_path, volume_path):
+        """Write DICOM frames (raw stored values) into a slice-major .npy"""
+        ds = pydicom.dcmread(source_path)
+        pixels, decode_info = pixel_decoders.decode(ds)
+        source_shape = list(pixels.shape)
+        if pixels.ndim == 2 or (pixels.ndim == 3 and int(ds.get('SamplesPerPixel', 1)) > 1):
+            pixels = pixels[np.newaxis]
+        dtype = pixels.dtype.newbyteorder('<')
+
+        volume = np.lib.format.open_memmap(volume_path, mode='w+', dtype=dtype, shape=pixels.shape)
+        volume[:] = pixels
+        volume.flush()
+        del volume
+
+        pixel_spacing = [float(x) for x in ds.get('PixelSpacing', [1.0, 1.0])]
+        slice_thickness = float(ds.get('SliceThickness', 0) or 0) or 1.0
+        return {
+            'source_format': 'DICOM',
+            'source_shape': source_shape,
+            'shape': list(pixels.shape),
+            'dtype': dtype.str,
+            'affine': None,
+            'spacing': pixel_spacing + [slice_thickness],
+            'rescale_slope': float(ds.get('RescaleSlope', 1) or 1),
+            'rescale_intercept': float(ds.get('RescaleIntercept', 0) or 0),
+            'intensity_stats': image_stats.compute_stats(image_stats.iter_array_slabs(pixels)),
+            'pixel_decode': decode_info,
+            'header': {
+                'modality': str(ds.get('Modality', 'UNKNOWN')),
+                'photometric_interpretation': str(ds.get('PhotometricInterpretation', '')),
+                'bits_stored': int(ds.get('BitsStored', 0)),
+                'window_center': first_float(ds.get('WindowCenter')),
+                'window_width': first_float(ds.get('WindowWidth'))
+            }
+        }
+
+    def open(self, source_path):
+        """
+        Open the store for a source file
+
+        Returns:
+            tuple of (read-only memory-mapped volume, metadata), or None when
+            no complete, up-to-date store exists
+        """
+        try:
+            stat = os.stat(source_path)
+        except OSError:
+            return None
+
+        key = (os.path.abspath(source_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._open.get(key)
+            if entry is not None:
+                self._open.move_to_end(key)
+                return entry
+
+        store_dir = self.get_store_dir(source_path)
+        sidecar_path = os.path.join(store_dir, SIDECAR_FILENAME)
+        volume_path = os.path.join(store_dir, VOLUME_FILENAME)
+        if not os.path.exists(sidecar_path) or not os.path.exists(volume_path):
+            return None
+
+        try:
+            with open(sidecar_path) as f:
+                meta = json.load(f)
+            if (meta.get('format_version') != STORE_FORMAT_VERSION or
+                    meta.get('source_mtime_ns') != stat.st_mtime_ns or
+                    meta.get('source_size') != stat.st_size):
+                return None
+            volume = np.load(volume_path, mmap_mode='r')
+        except Exception as e:
+            logger.warning(f"Could not open slice store {store_dir}: {str(e)}")
+            return None
+
+        entry = (volume, meta)
+        with self._lock:
+            self._open[key] = entry
+            while len(self._open) > self.max_open:
+                self._open.popitem(last=False)
+        return entry
+
+    def get_slice(self, source_path, slice_index):
+        """
+        Read one slice from the store (only that slice's bytes are touched)
+
+        Returns:
+            tuple of (2D array view, clamped slice index), or None without a store
+        """
+        entry = self.open(source_path)
+        if entry is None:
+            return None
+        volume, _ = entry
+        total_slices = volume.shape[0]
+        if slice_index is None:
+            slice_index = total_slices // 2
+        slice_index = max(0, min(int(slice_index), total_slices - 1))
+        return volume[slice_index], slice_index
+
+    def get_plane(self, source_path, plane):
+        """
+        Canonically oriented copy of the volume for one MPR plane
+
+        The copy is written from volume.npy the first time a plane is
+        requested and memory-mapped afterwards.
+
+        Returns:
+            tuple of (read-only memory-mapped (slices, rows, columns) array,
+            (slice, row, column) spacing), or None without a 3D NIFTI store
+        """
+        entry = self.open(source_path)
+        if entry is None:
+            return None
+        volume, meta = entry
+        if meta.get('affine') is None or len(meta.get('source_shape', [])) < 3:
+            return None
+
+        stat = os.stat(source_path)
+        key = (os.path.abspath(source_path), stat.st_mtime_ns, stat.st_size, plane)
+        with self._lock:
+            cached = self._planes.get(key)
+            if cached is not None:
+                self._planes.move_to_end(key)
+                return cached
+
+        store_dir = self.get_store_dir(source_path)
+        plane_path = os.path.join(store_dir, PLANE_FILENAME.format(plane))
+        if not os.path.exists(plane_path):
+            self._write_plane(volume, meta['affine'], plane, plane_path)
+
+        spacing = mpr.plane_spacing(meta['header']['zooms'], meta['affine'], plane)
+        cached = (np.load(plane_path, mmap_mode='r'), spacing)
+        with self._lock:
+            self._planes[key] = cached
+            while len(self._planes) > self.max_open:
+                self._planes.popitem(last=False)
+        return cached
+
+    def _write_plane(self, volume, affine, plane, plane_path):
+        """Copy a plane's view of the store into a C-contiguous .npy, slab by slab"""
+        # The store is (k, i, j); MPR views are defined on voxel axes (i, j, k)
+        view = mpr.plane_view(volume.transpose(1, 2, 0), affine, plane)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(plane_path), prefix='.tmp_', suffix='.npy')
+        os.close(fd)
+        try:
+            copy = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=view.dtype, shape=view.shape)
+            for start in range(0, view.shape[0], PLANE_COPY_SLAB):
+                copy[start:start + PLANE_COPY_SLAB] = view[start:start + PLANE_COPY_SLAB]
+            copy.flush()
+            del copy
+            os.replace(tmp_path, plane_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logger.info(f"Wrote {plane} plane {view.shape} to {plane_path}")
+
+    def _remove_planes(self, store_dir):
+        """Delete plane copies derived from a previous volume.npy"""
+        for plane in mpr.PLANES:
+            path = os.path.join(store_dir, PLANE_FILENAME.format(plane))
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_slice_range(self, source_path, slice_index):
+        """
+        Locate one slice's bytes inside volume.npy
+
+        Returns:
+            dict with path, offset, length, slice_index and the store metadata,
+            or None without a store
+        """
+        entry = self.open(source_path)
+        if entry is None:
+            return None
+        volume, meta = entry
+        slice_index = max(0, min(int(slice_index), volume.shape[0] - 1))
+        slice_bytes = int(np.prod(volume.shape[1:])) * volume.dtype.itemsize
+        return {
+            'path': volume.filename,
+            'offset': volume.offset + slice_index * slice_bytes,
+            'length': slice_bytes,
+            'slice_index': slice_index,
+            'metadata': meta
+        }
+
+    def get_histogram(self, source_path):
+        """
+        Whole-volume intensity histogram of the store
+
+        Stores written before histograms existed get one computed and saved
+        on first use.
+
+        Returns:
+            VolumeHistogram, or None without a store
+        """
+        entry = self.open(source_path)
+        if entry is None:
+            return None
+        histogram_path = os.path.join(self.get_store_dir(source_path), HISTOGRAM_FILENAME)
+        if os.path.exists(histogram_path):
+            return VolumeHistogram.load(histogram_path)
+
+        histogram = VolumeHistogram.from_volume(entry[0])
+        histogram.save(histogram_path)
+        return histogram
+
+    def remove(self, source_path):
+        """Delete the store for a source file"""
+        self._forget(source_path)
+        store_dir = self.get_store_dir(source_path)
+        for filename in (VOLUME_FILENAME, SIDECAR_FILENAME, HISTOGRAM_FILENAME):
+            path = os.path.join(store_dir, filename)
+            if os.path.exists(path):
+                os.remove(path)
+        self._remove_planes(store_dir)
+        if os.path.isdir(store_dir) and not os.listdir(store_dir):
+            os.rmdir(store_dir)
+
+    def _forget(self, source_path):
+        """Drop open memory maps for a source file"""
+        abs_path = os.path.abspath(source_path)
+        with self._lock:
+            for key in [k for k in self._open if k[0] == abs_path]:
+                del self._open[key]
+            for key in [k for k in self._planes if k[0] == abs_path]:
+                del self._planes[key]
+
+    def get_disk_usage(self):
+        """Total bytes recorded by the stores' sidecars, plus any plane copies"""
+        total_bytes = 0
+        store_count = 0
+        if not os.path.exists(self.root):
+            return {'stores': 0, 'total_bytes': 0}
+
+        for entry in os.scandir(self.root):
+            sidecar_path = os.path.join(entry.path, SIDECAR_FILENAME)
+            if not entry.is_dir() or not os.path.exists(sidecar_path):
+                continue
+            try:
+                with open(sidecar_path) as f:
+                    total_bytes += int(json.load(f).get('store_bytes', 0))
+                for plane in mpr.PLANES:
+                    plane_path = os.path.join(entry.path, PLANE_FILENAME.format(plane))
+                    if os.path.exists(plane_path):
+                        total_bytes += os.path.getsize(plane_path)
+                store_count += 1
+            except Exception as e:
+                logger.warning(f"Unreadable slice store sidecar {sidecar_path}: {str(e)}")
+
+        return {'stores': store_count, 'total_bytes': total_bytes}
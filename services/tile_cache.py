@@ -0,0 +1,157 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024  # 512MB of rendered tiles
+EVICTION_TARGET = 0.9  # Evict down to this fraction of the budget
+
+class TileCache:
+    """
+    Size-bounded on-disk cache of rendered slices
+
+    Tiles are content-addressed: the key is derived from the source file's
+    content hash and the render parameters, so a tile never has to be
+    invalidated and re-uploads of identical data share tiles. Writes go to a
+    temporary file in the same directory followed by os.replace, so
+    concurrent renders of the same tile never expose a partial file.
+    Recency is tracked through file mtimes, which are refreshed on every hit.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self.current_bytes = self._scan()[1]
+
+    @staticmethod
+    def make_key(content_hash, slice_index, plane='stored', window='auto', fmt='png', **params):
+        """
+        Build a tile key from the source content hash and render parameters
+
+        plane is 'stored' for slices along the file's own slice axis, else
+        the MPR plane. Extra keyword parameters (e.g. resolution level)
+        become part of the key.
+        """
+        parts = [content_hash, str(slice_index), plane, window, fmt]
+        parts.extend(f"{name}={params[name]}" for name in sorted(params))
+        return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def _tile_path(self, key, fmt):
+        """Fan tiles out over 256 subdirectories"""
+        return os.path.join(self.root, key[:2], f"{key}.{fmt}")
+
+    def get_path(self, key, fmt='png'):
+        """Return the path of a cached tile (marking it recently used), or None"""
+        path = self._tile_path(key, fmt)
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def get(self, key, fmt='png'):
+        """Return the bytes of a cached tile, or None"""
+        path = self.get_path(key, fmt)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, data, fmt='png'):
+        """
+        Atomically store tile bytes
+
+        Returns:
+            Path of the stored tile
+        """
+        path = self._tile_path(key, fmt)
+        tile_dir = os.path.dirname(path)
+        os.makedirs(tile_dir, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=tile_dir, prefix='.tmp_', suffix=f'.{fmt}')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            try:
+                replaced_bytes = os.path.getsize(path)  # A concurrent render of the same tile
+            except OSError:
+                replaced_bytes = 0
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self.current_bytes += len(data) - replaced_bytes
+            over_budget = self.current_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+        return path
+
+    def _scan(self):
+        """List (mtime, size, path) for all tiles and their total size"""
+        tiles = []
+        total_bytes = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith('.tmp_'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                tiles.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+        return tiles, total_bytes
+
+    def evict(self):
+        """Delete least recently used tiles until usage is under the target"""
+        tiles, total_bytes = self._scan()
+        target = self.max_bytes * EVICTION_TARGET
+        evicted = 0
+
+        for _, size, path in sorted(tiles):
+            if total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                total_bytes -= size
+                evicted += 1
+            except OSError:
+                continue
+
+        with self._lock:
+            self.current_bytes = total_bytes
+            self.evictions += evicted
+        if evicted:
+            logger.info(f"Evicted {evicted} rendered tiles from {self.root}")
+
+    def get_stats(self):
+        """Get tile cache occupancy and hit/miss counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0
+            }
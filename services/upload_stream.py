@@ -0,0 +1,244 @@
+import os
+import sys
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+from werkzeug.utils import secure_filename
+from utils.file_utils import store_file_content_addressed, get_file_extension
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1024 * 1024  # Request body read size; each read becomes one disk write
+SNIFF_BYTES = 512  # Enough for the DICOM preamble and the NIfTI-1 header magic
+MAX_FIELD_BYTES = 64 * 1024  # Form fields are small text values
+MAX_PARTS = 16
+
+# Signatures accepted for each upload extension (None = no recognizable signature,
+# e.g. DICOM written without the 128-byte preamble)
+EXPECTED_SIGNATURES = {
+    '.dcm': ('dicom', None),
+    '.nii': ('nifti',),
+    '.nii.gz': ('gzip',),
+    '.gz': ('gzip',),
+    '.zip': ('zip',)
+}
+
+def sniff_format(head):
+    """
+    Recognize a file from its first bytes
+
+    Returns:
+        'dicom', 'nifti', 'gzip', 'zip' or None
+    """
+    if head[128:132] == b'DICM':
+        return 'dicom'
+    if head[:2] == b'\x1f\x8b':
+        return 'gzip'
+    if head[:4] == b'PK\x03\x04':
+        return 'zip'
+    if head[344:348] in (b'n+1\x00', b'ni1\x00') or head[:4] in (b'\x5c\x01\x00\x00', b'\x00\x00\x01\x5c'):
+        return 'nifti'  # NIfTI-1 magic, or sizeof_hdr == 348 in either byte order
+    return None
+
+def receive_multipart(stream, boundary, folder, file_field='file', accept_filename=None,
+                      buffer_size=BUFFER_SIZE):
+    """
+    Parse a multipart/form-data body and write its file straight into place
+
+    The body is read in large blocks and decoded incrementally; the bytes
+    of the file part are hashed and written to a temporary file in the
+    destination folder as they arrive, then stored content-addressed by
+    rename. Nothing is spooled or copied. The first bytes are sniffed, and
+    a file whose content contradicts its extension is rejected before the
+    rest of the body is read.
+
+    Args:
+        stream: Request body stream
+        boundary: Multipart boundary (bytes)
+        folder: Destination directory for the file
+        file_field: Name of the form field carrying the file
+        accept_filename: Optional predicate on the uploaded filename
+        buffer_size: Body read size in bytes
+
+    Returns:
+        dict with success status, the form fields and the stored file
+        (path, sha256, size, existed, filename, sniffed_format); on failure
+        an error and an HTTP status
+    """
+    decoder = MultipartDecoder(boundary, max_parts=MAX_PARTS)
+    fields = {}
+    stored = None
+    part = None
+    tmp_path = None
+    output = None
+    result = None
+
+    try:
+        while result is None:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                decoder.receive_data(stream.read(buffer_size) or None)
+            elif isinstance(event, Epilogue):
+                break
+            elif isinstance(event, File) and event.name == file_field and stored is None:
+                if not event.filename:
+                    result = {'success': False, 'error': 'No file selected', 'status': 400}
+                    continue
+                if accept_filename is not None and not accept_filename(event.filename):
+                    result = {'success': False, 'error': f'File type of {event.filename} is not accepted',
+                              'status': 400}
+                    continue
+                part = {'kind': 'file', 'filename': event.filename, 'digest': hashlib.sha256(), 'size': 0,
+                        'head': bytearray(), 'sniffed_format': None}
+                tmp_path = os.path.join(folder, f'.upload_{uuid.uuid4().hex}.part')
+                output = open(tmp_path, 'wb')
+            elif isinstance(event, (Field, File)):
+                part = {'kind': 'field' if isinstance(event, Field) else 'ignored', 'name': event.name,
+                        'data': bytearray()}
+            elif isinstance(event, Data) and part is not None:
+                if part['kind'] == 'file':
+                    error = _write_file_data(part, output, event.data, event.more_data)
+                    if error:
+                        result = {'success': False, 'error': error, 'status': 400}
+                    elif not event.more_data:
+                        output.close()
+                        output = None
+                        stored = _store(part, tmp_path, folder)
+                        tmp_path = None
+                elif part['kind'] == 'field':
+                    part['data'] += event.data
+                    if len(part['data']) > MAX_FIELD_BYTES:
+                        result = {'success': False, 'error': f"Form field {part['name']} is too large",
+                                  'status': 413}
+                    elif not event.more_data:
+                        fields[part['name']] = part['data'].decode('utf-8', errors='replace')
+                if not event.more_data:
+                    part = None
+
+        if result is None and stored is None:
+            result = {'success': False, 'error': 'No file provided', 'status': 400}
+
+    except ValueError as e:
+        logger.warning(f"Malformed multipart upload: {str(e)}")
+        result = {'success': False, 'error': f'Malformed upload body: {str(e)}', 'status': 400}
+    finally:
+        if output is not None:
+            output.close()
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    if result is not None:
+        # A file stored before the body turned out to be bad is not kept
+        if stored is not None and not stored['existed']:
+            os.remove(stored['path'])
+        return result
+    return {'success': True, 'fields': fields, 'file': stored}
+
+def _write_file_data(part, output, data, more_data):
+    """Hash and write file bytes, checking the signature once enough has arrived"""
+    if part['sniffed_format'] is None and len(part['head']) < SNIFF_BYTES:
+        part['head'] += data[:SNIFF_BYTES - len(part['head'])]
+        if len(part['head']) >= SNIFF_BYTES or not more_data:
+            part['sniffed_format'] = sniff_format(bytes(part['head']))
+            expected = EXPECTED_SIGNATURES.get(get_file_extension(part['filename']))
+            if expected is not None and part['sniffed_format'] not in expected:
+                found = part['sniffed_format'] or 'unrecognized data'
+                return f"{part['filename']} contains {found}, not {' or '.join(filter(None, expected))}"
+    part['digest'].update(data)
+    part['size'] += len(data)
+    output.write(data)
+    return None
+
+def _store(part, tmp_path, folder):
+    """Rename the received file to its content address"""
+    filename = secure_filename(part['filename']) or f"upload{get_file_extension(part['filename'])}"
+    stored = store_file_content_addressed(tmp_path, folder, filename, content_hash=part['digest'].hexdigest())
+    return dict(stored, filename=part['filename'], sniffed_format=part['sniffed_format'])
+
+def _process_io():
+    """Bytes read and written through syscalls by this process (Linux /proc), or None"""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _write_body(path, boundary, size_bytes):
+    """Multipart body with form fields and a NIfTI-looking file of size_bytes"""
+    with open(path, 'wb') as f:
+        for name, value in (('patient_id', 'BENCH'), ('description', 'upload benchmark')):
+            f.write(b'--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                    % (boundary, name.encode(), value.encode()))
+        f.write(b'--%s\r\nContent-Disposition: form-data; name="file"; filename="bench.nii"\r\n'
+                b'Content-Type: application/octet-stream\r\n\r\n' % boundary)
+        f.write(b'\x5c\x01\x00\x00' + b'\x00' * 340 + b'n+1\x00')
+        remaining = size_bytes - 348
+        block = os.urandom(min(remaining, 4 * 1024 * 1024))
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+        f.write(b'\r\n--%s--\r\n' % boundary)
+
+def _werkzeug_upload(body_path, boundary, folder):
+    """The previous path: request.files spooling followed by a copy into the upload folder"""
+    from werkzeug.wrappers import Request
+    from utils.file_utils import save_stream_content_addressed
+    with open(body_path, 'rb') as body:
+        request = Request({
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': f'multipart/form-data; boundary={boundary.decode()}',
+            'CONTENT_LENGTH': str(os.path.getsize(body_path)),
+            'wsgi.input': body
+        })
+        file = request.files['file']
+        return save_stream_content_addressed(file.stream, folder, file.filename)
+
+def _streaming_upload(body_path, boundary, folder):
+    with open(body_path, 'rb') as body:
+        return receive_multipart(body, boundary, folder)['file']
+
+def main(argv=None):
+    """Compare upload throughput and write amplification of both upload paths"""
+    parser = argparse.ArgumentParser(description='Benchmark multipart upload handling')
+    parser.add_argument('--size-mb', type=int, default=256, help='Uploaded file size in MB')
+    parser.add_argument('--repeat', type=int, default=3, help='Uploads per path')
+    parser.add_argument('--dir', default=None, help='Scratch directory (default: system temp)')
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='upload_bench_', dir=args.dir)
+    try:
+        boundary = b'----bench' + uuid.uuid4().hex.encode()
+        body_path = os.path.join(work_dir, 'body')
+        size_bytes = args.size_mb * 1024 * 1024
+        _write_body(body_path, boundary, size_bytes)
+
+        print(f"{'path':<12}{'seconds':>10}{'MB/s':>10}{'written/size':>14}")
+        for name, upload in (('werkzeug', _werkzeug_upload), ('streaming', _streaming_upload)):
+            timings = []
+            written = []
+            for _ in range(args.repeat):
+                folder = tempfile.mkdtemp(dir=work_dir)
+                before = _process_io()
+                start = time.perf_counter()
+                stored = upload(body_path, boundary, folder)
+                timings.append(time.perf_counter() - start)
+                after = _process_io()
+                if before is not None and after is not None:
+                    written.append((after[1] - before[1]) / size_bytes)
+                assert stored['size'] == size_bytes
+                shutil.rmtree(folder)
+            best = min(timings)
+            amplification = f'{min(written):.2f}x' if written else 'n/a'
+            print(f"{name:<12}{best:>10.3f}{args.size_mb / best:>10.0f}{amplification:>14}")
+        return 0
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
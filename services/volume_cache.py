@@ -0,0 +1,119 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024  # 1GB of decoded voxel data
+
+class VolumeCache:
+    """Process-wide LRU cache of decoded image volumes keyed by file path and mtime"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = int(max_bytes)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _make_key(self, file_path, variant):
+        """Build cache key; a changed mtime or size yields a new key"""
+        stat = os.stat(file_path)
+        return (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size, variant)
+
+    def get(self, file_path, loader, variant=None):
+        """
+        Return the decoded volume for file_path, calling loader(file_path) on a miss
+
+        Args:
+            file_path: Path to the medical image file
+            loader: Callable returning a numpy array for the file
+            variant: Optional discriminator when one file is decoded in several ways
+
+        Returns:
+            Read-only numpy array shared between callers
+        """
+        key = self._make_key(file_path, variant)
+
+        with self._lock:
+            volume = self._entries.get(key)
+            if volume is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return volume
+            self.misses += 1
+
+        # Decode outside the lock so other volumes can still be served
+        volume = loader(file_path)
+        volume.flags.writeable = False
+        self.put(key, volume)
+        return volume
+
+    def peek(self, file_path, variant=None):
+        """Return the cached volume without loading it, or None"""
+        try:
+            key = self._make_key(file_path, variant)
+        except OSError:
+            return None
+
+        with self._lock:
+            volume = self._entries.get(key)
+            if volume is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return volume
+
+    def put(self, key, volume):
+        """Insert a volume and evict least recently used entries over budget"""
+        size = int(volume.nbytes)
+        if size > self.max_bytes:
+            logger.debug(f"Volume {key[0]} ({size} bytes) exceeds cache budget, not cached")
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= int(self._entries.pop(key).nbytes)
+
+            # Drop stale entries for the same file (older mtime or size)
+            stale = [k for k in self._entries if k[0] == key[0] and k[3] == key[3]]
+            for stale_key in stale:
+                self.current_bytes -= int(self._entries.pop(stale_key).nbytes)
+
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= int(evicted.nbytes)
+                self.evictions += 1
+                logger.debug(f"Evicted cached volume {evicted_key[0]}")
+
+            self._entries[key] = volume
+            self.current_bytes += size
+
+    def invalidate(self, file_path):
+        """Remove all cached variants of a file"""
+        path = os.path.abspath(file_path)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == path]:
+                self.current_bytes -= int(self._entries.pop(key).nbytes)
+
+    def clear(self):
+        """Empty the cache (counters are kept)"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def get_stats(self):
+        """Get cache occupancy and hit/miss counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0
+            }
@@ -0,0 +1,123 @@
+import logging
+import numpy as np
+import nibabel as nib
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLAB_SIZE = 16  # Slices read per proxy access when streaming a volume
+
+def open_nifti(file_path):
+    """
+    Open a NIFTI image without reading voxel data
+
+    Uncompressed .nii files are memory-mapped read-only so slice reads
+    only touch the pages they need; .nii.gz files go through nibabel's
+    array proxy, which decompresses up to the requested offset.
+    """
+    if file_path.lower().endswith('.gz'):
+        return nib.load(file_path)
+    return nib.load(file_path, mmap='r')
+
+def is_memory_mappable(file_path):
+    """Whether slice reads on this file can be served from a memory map"""
+    return not file_path.lower().endswith('.gz')
+
+def get_shape(img):
+    """Spatial/temporal shape from the header"""
+    return tuple(int(x) for x in img.header.get_data_shape())
+
+def get_slice_count(img):
+    """Number of slices along the display axis (axis 2)"""
+    shape = get_shape(img)
+    return shape[2] if len(shape) >= 3 else 1
+
+def estimate_nbytes(img):
+    """Bytes needed to hold the full volume in its on-disk dtype"""
+    shape = get_shape(img)
+    return int(np.prod(shape)) * img.header.get_data_dtype().itemsize
+
+def _frame_slicer(shape, index_slicer, frame=0):
+    """Build a proxy slicer selecting axis-2 slices of a single frame"""
+    if len(shape) == 2:
+        return (slice(None), slice(None))
+    slicer = (slice(None), slice(None), index_slicer)
+    if len(shape) >= 4:
+        slicer = slicer + (frame,) + (0,) * (len(shape) - 4)
+    return slicer
+
+def read_slice(img, slice_index, frame=0):
+    """
+    Read a single axis-2 slice through the array proxy
+
+    Args:
+        img: nibabel image from open_nifti
+        slice_index: Slice to read (clamped to the valid range)
+        frame: Volume index for 4D images
+
+    Returns:
+        2D numpy array in the file's dtype (float only if scl_slope/inter apply)
+    """
+    shape = get_shape(img)
+    if len(shape) == 2:
+        return np.asanyarray(img.dataobj)
+
+    slice_index = max(0, min(int(slice_index), shape[2] - 1))
+    frame = max(0, min(int(frame), shape[3] - 1)) if len(shape) >= 4 else 0
+    return np.asanyarray(img.dataobj[_frame_slicer(shape, slice_index, frame)])
+
+def read_slab(img, start, stop, step=1, frame=0):
+    """
+    Read axis-2 slices start:stop:step of one frame in a single proxy access
+
+    Returns:
+        numpy array (X, Y, n) in the file's dtype
+    """
+    shape = get_shape(img)
+    if len(shape) == 2:
+        return np.asanyarray(img.dataobj)[:, :, np.newaxis]
+    frame = max(0, min(int(frame), shape[3] - 1)) if len(shape) >= 4 else 0
+    return np.asanyarray(img.dataobj[_frame_slicer(shape, slice(start, stop, step), frame)])
+
+def iter_slabs(img, slab_size=DEFAULT_SLAB_SIZE, frame=0):
+    """
+    Yield (start_index, slab) pairs covering the volume along axis 2
+
+    Peak memory is bounded by one slab rather than the whole volume.
+    """
+    shape = get_shape(img)
+    if len(shape) == 2:
+        yield 0, np.asanyarray(img.dataobj)
+        return
+
+    depth = shape[2]
+    for start in range(0, depth, slab_size):
+        stop = min(start + slab_size, depth)
+        yield start, np.asanyarray(img.dataobj[_frame_slicer(shape, slice(start, stop), frame)])
+
+def read_volume(img):
+    """Read the full volume in the file's dtype (no float64 promotion)"""
+    return np.asanyarray(img.dataobj)
+
+def has_variation(img, slab_size=DEFAULT_SLAB_SIZE):
+    """
+    Check that the volume is not constant, stopping at the first slab that proves it
+
+    Returns:
+        True if at least two distinct finite values exist
+    """
+    lowest = None
+    highest = None
+    for _, slab in iter_slabs(img, slab_size):
+        if slab.size == 0:
+            continue
+        if np.issubdtype(slab.dtype, np.floating):
+            if np.all(np.isnan(slab)):
+                continue
+            slab_min, slab_max = np.nanmin(slab), np.nanmax(slab)
+        else:
+            slab_min, slab_max = slab.min(), slab.max()
+        lowest = slab_min if lowest is None else min(lowest, slab_min)
+        highest = slab_max if highest is None else max(highest, slab_max)
+        if lowest != highest:
+            return True
+    return False
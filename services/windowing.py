@@ -0,0 +1,204 @@
+import os
+import logging
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+HISTOGRAM_BINS = 65536  # One 16-bit code per bin
+
+AUTO_WINDOW = 'auto'
+DICOM_WINDOW = 'dicom'
+AUTO_PERCENTILES = (1.0, 99.0)
+
+# Named CT windows as (center, width) in Hounsfield units
+WINDOW_PRESETS = {
+    'lung': (-600.0, 1500.0),
+    'mediastinum': (50.0, 350.0),
+    'soft_tissue': (40.0, 400.0),
+    'bone': (400.0, 1800.0),
+    'brain': (40.0, 80.0)
+}
+
+# Air in Hounsfield units, and the share of voxels in it that marks CT data without a modality
+HU_AIR_RANGE = (-1100.0, -900.0)
+MIN_AIR_FRACTION = 0.01
+
+# Integer dtypes whose values map one-to-one onto 16-bit codes (code = value - offset)
+EXACT_OFFSETS = {
+    np.dtype(np.uint8): 0,
+    np.dtype(np.int8): -2 ** 7,
+    np.dtype(np.uint16): 0,
+    np.dtype(np.int16): -2 ** 15
+}
+
+def _iter_slabs(volume, slab_size):
+    if volume.ndim < 3:
+        yield volume
+        return
+    for start in range(0, volume.shape[0], slab_size):
+        yield volume[start:start + slab_size]
+
+class VolumeHistogram:
+    """
+    Whole-volume intensity histogram over 65536 16-bit codes
+
+    Every voxel value maps to a code: 8- and 16-bit integer values map
+    one-to-one, other dtypes are quantized linearly between the volume's
+    minimum and maximum. A window is then a 65536-entry uint8 lookup table
+    over codes, so rendering a slice is a code conversion and one np.take,
+    with the same mapping on every slice of the volume.
+    """
+
+    def __init__(self, counts, offset, scale, dtype):
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.offset = float(offset)
+        self.scale = float(scale)
+        self.dtype = np.dtype(dtype)
+        self.exact = self.dtype in EXACT_OFFSETS
+        self._cumulative = np.cumsum(self.counts)
+
+    @classmethod
+    def from_volume(cls, volume, slab_size=16):
+        """Build the histogram by streaming slabs along axis 0"""
+        volume = np.asanyarray(volume)
+        dtype = volume.dtype.newbyteorder('=')
+        floating = np.issubdtype(dtype, np.floating)
+
+        if dtype in EXACT_OFFSETS:
+            offset, scale = EXACT_OFFSETS[dtype], 1.0
+        else:
+            # Quantized codes need the value range first
+            lowest, highest = np.inf, -np.inf
+            for slab in _iter_slabs(volume, slab_size):
+                values = slab[np.isfinite(slab)] if floating else slab
+                if values.size:
+                    lowest = min(lowest, float(values.min()))
+                    highest = max(highest, float(values.max()))
+            if not np.isfinite(lowest):
+                lowest, highest = 0.0, 0.0
+            offset = lowest
+            scale = (highest - lowest) / (HISTOGRAM_BINS - 1) if highest > lowest else 1.0
+
+        histogram = cls(np.zeros(HISTOGRAM_BINS), offset, scale, dtype)
+        counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        for slab in _iter_slabs(volume, slab_size):
+            codes = histogram.to_codes(slab)
+            if floating:
+                codes = codes[np.isfinite(slab)]
+            counts += np.bincount(codes.ravel(), minlength=HISTOGRAM_BINS)
+        return cls(counts, offset, scale, dtype)
+
+    def to_codes(self, data):
+        """Map voxel values to uint16 codes"""
+        data = np.asarray(data)
+        if self.exact and data.dtype == self.dtype:
+            if self.dtype == np.uint16:
+                return data
+            if self.dtype == np.int16:
+                # Flipping the sign bit turns two's complement into offset binary
+                return np.ascontiguousarray(data).view(np.uint16) ^ np.uint16(0x8000)
+            return (data.astype(np.int16) - int(self.offset)).astype(np.uint16)
+
+        codes = (data - self.offset) / self.scale
+        codes = np.nan_to_num(codes, nan=0.0, posinf=HISTOGRAM_BINS - 1, neginf=0.0)
+        return np.clip(np.rint(codes), 0, HISTOGRAM_BINS - 1).astype(np.uint16)
+
+    def code_values(self):
+        """Voxel value represented by each code"""
+        return self.offset + np.arange(HISTOGRAM_BINS, dtype=np.float64) * self.scale
+
+    def percentile(self, q):
+        """Voxel value at percentile q (0-100), or None for an empty volume"""
+        total = int(self._cumulative[-1])
+        if total == 0:
+            return None
+        rank = min(int(np.floor(q / 100.0 * total)), total - 1)
+        code = int(np.searchsorted(self._cumulative, rank, side='right'))
+        return self.offset + code * self.scale
+
+    def save(self, path):
+        """Atomically write the histogram as .npz"""
+        directory = os.path.dirname(path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, counts=self.counts, offset=self.offset, scale=self.scale,
+                         dtype=np.array(self.dtype.str))
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['counts'], float(data['offset']), float(data['scale']),
+                       np.dtype(str(data['dtype'])).newbyteorder('='))
+
+def is_hounsfield(histogram, slope=1.0, intercept=0.0, modality=None):
+    """
+    Whether rescaled values are CT Hounsfield units, so the CT presets apply
+
+    A DICOM modality decides. Data without one (NIFTI) counts as CT when a
+    sizeable share of voxels is air around -1000: magnitude MR images have
+    no negative values, and signed data such as phase maps has as much
+    around +1000.
+    """
+    if modality and modality.upper() not in ('UNKNOWN', 'OT'):
+        return modality.upper() == 'CT'
+    total = histogram.counts.sum()
+    if not total:
+        return False
+    values = histogram.code_values() * slope + intercept
+    low, high = HU_AIR_RANGE
+    air = histogram.counts[(values >= low) & (values <= high)].sum() / total
+    mirrored = histogram.counts[(values >= -high) & (values <= -low)].sum() / total
+    return air >= MIN_AIR_FRACTION and air > 2 * mirrored
+
+def available_windows(dicom_window=None, hounsfield=True):
+    """Window names that can be rendered for a study (CT presets only for Hounsfield data)"""
+    names = [AUTO_WINDOW]
+    if dicom_window is not None:
+        names.append(DICOM_WINDOW)
+    return names + (list(WINDOW_PRESETS) if hounsfield else [])
+
+def resolve_window(window, histogram, slope=1.0, intercept=0.0, dicom_window=None, hounsfield=True):
+    """
+    Center and width of a named window in rescaled (e.g. Hounsfield) units
+
+    Returns:
+        tuple of (center, width), or None if the window is not available
+    """
+    if window == AUTO_WINDOW:
+        low = histogram.percentile(AUTO_PERCENTILES[0])
+        high = histogram.percentile(AUTO_PERCENTILES[1])
+        if low is None:
+            return 0.0, 1.0
+        low, high = sorted((low * slope + intercept, high * slope + intercept))
+        return (low + high) / 2.0, max(high - low, 1e-6)
+    if window == DICOM_WINDOW:
+        return dicom_window
+    return WINDOW_PRESETS.get(window) if hounsfield else None
+
+def make_lut(histogram, center, width, slope=1.0, intercept=0.0):
+    """
+    uint8 lookup table over the histogram's codes for a linear window
+
+    Args:
+        histogram: VolumeHistogram of the volume
+        center, width: Window in rescaled units
+        slope, intercept: Stored-value to rescaled-value transform
+
+    Returns:
+        numpy uint8 array of 65536 entries
+    """
+    values = histogram.code_values() * slope + intercept
+    low = center - width / 2.0
+    lut = (values - low) / max(width, 1e-6) * 255.0
+    return np.clip(np.rint(lut), 0, 255).astype(np.uint8)
+
+def apply_lut(lut, codes):
+    """Render codes through a window lookup table"""
+    return np.take(lut, codes)
@@ -43,6 +43,10 @@ window.CornerstoneConfig = {
                 console.warn('cornerstoneWebImageLoader not available - only basic image loading will work');
             }
             
+            // Native-pixel slices from /api/studies/<id>/slices/<k>.raw,
+            // windowed on the client without further server requests
+            cornerstone.registerImageLoader('medraw', this.loadRawSliceImage.bind(this));
+            
             // Initialize tools if available
             if (typeof cornerstoneTools !== 'undefined') {
                 this.initializeTools();
@@ -61,6 +65,84 @@ window.CornerstoneConfig = {
         }
     },
     
+    // Typed array constructors for the raw slice X-Dtype header
+    rawPixelTypes: {
+        uint8: Uint8Array,
+        int8: Int8Array,
+        int16: Int16Array,
+        uint16: Uint16Array,
+        float32: Float32Array
+    },
+    
+    // Build the imageId for a raw slice, e.g. medraw:/api/studies/1/slices/10.raw
+    getRawSliceImageId: function(studyId, sliceIndex) {
+        return `medraw:/api/studies/${studyId}/slices/${sliceIndex}.raw`;
+    },
+    
+    // Cornerstone image loader for raw native-dtype slices
+    loadRawSliceImage: function(imageId) {
+        const url = imageId.substring('medraw:'.length);
+        const controller = new AbortController();
+        
+        const promise = fetch(url, { signal: controller.signal })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Raw slice request failed: ${response.status}`);
+                }
+                return response.arrayBuffer().then(buffer => ({ buffer, headers: response.headers }));
+            })
+            .then(({ buffer, headers }) => {
+                const PixelArray = this.rawPixelTypes[headers.get('X-Dtype')];
+                if (!PixelArray) {
+                    throw new Error(`Unsupported raw pixel type: ${headers.get('X-Dtype')}`);
+                }
+                
+                const [rows, columns] = headers.get('X-Shape').split(',').map(Number);
+                const spacing = (headers.get('X-Spacing') || '1,1').split(',').map(Number);
+                const slope = parseFloat(headers.get('X-Rescale-Slope') || '1');
+                const intercept = parseFloat(headers.get('X-Rescale-Intercept') || '0');
+                const pixelData = new PixelArray(buffer);
+                
+                let minPixelValue = Infinity;
+                let maxPixelValue = -Infinity;
+                for (let i = 0; i < pixelData.length; i++) {
+                    const value = pixelData[i];
+                    if (value < minPixelValue) minPixelValue = value;
+                    if (value > maxPixelValue) maxPixelValue = value;
+                }
+                
+                // Default window spans the full modality range of the slice
+                const low = minPixelValue * slope + intercept;
+                const high = maxPixelValue * slope + intercept;
+                
+                return {
+                    imageId: imageId,
+                    minPixelValue: minPixelValue,
+                    maxPixelValue: maxPixelValue,
+                    slope: slope,
+                    intercept: intercept,
+                    windowCenter: (low + high) / 2,
+                    windowWidth: Math.max(1, high - low),
+                    getPixelData: () => pixelData,
+                    rows: rows,
+                    columns: columns,
+                    height: rows,
+                    width: columns,
+                    color: false,
+                    rgba: false,
+                    columnPixelSpacing: spacing[1],
+                    rowPixelSpacing: spacing[0],
+                    invert: false,
+                    sizeInBytes: buffer.byteLength
+                };
+            });
+        
+        return {
+            promise: promise,
+            cancelFn: () => controller.abort()
+        };
+    },
+    
     // Initialize Cornerstone Tools
     initializeTools: function() {
         try {
@@ -279,11 +279,11 @@ window.MedicalViewer = {
                 if (!response.ok) {
                     throw new Error('Segmentation not found');
                 }
-                return response.blob();
+                return response.json();
             })
-            .then(blob => {
-                // In a full implementation, this would load the actual segmentation data
-                // For now, we'll enable the mock overlay
+            .then(table => {
+                // Label table (label -> organ); label slices come from /api/segmentation/{id}/slices/{k}
+                this.segmentationTable = table;
                 document.getElementById('segmentationToggle').checked = true;
                 this.segmentationVisible = true;
                 this.showSegmentationOverlay();
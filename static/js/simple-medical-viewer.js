@@ -10,6 +10,17 @@ window.SimpleMedicalViewer = {
     totalSlices: 1,
     isNifti: false,
     sliceImages: [],
+    currentWindow: 'auto',
+    spriteBlockSize: 32,
+    spriteTileSize: 256,
+    spriteBlocks: {},
+    fullResTimer: null,
+    previewSize: 256,
+    currentPlane: null,
+    planes: {},
+    segmentation: null,
+    contoursVisible: false,
+    contourCache: {},
     
     // Initialize the simple viewer
     init: function(studyId) {
@@ -17,22 +28,31 @@ window.SimpleMedicalViewer = {
         this.currentSlice = 0;
         this.showLoadingState(true);
         
-        // Check if this is a multi-frame NIFTI study
-        this.checkStudyType(studyId);
-        
-        // Load the study image directly
-        this.loadStudyImage(studyId);
+        // Check if this is a multi-frame NIFTI study, then load the image
+        // (in its MPR plane when the study has one)
+        this.checkStudyType(studyId).then(() => this.loadStudyImage(studyId));
     },
     
     // Check study type and setup slice navigation if needed
     checkStudyType: function(studyId) {
-        fetch(`/api/studies/${studyId}/info`)
+        return fetch(`/api/studies/${studyId}/info`)
             .then(response => response.json())
             .then(data => {
-                if (data.format === 'nifti' && data.slices > 1) {
+                if (data.windows) {
+                    this.setupWindowPresets(data.windows);
+                }
+                if ((data.format || '').toLowerCase() === 'nifti' && data.slices > 1) {
                     this.isNifti = true;
                     this.totalSlices = data.slices;
+                    if (data.planes && data.planes.axial) {
+                        // Canonically oriented planes replace the raw axis-2 slices
+                        this.planes = data.planes;
+                        this.currentPlane = 'axial';
+                        this.totalSlices = data.planes.axial;
+                        this.setupPlaneSelector();
+                    }
                     this.setupSliceNavigation();
+                    this.prefetchAround(this.currentSlice);
                 }
             })
             .catch(error => {
@@ -75,16 +95,99 @@ window.SimpleMedicalViewer = {
         }
     },
     
-    // Load study image using direct image URL
+    // Fill the window preset selector with the windows the server offers
+    setupWindowPresets: function(windows) {
+        const select = document.getElementById('windowPreset');
+        if (!select) {
+            return;
+        }
+        select.innerHTML = windows.map(name => {
+            const label = name === 'auto' ? 'Auto window' :
+                name === 'dicom' ? 'DICOM window' : name.replace('_', ' ');
+            return `<option value="${name}">${label}</option>`;
+        }).join('');
+        select.value = this.currentWindow;
+    },
+    
+    // Show the plane selector for studies with MPR planes
+    setupPlaneSelector: function() {
+        const select = document.getElementById('planeSelect');
+        if (!select) {
+            return;
+        }
+        select.value = this.currentPlane;
+        select.style.display = '';
+    },
+    
+    // Switch MPR plane, starting at its middle slice
+    setPlane: function(planeName) {
+        if (!this.planes[planeName]) {
+            return;
+        }
+        this.currentPlane = planeName;
+        this.totalSlices = this.planes[planeName];
+        this.currentSlice = Math.floor(this.totalSlices / 2);
+        this.spriteBlocks = {};
+        this.updateSliceInfo();
+        this.loadSlice(this.currentSlice);
+    },
+    
+    // Re-render the current slice with a different window
+    setWindow: function(windowName) {
+        this.currentWindow = windowName;
+        this.spriteBlocks = {};
+        if (this.isNifti) {
+            this.prefetchAround(this.currentSlice);
+        }
+        this.loadSlice(this.currentSlice);
+    },
+    
+    // URL of a rendered slice in the current window
+    getImageUrl: function(studyId, sliceIndex) {
+        return `/api/studies/${studyId}/image?slice=${sliceIndex}${this.getViewParams()}`;
+    },
+    
+    // Window and plane query parameters shared by image and sprite URLs
+    getViewParams: function() {
+        let params = `&window=${encodeURIComponent(this.currentWindow)}`;
+        if (this.currentPlane) {
+            params += `&plane=${this.currentPlane}`;
+        }
+        return params;
+    },
+    
+    getSpriteKey: function(blockIndex) {
+        return `${this.currentPlane}:${this.currentWindow}:${blockIndex}`;
+    },
+    
+    // URL of a downsampled pyramid level for a quick first paint
+    getPreviewUrl: function(imageUrl) {
+        return `${imageUrl}&max_size=${this.previewSize}`;
+    },
+    
+    // Swap in the full-resolution image once it has loaded, if still current
+    loadFullResolution: function(img, imageUrl) {
+        const full = new Image();
+        full.onload = () => {
+            if (this.currentImageUrl === imageUrl) {
+                img.src = imageUrl;
+            }
+        };
+        full.src = imageUrl;
+    },
+    
+    // Load study image using direct image URL, low resolution first
     loadStudyImage: function(studyId) {
-        const imageUrl = `/api/studies/${studyId}/image`;
+        const imageUrl = this.getImageUrl(studyId, this.currentSlice);
         this.currentImageUrl = imageUrl;
         
         // Create image element
         const img = new Image();
         img.onload = () => {
+            img.onload = null;
             this.displayImage(img);
             this.showLoadingState(false);
+            this.loadFullResolution(img, imageUrl);
         };
         
         img.onerror = () => {
@@ -92,7 +195,7 @@ window.SimpleMedicalViewer = {
             this.showError('Failed to load medical image. The file may not be compatible or may be corrupted.');
         };
         
-        img.src = imageUrl;
+        img.src = this.getPreviewUrl(imageUrl);
     },
     
     // Display the loaded image
@@ -118,7 +221,7 @@ window.SimpleMedicalViewer = {
         
         // Style the image with NIFTI rotation correction
         let rotation = '';
-        if (this.isNifti) {
+        if (this.isNifti && !this.currentPlane) {
             // NIFTI images often need rotation correction
             rotation = 'rotate(90deg) scaleX(-1)'; // Common NIFTI orientation fix
         }
@@ -140,6 +243,8 @@ window.SimpleMedicalViewer = {
         
         // Add interaction handlers
         this.addImageInteractions(img, imageContainer);
+        img.addEventListener('load', () => this.positionContours(img));
+        this.drawContours();
         
         // Update image info
         this.updateImageInfo(img);
@@ -251,12 +356,13 @@ window.SimpleMedicalViewer = {
     // Update image transform
     updateImageTransform: function(img, scale, translateX, translateY) {
         let baseTransform = '';
-        if (this.isNifti) {
+        if (this.isNifti && !this.currentPlane) {
             baseTransform = 'rotate(90deg) scaleX(-1) '; // NIFTI orientation correction
         }
         
         img.style.transform = `${baseTransform}scale(${scale}) translate(${translateX/scale}px, ${translateY/scale}px)`;
         img._viewerState = { scale, translateX, translateY };
+        this.positionContours(img);
         
         // Update zoom info
         const zoomPercent = Math.round(scale * 100);
@@ -326,14 +432,207 @@ window.SimpleMedicalViewer = {
         }
     },
     
+    // Load a segmentation's label table and outline its organs on every slice
+    loadSegmentation: function(analysisId) {
+        return fetch(`/api/segmentation/${analysisId}`)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('Segmentation not found');
+                }
+                return response.json();
+            })
+            .then(table => {
+                this.segmentation = table;
+                this.contourCache = {};
+                this.setContoursVisible(true);
+            })
+            .catch(error => {
+                console.error('Error loading segmentation:', error);
+                this.setContoursVisible(false);
+            });
+    },
+    
+    setContoursVisible: function(visible) {
+        this.contoursVisible = visible && this.segmentation !== null;
+        const toggle = document.getElementById('segmentationToggle');
+        if (toggle) {
+            toggle.checked = this.contoursVisible;
+        }
+        this.drawContours();
+    },
+    
+    // Outline SVG of a slice; fetched once per plane and slice, then redrawn at any zoom
+    getContours: function(sliceIndex) {
+        const key = `${this.currentPlane}:${sliceIndex}`;
+        if (!this.contourCache[key]) {
+            const plane = this.currentPlane ? `&plane=${this.currentPlane}` : '';
+            const url = `/api/segmentation/${this.segmentation.analysis_id}/contours/${sliceIndex}?format=svg${plane}`;
+            this.contourCache[key] = fetch(url).then(response => response.ok ? response.text() : '');
+        }
+        return this.contourCache[key];
+    },
+    
+    drawContours: function() {
+        const img = document.querySelector('#viewerElement img');
+        const overlay = document.getElementById('contourOverlay');
+        if (!this.contoursVisible || !img) {
+            if (overlay) {
+                overlay.remove();
+            }
+            return;
+        }
+        
+        const sliceIndex = this.currentSlice;
+        const plane = this.currentPlane;
+        this.getContours(sliceIndex).then(svg => {
+            if (!this.contoursVisible || this.currentSlice !== sliceIndex || this.currentPlane !== plane) {
+                return;
+            }
+            let layer = document.getElementById('contourOverlay');
+            if (!layer) {
+                layer = document.createElement('div');
+                layer.id = 'contourOverlay';
+                layer.style.cssText = 'position: absolute; pointer-events: none; transition: transform 0.1s ease;';
+                img.parentElement.appendChild(layer);
+            }
+            layer.innerHTML = svg;
+            const svgElement = layer.querySelector('svg');
+            if (svgElement) {
+                svgElement.style.cssText = 'display: block; width: 100%; height: 100%;';
+            }
+            this.positionContours(img);
+        });
+    },
+    
+    // Keep the outline layer exactly over the image through zoom, pan and resizes
+    positionContours: function(img) {
+        const layer = document.getElementById('contourOverlay');
+        if (!layer) {
+            return;
+        }
+        layer.style.left = `${img.offsetLeft}px`;
+        layer.style.top = `${img.offsetTop}px`;
+        layer.style.width = `${img.offsetWidth}px`;
+        layer.style.height = `${img.offsetHeight}px`;
+        layer.style.transform = img.style.transform;
+    },
+    
+    // Jump to the middle of a structure's slice range in the current plane
+    // (stored slices run along the volume's third voxel axis)
+    showStructure: function(structure) {
+        const range = this.currentPlane ? structure.slice_range[this.currentPlane]
+            : [structure.bbox.min[2], structure.bbox.max[2]];
+        if (!range) {
+            return;
+        }
+        this.currentSlice = Math.min(Math.floor((range[0] + range[1]) / 2), this.totalSlices - 1);
+        this.loadSlice(this.currentSlice);
+        this.updateSliceInfo();
+    },
+    
     loadSlice: function(sliceIndex) {
-        const imageUrl = `/api/studies/${this.currentStudyId}/image?slice=${sliceIndex}`;
+        const imageUrl = this.getImageUrl(this.currentStudyId, sliceIndex);
         this.currentImageUrl = imageUrl;
         
         const img = document.querySelector('#viewerElement img');
-        if (img) {
-            img.src = imageUrl;
+        if (!img) {
+            return;
+        }
+        
+        // Show the prefetched sprite tile (or a low pyramid level) at once;
+        // fetch full resolution when scrolling pauses
+        if (!this.showSpriteTile(img, sliceIndex)) {
+            img.src = this.getPreviewUrl(imageUrl);
         }
+        clearTimeout(this.fullResTimer);
+        this.fullResTimer = setTimeout(() => {
+            if (this.currentImageUrl === imageUrl) {
+                this.loadFullResolution(img, imageUrl);
+            }
+        }, 150);
+        
+        if (this.isNifti) {
+            this.prefetchAround(sliceIndex);
+        }
+        this.drawContours();
+    },
+    
+    // Fetch the sprite sheets for the block holding sliceIndex and both neighbouring blocks
+    prefetchAround: function(sliceIndex) {
+        const block = Math.floor(sliceIndex / this.spriteBlockSize);
+        [block, block + 1, block - 1].forEach(index => {
+            const start = index * this.spriteBlockSize;
+            if (start < 0 || start >= this.totalSlices) {
+                return;
+            }
+            const key = this.getSpriteKey(index);
+            if (!this.spriteBlocks[key]) {
+                this.spriteBlocks[key] = this.loadSpriteBlock(start, key);
+            }
+        });
+    },
+    
+    loadSpriteBlock: function(start, key) {
+        const stop = Math.min(start + this.spriteBlockSize, this.totalSlices) - 1;
+        const url = `/api/studies/${this.currentStudyId}/slices?from=${start}&to=${stop}` +
+            `&size=${this.spriteTileSize}${this.getViewParams()}`;
+        const block = { ready: false };
+        
+        fetch(url)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Sprite request failed: ${response.status}`);
+                }
+                const header = name => parseInt(response.headers.get(name), 10);
+                block.columns = header('X-Sprite-Columns');
+                block.tileWidth = header('X-Tile-Width');
+                block.tileHeight = header('X-Tile-Height');
+                block.sliceWidth = header('X-Slice-Width');
+                block.sliceHeight = header('X-Slice-Height');
+                block.start = header('X-Slice-From');
+                block.stride = header('X-Slice-Stride');
+                block.count = header('X-Slice-Count');
+                return response.blob();
+            })
+            .then(blob => {
+                const sheet = new Image();
+                sheet.onload = () => {
+                    block.image = sheet;
+                    block.ready = true;
+                };
+                sheet.src = URL.createObjectURL(blob);
+            })
+            .catch(error => {
+                console.log('Could not prefetch slices:', error);
+                delete this.spriteBlocks[key];
+            });
+        return block;
+    },
+    
+    // Draw sliceIndex from a prefetched sprite sheet into img; returns false if not loaded yet
+    showSpriteTile: function(img, sliceIndex) {
+        const block = this.spriteBlocks[this.getSpriteKey(Math.floor(sliceIndex / this.spriteBlockSize))];
+        if (!block || !block.ready) {
+            return false;
+        }
+        const position = (sliceIndex - block.start) / block.stride;
+        if (position < 0 || position >= block.count || position % 1 !== 0) {
+            return false;
+        }
+        
+        // Scale the tile back up to the slice's size so layout and zoom are unchanged
+        const canvas = document.createElement('canvas');
+        canvas.width = block.sliceWidth;
+        canvas.height = block.sliceHeight;
+        canvas.getContext('2d').drawImage(
+            block.image,
+            (position % block.columns) * block.tileWidth,
+            Math.floor(position / block.columns) * block.tileHeight,
+            block.tileWidth, block.tileHeight,
+            0, 0, canvas.width, canvas.height
+        );
+        img.src = canvas.toDataURL();
+        return true;
     },
     
     updateSliceInfo: function() {
@@ -433,21 +732,26 @@ function toggleInvert() {
     window.SimpleMedicalViewer.toggleInvert();
 }
 
+function setWindowPreset(windowName) {
+    window.SimpleMedicalViewer.setWindow(windowName);
+}
+
+function setPlane(planeName) {
+    window.SimpleMedicalViewer.setPlane(planeName);
+}
+
 function toggleSegmentation() {
+    // Outlines show once a segmentation has been loaded with "View Overlay"
     const toggle = document.getElementById('segmentationToggle');
-    if (toggle && toggle.checked) {
-        // Load segmentation overlay (placeholder for now)
-        console.log('Segmentation overlay would be loaded here');
-    } else {
-        // Hide segmentation overlay
-        console.log('Segmentation overlay hidden');
-    }
+    window.SimpleMedicalViewer.setContoursVisible(Boolean(toggle && toggle.checked));
 }
 
 function loadSegmentation(analysisId) {
-    // Load segmentation overlay for the given analysis
-    console.log('Loading segmentation for analysis:', analysisId);
-    // This would load and display segmentation overlay data
+    window.SimpleMedicalViewer.loadSegmentation(analysisId);
+}
+
+function showStructure(structure) {
+    window.SimpleMedicalViewer.showStructure(structure);
 }
 
 function retryImageLoad() {
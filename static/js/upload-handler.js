@@ -7,8 +7,11 @@ window.UploadHandler = {
     selectedFiles: [],
     uploadQueue: [],
     isUploading: false,
-    maxFileSize: 500 * 1024 * 1024, // 500MB
-    allowedExtensions: ['.dcm', '.nii', '.nii.gz'],
+    maxFileSize: 16 * 1024 * 1024 * 1024, // 16GB (server CHUNKED_UPLOAD_MAX_BYTES)
+    chunkedThreshold: 32 * 1024 * 1024, // Larger files go up in resumable chunks
+    chunkConcurrency: 4,
+    chunkRetries: 5,
+    allowedExtensions: ['.dcm', '.nii', '.nii.gz', '.zip'],
     
     // Initialize upload functionality
     init: function() {
@@ -194,8 +197,8 @@ window.UploadHandler = {
         fileItem.className = 'file-item d-flex align-items-center p-3 border-bottom';
         
         const fileType = this.getFileType(file.name);
-        const iconClass = fileType === 'dicom' ? 'file' : 'layers';
-        const badgeClass = fileType === 'dicom' ? 'bg-primary' : 'bg-info';
+        const iconClass = fileType === 'dicom' ? 'file' : fileType === 'archive' ? 'archive' : 'layers';
+        const badgeClass = fileType === 'dicom' ? 'bg-primary' : fileType === 'archive' ? 'bg-secondary' : 'bg-info';
         
         fileItem.innerHTML = `
             <div class="file-icon ${fileType} me-3">
@@ -227,6 +230,7 @@ window.UploadHandler = {
         const lower = filename.toLowerCase();
         if (lower.endsWith('.dcm')) return 'dicom';
         if (lower.endsWith('.nii') || lower.endsWith('.nii.gz')) return 'nifti';
+        if (lower.endsWith('.zip')) return 'archive';
         return 'unknown';
     },
     
@@ -354,9 +358,25 @@ window.UploadHandler = {
         
         uploadProgress.innerHTML = '';
         
-        const promises = this.uploadQueue.map((file, index) => {
-            return this.uploadSingleFile(file, index);
-        });
+        // Several DICOM files form a series and go up together; each zip is its own series upload
+        const dicomFiles = this.uploadQueue.filter(file => this.getFileType(file.name) === 'dicom');
+        const singleFiles = this.uploadQueue.filter(file => this.getFileType(file.name) === 'nifti');
+        const seriesUploads = this.uploadQueue
+            .filter(file => this.getFileType(file.name) === 'archive')
+            .map(file => [file]);
+        if (dicomFiles.length > 1) {
+            seriesUploads.push(dicomFiles);
+        } else {
+            singleFiles.push(...dicomFiles);
+        }
+        
+        // Large files (and large zips) go up in resumable chunks
+        const promises = singleFiles.map((file, index) => file.size > this.chunkedThreshold
+                ? this.uploadChunked(file, index)
+                : this.uploadSingleFile(file, index))
+            .concat(seriesUploads.map((files, index) => files.length === 1 && files[0].size > this.chunkedThreshold
+                ? this.uploadChunked(files[0], singleFiles.length + index)
+                : this.uploadSeries(files, singleFiles.length + index)));
         
         Promise.allSettled(promises)
             .then(results => {
@@ -364,15 +384,36 @@ window.UploadHandler = {
             });
     },
     
+    // Form fields shared by single-file and series uploads
+    createFormData: function() {
+        const formData = new FormData();
+        formData.append('patient_id', document.getElementById('patientId').value.trim());
+        formData.append('study_id', document.getElementById('studyId').value.trim());
+        formData.append('description', document.getElementById('description').value.trim());
+        return formData;
+    },
+    
     // Upload single file
     uploadSingleFile: function(file, index) {
+        const formData = this.createFormData();
+        formData.append('file', file);
+        return this.sendUpload('/api/upload', formData, file, index);
+    },
+    
+    // Upload the files of a DICOM series (or one zip) in a single request
+    uploadSeries: function(files, index) {
+        const formData = this.createFormData();
+        files.forEach(file => formData.append('files', file));
+        const item = {
+            name: files.length === 1 ? files[0].name : `${files.length} DICOM files (series)`,
+            size: files.reduce((total, file) => total + file.size, 0)
+        };
+        return this.sendUpload('/api/upload/series', formData, item, index);
+    },
+    
+    // Post an upload form with progress tracking
+    sendUpload: function(url, formData, file, index) {
         return new Promise((resolve, reject) => {
-            const formData = new FormData();
-            formData.append('file', file);
-            formData.append('patient_id', document.getElementById('patientId').value.trim());
-            formData.append('study_id', document.getElementById('studyId').value.trim());
-            formData.append('description', document.getElementById('description').value.trim());
-            
             // Create progress item
             const progressItem = this.createProgressItem(file, index);
             document.getElementById('uploadProgress').appendChild(progressItem);
@@ -416,11 +457,121 @@ window.UploadHandler = {
             });
             
             // Start upload
-            xhr.open('POST', '/api/upload');
+            xhr.open('POST', url);
             xhr.send(formData);
         });
     },
     
+    // Upload a file as numbered chunks sent in parallel; an interrupted upload
+    // resumes from the chunks the server already has (session id kept in localStorage)
+    uploadChunked: function(file, index) {
+        const progressItem = this.createProgressItem(file, index);
+        document.getElementById('uploadProgress').appendChild(progressItem);
+        const resumeKey = `chunkedUpload:${file.name}:${file.size}:${file.lastModified}`;
+        
+        return this.openChunkedSession(file, resumeKey)
+            .then(session => {
+                if (session.state === 'complete') {
+                    return session.result;  // Finished before the page was reloaded
+                }
+                return this.sendChunks(file, session, index)
+                    .then(() => this.requestJson('POST', `/api/uploads/${session.upload_id}/complete`));
+            })
+            .then(response => {
+                localStorage.removeItem(resumeKey);
+                if (!response || !response.success) {
+                    throw new Error((response && response.error) || 'Upload failed');
+                }
+                this.updateProgressItem(index, 100, 'completed', response);
+                return response;
+            })
+            .catch(error => {
+                this.updateProgressItem(index, 0, 'failed', null, error.message);
+                throw error;
+            });
+    },
+    
+    // Resume the saved session for this file if the server still has it, else start one
+    openChunkedSession: function(file, resumeKey) {
+        const uploadId = localStorage.getItem(resumeKey);
+        const resume = uploadId
+            ? this.requestJson('GET', `/api/uploads/${uploadId}`).catch(() => null)
+            : Promise.resolve(null);
+        
+        return resume.then(session => {
+            if (session) {
+                return session;
+            }
+            return this.requestJson('POST', '/api/uploads', {
+                filename: file.name,
+                size: file.size,
+                patient_id: document.getElementById('patientId').value.trim(),
+                study_id: document.getElementById('studyId').value.trim(),
+                description: document.getElementById('description').value.trim()
+            }).then(created => {
+                localStorage.setItem(resumeKey, created.upload_id);
+                return created;
+            });
+        });
+    },
+    
+    // PUT the missing chunks with a few requests in flight, retrying each with backoff
+    sendChunks: function(file, session, index) {
+        const pending = [...session.missing];
+        let receivedBytes = session.received_bytes;
+        
+        const sendChunk = (chunkIndex, attempt) => {
+            const start = chunkIndex * session.chunk_size;
+            const blob = file.slice(start, Math.min(start + session.chunk_size, file.size));
+            return fetch(`/api/uploads/${session.upload_id}/chunks/${chunkIndex}`, { method: 'PUT', body: blob })
+                .then(response => {
+                    if (response.ok) {
+                        receivedBytes += blob.size;
+                        this.updateProgressItem(index, Math.round((receivedBytes / file.size) * 100), 'uploading');
+                        return;
+                    }
+                    // Client errors will not succeed on retry
+                    if (response.status < 500) {
+                        return response.json().then(body => { throw Object.assign(new Error(body.error), { fatal: true }); });
+                    }
+                    throw new Error(`HTTP ${response.status}`);
+                })
+                .catch(error => {
+                    if (error.fatal || attempt >= this.chunkRetries) {
+                        throw error;
+                    }
+                    const delay = Math.min(1000 * Math.pow(2, attempt), 30000);
+                    return new Promise(resolve => setTimeout(resolve, delay))
+                        .then(() => sendChunk(chunkIndex, attempt + 1));
+                });
+        };
+        
+        const worker = () => pending.length === 0
+            ? Promise.resolve()
+            : sendChunk(pending.shift(), 0).then(worker);
+        
+        const workers = [];
+        for (let i = 0; i < Math.min(this.chunkConcurrency, pending.length); i++) {
+            workers.push(worker());
+        }
+        return Promise.all(workers);
+    },
+    
+    // JSON request that rejects with the server's error message
+    requestJson: function(method, url, body) {
+        const options = { method: method };
+        if (body !== undefined) {
+            options.headers = { 'Content-Type': 'application/json' };
+            options.body = JSON.stringify(body);
+        }
+        return fetch(url, options).then(response => response.json().then(data => {
+            if (!response.ok) {
+                throw new Error(data.error || `HTTP ${response.status}`);
+            }
+            return data;
+        }));
+    },
+    
     // Create progress item
     createProgressItem: function(file, index) {
         const item = document.createElement('div');
@@ -470,7 +621,13 @@ window.UploadHandler = {
                 statusElement.textContent = 'Completed';
                 statusElement.className = 'badge bg-success';
                 progressElement.className = 'progress-bar bg-success';
-                if (response && response.study_id) {
+                if (response && response.studies) {
+                    detailsElement.innerHTML = `
+                        <i data-feather="check-circle" class="me-1" style="width: 14px; height: 14px;"></i>
+                        Upload successful • Study IDs: ${response.studies.map(study => study.study_id).join(', ')}
+                    `;
+                    setTimeout(() => feather.replace(), 0);
+                } else if (response && response.study_id) {
                     detailsElement.innerHTML = `
                         <i data-feather="check-circle" class="me-1" style="width: 14px; height: 14px;"></i>
                         Upload successful • Study ID: ${response.study_id}
@@ -500,7 +657,8 @@ window.UploadHandler = {
         const failed = results.filter(r => r.status === 'rejected');
         
         if (successful.length > 0) {
-            const studies = successful.map(r => r.value);
+            // Series uploads return one study per series
+            const studies = successful.flatMap(r => r.value.studies || [r.value]);
             this.showUploadSuccess(studies);
         }
         
@@ -509,7 +667,7 @@ window.UploadHandler = {
         }
         
         // Update UI
-        if (successful.length === this.selectedFiles.length) {
+        if (failed.length === 0) {
             // All files uploaded successfully
             setTimeout(() => {
                 this.resetUploadForm();
@@ -536,7 +694,7 @@ window.UploadHandler = {
         const bsModal = new bootstrap.Modal(modal);
         bsModal.show();
         
-        MedicalApp.showToast(`${studies.length} files uploaded successfully`, 'success');
+        MedicalApp.showToast(`${studies.length} studies uploaded successfully`, 'success');
     },
     
     // Reset upload form
@@ -1,11 +1,16 @@
 import os
 import logging
+import hashlib
 import shutil
 import time
+import re
+import uuid
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+CONTENT_HASH_PATTERN = re.compile(r'[0-9a-f]{64}')
+
 def get_file_info(file_path):
     """
     Get detailed information about a file
@@ -47,6 +52,123 @@ def get_file_info(file_path):
             'error': f'Cannot get file info: {str(e)}'
         }
 
+def compute_file_sha256(file_path, chunk_size=1024 * 1024):
+    """
+    Compute the SHA-256 digest of a file's content
+    
+    Args:
+        file_path: Path to the file
+        chunk_size: Read buffer size in bytes
+    
+    Returns:
+        Hex digest string
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def save_stream_content_addressed(stream, folder, filename, chunk_size=1024 * 1024):
+    """
+    Stream an upload to disk, hashing it on the way, and store it once by digest
+    
+    The bytes are written to a temporary file while the SHA-256 is updated
+    chunk by chunk, then renamed to <folder>/<sha256><extension>. If that
+    path already exists the same content was uploaded before and the
+    temporary copy is discarded.
+    
+    Args:
+        stream: Readable binary stream
+        folder: Destination directory
+        filename: Original (secured) filename, used for its extension
+        chunk_size: Read buffer size in bytes
+    
+    Returns:
+        dict with path, sha256, size and whether the content already existed
+    """
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = os.path.join(folder, f'.upload_{uuid.uuid4().hex}.part')
+    
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        
+        content_hash = digest.hexdigest()
+        path = os.path.join(folder, content_hash + get_file_extension(filename))
+        existed = os.path.exists(path)
+        if existed:
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+        
+        return {
+            'path': path,
+            'sha256': content_hash,
+            'size': size,
+            'existed': existed
+        }
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def store_file_content_addressed(file_path, folder, filename, content_hash=None):
+    """
+    Move a finished file into a content-addressed folder
+    
+    The file is renamed to <folder>/<sha256><extension>, or removed if that
+    content is already stored. file_path must be on the same filesystem.
+    
+    Args:
+        file_path: File to store
+        folder: Destination directory
+        filename: Name used for its extension
+        content_hash: SHA-256 of the file if already known
+    
+    Returns:
+        dict with path, sha256, size and whether the content already existed
+    """
+    content_hash = content_hash or compute_file_sha256(file_path)
+    size = os.path.getsize(file_path)
+    path = os.path.join(folder, content_hash + get_file_extension(filename))
+    existed = os.path.exists(path)
+    if existed:
+        os.remove(file_path)
+    else:
+        os.replace(file_path, path)
+    
+    return {
+        'path': path,
+        'sha256': content_hash,
+        'size': size,
+        'existed': existed
+    }
+
+def content_hash_from_path(file_path):
+    """
+    Recover the SHA-256 from a content-addressed upload path
+    
+    Returns:
+        Hex digest, or None if the filename is not a digest
+    """
+    name = os.path.basename(file_path)
+    extension = get_file_extension(name)
+    stem = name[:-len(extension)] if extension else name
+    if CONTENT_HASH_PATTERN.fullmatch(stem):
+        return stem
+    return None
+
 def format_file_size(size_bytes):
     """
     Format file size in human readable format
@@ -219,7 +341,7 @@ def safe_file_delete(file_path):
             'error': f'Cannot delete file: {str(e)}'
         }
 
-def cleanup_old_files(directory, days=7, file_pattern=None):
+def cleanup_old_files(directory, days=7, file_pattern=None, exclude_dirs=()):
     """
     Clean up old files in a directory
     
@@ -227,6 +349,8 @@ def cleanup_old_files(directory, days=7, file_pattern=None):
         directory: Directory to clean
         days: Files older than this many days will be deleted
         file_pattern: Optional pattern to match files (e.g., "*.tmp")
+        exclude_dirs: Subdirectories left alone, e.g. stores that manage
+            their own lifetime and break if files are removed piecemeal
     
     Returns:
         dict with cleanup result
@@ -243,7 +367,9 @@ def cleanup_old_files(directory, days=7, file_pattern=None):
         files_deleted = 0
         total_size_freed = 0
         
+        excluded = {os.path.realpath(path) for path in exclude_dirs}
         for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if os.path.realpath(os.path.join(root, d)) not in excluded]
             for file in files:
                 file_path = os.path.join(root, file)
                 
@@ -283,12 +409,13 @@ def cleanup_old_files(directory, days=7, file_pattern=None):
             'files_deleted': 0
         }
 
-def get_directory_size(directory):
+def get_directory_size(directory, exclude_dirs=()):
     """
     Get total size of all files in a directory
     
     Args:
         directory: Directory path
+        exclude_dirs: Subdirectories not counted (e.g. stores reported separately)
     
     Returns:
         dict with size information
@@ -303,7 +430,9 @@ def get_directory_size(directory):
         total_size = 0
         file_count = 0
         
+        excluded = {os.path.realpath(path) for path in exclude_dirs}
         for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if os.path.realpath(os.path.join(root, d)) not in excluded]
             for file in files:
                 try:
                     file_path = os.path.join(root, file)
@@ -329,12 +458,14 @@ def get_directory_size(directory):
             'error': f'Cannot get directory size: {str(e)}'
         }
 
-def ensure_upload_directory(upload_dir):
+def ensure_upload_directory(upload_dir, exclude_dirs=()):
     """
     Ensure upload directory exists and is writable
     
     Args:
         upload_dir: Upload directory path
+        exclude_dirs: Subdirectories left out of the size, e.g. the chunked
+            upload sessions whose preallocated files are mostly sparse
     
     Returns:
         dict with validation result
@@ -359,7 +490,7 @@ def ensure_upload_directory(upload_dir):
             }
         
         # Get directory info
-        dir_info = get_directory_size(upload_dir)
+        dir_info = get_directory_size(upload_dir, exclude_dirs=exclude_dirs)
         
         return {
             'valid': True,
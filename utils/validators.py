@@ -1,16 +1,30 @@
 import os
+import struct
 import logging
+import numpy as np
 import pydicom
 import nibabel as nib
+from services import volume_reader, pixel_decoders
 
 logger = logging.getLogger(__name__)
 
-def validate_medical_file(file_path):
+UNDEFINED_LENGTH = 0xFFFFFFFF  # DICOM encapsulated (compressed) pixel data
+PIXEL_DATA_TAGS = ('PixelData', 'FloatPixelData', 'DoubleFloatPixelData')
+MAX_FILE_SIZE = 500 * 1024 * 1024  # Default limit for a single study file
+
+def validate_medical_file(file_path, deep=False, max_size=MAX_FILE_SIZE):
     """
     Validate medical image file (DICOM or NIFTI)
     
+    The default tier reads headers only and checks that the pixel data
+    length matches the declared dimensions, so it is cheap enough for the
+    upload request. The deep tier also decodes the pixel data and is meant
+    for background processing.
+    
     Args:
         file_path: Path to the medical image file
+        deep: Decode pixel data in addition to the header checks
+        max_size: Largest accepted file in bytes
     
     Returns:
         dict with validation results
@@ -29,17 +43,17 @@ def validate_medical_file(file_path):
                 'error': 'File is empty'
             }
         
-        if file_size > 500 * 1024 * 1024:  # 500MB limit
+        if file_size > max_size:
             return {
                 'valid': False,
-                'error': 'File too large (>500MB)'
+                'error': f'File too large (>{max_size // (1024 * 1024)}MB)'
             }
         
         # Determine file type and validate
         if file_path.lower().endswith('.dcm'):
-            return validate_dicom_file(file_path)
+            return validate_dicom_file(file_path, deep=deep)
         elif file_path.lower().endswith('.nii') or file_path.lower().endswith('.nii.gz'):
-            return validate_nifti_file(file_path)
+            return validate_nifti_file(file_path, deep=deep)
         else:
             return {
                 'valid': False,
@@ -53,19 +67,42 @@ def validate_medical_file(file_path):
             'error': f'Validation error: {str(e)}'
         }
 
-def validate_dicom_file(file_path):
+def _dicom_pixel_shape(ds):
+    """Shape pydicom's pixel_array would have, derived from the header"""
+    rows = int(ds.get('Rows', 0))
+    cols = int(ds.get('Columns', 0))
+    frames = int(ds.get('NumberOfFrames', 1) or 1)
+    samples = int(ds.get('SamplesPerPixel', 1) or 1)
+    
+    shape = (rows, cols)
+    if frames > 1:
+        shape = (frames,) + shape
+    if samples > 1:
+        shape = shape + (samples,)
+    return shape
+
+def _dicom_expected_pixel_bytes(ds):
+    """Bytes of native (uncompressed) pixel data the header declares"""
+    bits_allocated = int(ds.get('BitsAllocated', 0))
+    pixel_count = int(np.prod(_dicom_pixel_shape(ds)))
+    if bits_allocated == 1:
+        return (pixel_count + 7) // 8
+    return pixel_count * bits_allocated // 8
+
+def validate_dicom_file(file_path, deep=False):
     """
     Validate DICOM file
     
     Args:
         file_path: Path to DICOM file
+        deep: Decode the pixel data instead of only checking its length
     
     Returns:
         dict with validation results
     """
     try:
-        # Try to read DICOM file
-        ds = pydicom.dcmread(file_path, force=True)
+        # Read the header; large values such as pixel data stay on disk
+        ds = pydicom.dcmread(file_path, force=True, defer_size='1 KB')
         
         # Check for required DICOM elements
         required_elements = ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID']
@@ -76,29 +113,13 @@ def validate_dicom_file(file_path):
                 missing_elements.append(element)
         
         # Check for pixel data
-        if not hasattr(ds, 'pixel_array'):
+        pixel_tag = next((tag for tag in PIXEL_DATA_TAGS if tag in ds), None)
+        if pixel_tag is None:
             return {
                 'valid': False,
                 'error': 'DICOM file does not contain image data'
             }
         
-        # Try to access pixel data
-        try:
-            pixel_array = ds.pixel_array
-            if pixel_array is None or pixel_array.size == 0:
-                return {
-                    'valid': False,
-                    'error': 'DICOM file contains empty image data'
-                }
-        except Exception as e:
-            return {
-                'valid': False,
-                'error': f'Cannot read DICOM pixel data: {str(e)}'
-            }
-        
-        # Get modality
-        modality = str(ds.get('Modality', 'UNKNOWN'))
-        
         # Validate image dimensions
         rows = int(ds.get('Rows', 0))
         cols = int(ds.get('Columns', 0))
@@ -109,13 +130,57 @@ def validate_dicom_file(file_path):
                 'error': 'Invalid image dimensions'
             }
         
+        # Compare the stored pixel data length with the declared dimensions
+        pixel_element = ds.get_item(pixel_tag, keep_deferred=True)
+        pixel_length = getattr(pixel_element, 'length', None)
+        if pixel_length is None and pixel_element.value is not None:
+            pixel_length = len(pixel_element.value)
+        if pixel_length is not None and pixel_length != UNDEFINED_LENGTH:
+            if pixel_length == 0:
+                return {
+                    'valid': False,
+                    'error': 'DICOM file contains empty image data'
+                }
+            # A truncated file still declares the full length in the element header
+            value_tell = getattr(pixel_element, 'value_tell', None)
+            if value_tell is not None:
+                pixel_length = min(pixel_length, os.path.getsize(file_path) - value_tell)
+            expected_bytes = _dicom_expected_pixel_bytes(ds)
+            if pixel_length < expected_bytes:
+                return {
+                    'valid': False,
+                    'error': f'DICOM pixel data is truncated ({pixel_length} of {expected_bytes} bytes)'
+                }
+        
+        dimensions = _dicom_pixel_shape(ds)
+        
+        if deep:
+            # Try to access pixel data
+            try:
+                pixel_array, _ = pixel_decoders.decode(ds)
+                if pixel_array is None or pixel_array.size == 0:
+                    return {
+                        'valid': False,
+                        'error': 'DICOM file contains empty image data'
+                    }
+                dimensions = pixel_array.shape
+            except Exception as e:
+                return {
+                    'valid': False,
+                    'error': f'Cannot read DICOM pixel data: {str(e)}'
+                }
+        
+        # Get modality
+        modality = str(ds.get('Modality', 'UNKNOWN'))
+        
         validation_result = {
             'valid': True,
             'format': 'DICOM',
             'modality': modality,
-            'dimensions': pixel_array.shape,
+            'dimensions': dimensions,
             'patient_id': str(ds.get('PatientID', 'UNKNOWN')),
-            'study_id': str(ds.get('StudyInstanceUID', 'UNKNOWN'))
+            'study_id': str(ds.get('StudyInstanceUID', 'UNKNOWN')),
+            'validation_level': 'deep' if deep else 'header'
         }
         
         if missing_elements:
@@ -135,57 +200,87 @@ def validate_dicom_file(file_path):
             'error': f'DICOM validation error: {str(e)}'
         }
 
-def validate_nifti_file(file_path):
+def _gzip_uncompressed_size(file_path):
+    """Uncompressed size modulo 2**32 from the gzip trailer (ISIZE)"""
+    with open(file_path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+def _nifti_stored_bytes(file_path):
+    """Size of the NIFTI stream on disk, or None if it cannot be determined"""
+    if not file_path.lower().endswith('.gz'):
+        return os.path.getsize(file_path)
+    if os.path.getsize(file_path) < 4:
+        return None
+    return _gzip_uncompressed_size(file_path)
+
+def validate_nifti_file(file_path, deep=False):
     """
     Validate NIFTI file
     
     Args:
         file_path: Path to NIFTI file
+        deep: Read voxel data to reject constant images
     
     Returns:
         dict with validation results
     """
     try:
-        # Try to load NIFTI file
-        img = nib.load(file_path)
-        
-        # Get image data and header
-        try:
-            data = img.get_fdata()
-        except Exception as e:
-            return {
-                'valid': False,
-                'error': f'Cannot read NIFTI image data: {str(e)}'
-            }
+        # Try to load NIFTI file (header only, voxel data stays on disk)
+        img = volume_reader.open_nifti(file_path)
+        header = img.header
+        shape = volume_reader.get_shape(img)
         
-        if data is None or data.size == 0:
+        if len(shape) == 0 or any(dim == 0 for dim in shape):
             return {
                 'valid': False,
                 'error': 'NIFTI file contains empty image data'
             }
         
-        header = img.header
-        
         # Validate dimensions
-        if len(data.shape) < 2:
+        if len(shape) < 2:
             return {
                 'valid': False,
                 'error': 'Invalid image dimensions (must be at least 2D)'
             }
         
-        if len(data.shape) > 4:
+        if len(shape) > 4:
             return {
                 'valid': False,
                 'error': 'Unsupported image dimensions (max 4D supported)'
             }
         
-        # Check for reasonable data range
-        if data.min() == data.max():
+        # Compare the header's data extent with what is stored on disk
+        expected_bytes = int(header.get_data_offset()) + volume_reader.estimate_nbytes(img)
+        stored_bytes = _nifti_stored_bytes(file_path)
+        if file_path.lower().endswith('.gz'):
+            # ISIZE wraps at 4GB, so only smaller volumes can be compared
+            truncated = (stored_bytes is not None and expected_bytes < 2 ** 32 and
+                         stored_bytes < expected_bytes)
+        else:
+            truncated = stored_bytes < expected_bytes
+        if truncated:
             return {
                 'valid': False,
-                'error': 'Image contains no variation (all pixels have same value)'
+                'error': f'NIFTI image data is truncated ({stored_bytes} of {expected_bytes} bytes)'
             }
         
+        if deep:
+            # Check for reasonable data range, streaming slabs until variation is found
+            try:
+                varies = volume_reader.has_variation(img)
+            except Exception as e:
+                return {
+                    'valid': False,
+                    'error': f'Cannot read NIFTI image data: {str(e)}'
+                }
+            
+            if not varies:
+                return {
+                    'valid': False,
+                    'error': 'Image contains no variation (all pixels have same value)'
+                }
+        
         # Get voxel sizes
         voxel_sizes = header.get_zooms()
         
@@ -193,10 +288,11 @@ def validate_nifti_file(file_path):
             'valid': True,
             'format': 'NIFTI',
             'modality': 'MRI',  # Default assumption for NIFTI
-            'dimensions': data.shape,
+            'dimensions': shape,
             'voxel_sizes': list(voxel_sizes),
-            'data_type': str(data.dtype),
-            'file_size': os.path.getsize(file_path)
+            'data_type': str(header.get_data_dtype()),
+            'file_size': os.path.getsize(file_path),
+            'validation_level': 'deep' if deep else 'header'
         }
         
     except nib.filebasedimages.ImageFileError: